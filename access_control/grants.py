@@ -0,0 +1,167 @@
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.db.models import Q
+from django.shortcuts import get_object_or_404, redirect
+from django.utils import timezone
+
+from doctor_app.models import Doctor
+from patients.models import Patient
+
+from .models import PatientAccess
+
+# ============================================================
+# Access grants
+# A doctor may open a patient's records while they hold a
+# verified PatientAccess that has not expired. Lookups go
+#   this process's memory -> default cache -> one indexed query
+#   (access_verified_grant)
+# and a found grant is cached until its expires_at, so most
+# protected requests never reach the table. Saving or deleting a
+# PatientAccess drops the pair from the default cache (see
+# access_control.signals). That cache must be shared between
+# workers: then other processes' memory copies live at most
+# ACCESS_GRANT_LOCAL_TTL seconds, whereas a per-process cache
+# keeps honouring a revoked grant until its expires_at.
+# Missing grants are not cached: verifying an OTP takes effect
+# on the next request.
+# ============================================================
+
+DEFAULT_DENIED_MESSAGE = "OTP verification required."
+
+
+def active_grants():
+    """Verified, unexpired grants."""
+    return PatientAccess.objects.filter(is_verified=True, expires_at__gt=timezone.now())
+
+
+def _key(doctor_id, patient_id):
+    return f"access:grant:{doctor_id}:{patient_id}"
+
+
+class _LocalGrants:
+    """Small in-process map of (doctor_id, patient_id) -> (grant, stored at)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._grants = {}
+
+    def get(self, doctor_id, patient_id):
+        with self._lock:
+            hit = self._grants.get((doctor_id, patient_id))
+        if hit is None or time.monotonic() - hit[1] > settings.ACCESS_GRANT_LOCAL_TTL:
+            return None
+        return hit[0]
+
+    def set(self, doctor_id, patient_id, grant):
+        with self._lock:
+            if len(self._grants) >= settings.ACCESS_GRANT_LOCAL_SIZE:
+                self._grants.clear()
+            self._grants[(doctor_id, patient_id)] = (grant, time.monotonic())
+
+    def discard(self, doctor_id, patient_id):
+        with self._lock:
+            self._grants.pop((doctor_id, patient_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._grants.clear()
+
+
+_local = _LocalGrants()
+
+
+def get_active_grant(doctor_id, patient_id):
+    """
+    The doctor's live grant on the patient as {"id", "expires_at"},
+    or None.
+    """
+    now = timezone.now()
+
+    grant = _local.get(doctor_id, patient_id)
+    if grant is None:
+        grant = cache.get(_key(doctor_id, patient_id))
+    if grant is not None and grant["expires_at"] > now:
+        _local.set(doctor_id, patient_id, grant)
+        return grant
+
+    grant = active_grants().filter(
+        doctor_id=doctor_id, patient_id=patient_id
+    ).order_by("-expires_at").values("id", "expires_at").first()
+    if grant is None:
+        return None
+
+    timeout = int((grant["expires_at"] - now).total_seconds())
+    if timeout > 0:
+        cache.set(_key(doctor_id, patient_id), grant, timeout)
+        _local.set(doctor_id, patient_id, grant)
+    return grant
+
+
+def has_active_grant(doctor_id, patient_id):
+    return get_active_grant(doctor_id, patient_id) is not None
+
+
+def invalidate_grant(doctor_id, patient_id):
+    cache.delete(_key(doctor_id, patient_id))
+    _local.discard(doctor_id, patient_id)
+
+
+def clear_local_grants():
+    _local.clear()
+
+
+def can_read_patient(user, patient_id):
+    """Staff, the patient themselves, or a doctor holding a live grant."""
+    if user.is_staff:
+        return True
+    doctor_id = Doctor.objects.filter(user=user).values_list("id", flat=True).first()
+    if doctor_id is not None and has_active_grant(doctor_id, patient_id):
+        return True
+    return Patient.objects.filter(id=patient_id, user=user).exists()
+
+
+def readable_patient_ids(user):
+    """
+    Subquery of the patients `user` may read (see can_read_patient),
+    for scoping searches; None for staff, who may read every patient.
+    """
+    if user.is_staff:
+        return None
+    granted = active_grants().filter(doctor__user=user).values("patient_id")
+    return Patient.objects.filter(Q(user=user) | Q(id__in=granted)).values("id")
+
+
+def grant_required(view=None, message=DEFAULT_DENIED_MESSAGE):
+    """
+    Guard a doctor view taking `patient_id`: the logged-in doctor needs
+    a live grant on that patient, otherwise they are sent back to the
+    dashboard with `message`. The view finds the doctor and grant on
+    request.doctor and request.grant.
+
+        @login_required
+        @grant_required
+        def view(request, patient_id): ...
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, patient_id, *args, **kwargs):
+            doctor = get_object_or_404(Doctor.objects.select_related("user"), user=request.user)
+
+            grant = get_active_grant(doctor.id, int(patient_id))
+            if grant is None:
+                messages.error(request, message)
+                return redirect("doctor_app:doctor_dashboard")
+
+            request.doctor = doctor
+            request.grant = grant
+            return view_func(request, patient_id, *args, **kwargs)
+        return wrapper
+
+    if view is None:
+        return decorator
+    return decorator(view)
@@ -0,0 +1,45 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from access_control.purge import PURGE_BATCH_SIZE, PURGE_GRACE, purge_expired_grants
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete PatientAccess grants that expired more than --grace-hours "
+        "ago, in small batches. Verified grants are recorded in the audit "
+        "log first. Safe to run from cron alongside traffic."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--grace-hours",
+            type=float,
+            default=PURGE_GRACE.total_seconds() / 3600,
+            help="Keep grants for this long after they expire"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=PURGE_BATCH_SIZE,
+            help="Rows deleted per transaction"
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0.05,
+            help="Seconds to sleep between batches"
+        )
+
+    def handle(self, *args, **options):
+        stats = purge_expired_grants(
+            grace=timedelta(hours=options["grace_hours"]),
+            batch_size=options["batch_size"],
+            pause=options["pause"],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Purged {stats['deleted']} expired grant(s) "
+            f"({stats['audited']} audited) in {stats['batches']} batch(es), "
+            f"{stats['seconds']:.2f}s"
+        ))
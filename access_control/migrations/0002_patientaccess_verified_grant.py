@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-17 21:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('access_control', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patientaccess',
+            index=models.Index(condition=models.Q(('is_verified', True)), fields=['doctor', 'patient', 'expires_at'], name='access_verified_grant'),
+        ),
+    ]
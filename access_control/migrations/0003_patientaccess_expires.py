@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-17 21:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('access_control', '0002_patientaccess_verified_grant'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patientaccess',
+            index=models.Index(fields=['expires_at'], name='access_expires'),
+        ),
+    ]
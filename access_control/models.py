@@ -27,4 +27,16 @@ class PatientAccess(models.Model):
     is_verified = models.BooleanField(default=False)
 
     expires_at = models.DateTimeField()
-    created_at = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # access_control.grants: live verified grant for a doctor/patient pair
+            models.Index(
+                fields=["doctor", "patient", "expires_at"],
+                condition=models.Q(is_verified=True),
+                name="access_verified_grant",
+            ),
+            # access_control.purge walks expired rows in expiry order
+            models.Index(fields=["expires_at"], name="access_expires"),
+        ]
@@ -0,0 +1,14 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .grants import invalidate_grant
+from .models import PatientAccess
+
+
+@receiver([post_save, post_delete], sender=PatientAccess)
+def invalidate_cached_grant(sender, instance, **kwargs):
+    doctor_id, patient_id = instance.doctor_id, instance.patient_id
+    invalidate_grant(doctor_id, patient_id)
+    # again once committed, in case a request re-cached the old row meanwhile
+    transaction.on_commit(lambda: invalidate_grant(doctor_id, patient_id))
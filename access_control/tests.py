@@ -1,3 +1,114 @@
+import datetime
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
+from django.utils import timezone
+
+from doctor_app.models import Doctor
+from hospital_app.models import Hospital
+from patients.models import Patient
+from records.models import AuditLog
+
+from .grants import can_read_patient, clear_local_grants, get_active_grant
+from .models import PatientAccess
+
+
+class AccessTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        hospital = Hospital.objects.create(name="H", location="L", email="h@example.com", phone="1")
+        cls.doctor = Doctor.objects.create(user=User.objects.create_user("drbob", password="pw"),
+                                           hospital=hospital, specialization="x",
+                                           contact_number="1", qualification="MBBS")
+        cls.patient = Patient.objects.create(user=User.objects.create_user("pat", password="pw"))
+
+    def setUp(self):
+        cache.clear()
+        clear_local_grants()
+
+    def _grant(self, **kwargs):
+        fields = dict(doctor=self.doctor, patient=self.patient, otp="123456", is_verified=True,
+                      expires_at=timezone.now() + datetime.timedelta(minutes=10))
+        fields.update(kwargs)
+        return PatientAccess.objects.create(**fields)
+
+
+class AccessGrantTests(AccessTestCase):
+    def test_grant_is_cached_until_revoked(self):
+        access = self._grant()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_active_grant(self.doctor.id, self.patient.id)["id"], access.id)
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(get_active_grant(self.doctor.id, self.patient.id))
+        clear_local_grants()
+        with self.assertNumQueries(0):   # shared cache
+            self.assertIsNotNone(get_active_grant(self.doctor.id, self.patient.id))
+
+        access.delete()
+        self.assertIsNone(get_active_grant(self.doctor.id, self.patient.id))
+
+    def test_revoking_a_grant_deletes_the_shared_key(self):
+        key = f"access:grant:{self.doctor.id}:{self.patient.id}"
+        access = self._grant()
+        get_active_grant(self.doctor.id, self.patient.id)
+        self.assertIsNotNone(cache.get(key))
+
+        access.is_verified = False
+        access.save()
+        self.assertIsNone(cache.get(key))
+
+        access.is_verified = True
+        access.save()
+        get_active_grant(self.doctor.id, self.patient.id)
+        self.assertIsNotNone(cache.get(key))
+
+        access.delete()
+        self.assertIsNone(cache.get(key))
+
+    def test_unverified_and_expired_grants_are_refused(self):
+        access = self._grant(is_verified=False)
+        self.assertIsNone(get_active_grant(self.doctor.id, self.patient.id))
+        access.is_verified = True
+        access.save()
+        self.assertIsNotNone(get_active_grant(self.doctor.id, self.patient.id))
+
+        # a cached grant is not honoured past its expires_at
+        PatientAccess.objects.filter(id=access.id).update(expires_at=timezone.now())
+        clear_local_grants()
+        cache.set(f"access:grant:{self.doctor.id}:{self.patient.id}",
+                  {"id": access.id, "expires_at": timezone.now() - datetime.timedelta(seconds=1)})
+        self.assertIsNone(get_active_grant(self.doctor.id, self.patient.id))
+
+    def test_can_read_patient(self):
+        doctor_user, patient_user = self.doctor.user, self.patient.user
+        self.assertFalse(can_read_patient(doctor_user, self.patient.id))
+        self.assertTrue(can_read_patient(patient_user, self.patient.id))
+        self._grant()
+        self.assertTrue(can_read_patient(doctor_user, self.patient.id))
+
+    def test_protected_view_redirects_without_grant(self):
+        self.client.login(username="drbob", password="pw")
+        url = f"/doctor/patient/{self.patient.id}/fhir-records/"
+        self.assertRedirects(self.client.get(url), "/doctor/dashboard/", fetch_redirect_response=False)
+
+        self._grant()
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class PurgeExpiredAccessTests(AccessTestCase):
+    def test_purge_deletes_old_grants_in_batches_and_audits_verified_ones(self):
+        now = timezone.now()
+        self._grant(expires_at=now - datetime.timedelta(days=3))
+        self._grant(expires_at=now - datetime.timedelta(days=2), is_verified=False)
+        recent = self._grant(expires_at=now - datetime.timedelta(hours=1))
+        live = self._grant()
+
+        out = StringIO()
+        call_command("purge_expired_access", "--batch-size=1", "--pause=0", stdout=out)
 
-# Create your tests here.
+        self.assertIn("Purged 2 expired grant(s) (1 audited) in 2 batch(es)", out.getvalue())
+        self.assertEqual(set(PatientAccess.objects.values_list("id", flat=True)), {recent.id, live.id})
+        self.assertTrue(AuditLog.objects.get().action.startswith("Access grant expired"))
@@ -132,6 +132,46 @@ FILE_UPLOAD_MAX_MEMORY_SIZE = 10485760
 DEFAULT_FILE_STORAGE = "cloudinary_storage.storage.MediaCloudinaryStorage"
 
 
+# Caches
+# "fhir" holds per-patient DocumentReference bundles (fhir/cache.py).
+# LocMem is per process; point it at a shared backend (e.g. Redis)
+# when running several workers so invalidations reach all of them.
+CACHES = {
+    # Holds access grants (access_control.grants), which are revoked by
+    # deleting their key here, so with more than one worker process this
+    # must be a shared backend (Redis, Memcached).
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "fhir": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "fhir-bundles",
+        "TIMEOUT": int(os.environ.get("FHIR_BUNDLE_CACHE_TTL", 300)),
+        "OPTIONS": {"MAX_ENTRIES": int(os.environ.get("FHIR_BUNDLE_CACHE_SIZE", 1000))},
+    },
+    # Rendered doctor dashboard fragments (doctor_app.dashboard_cache).
+    # Invalidation bumps a version counter in this cache, so with more
+    # than one worker process it must be a shared backend (Redis, Memcached).
+    "dashboard": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "doctor-dashboards",
+        "OPTIONS": {"MAX_ENTRIES": int(os.environ.get("DASHBOARD_CACHE_SIZE", 5000))},
+    },
+}
+
+# Upper bound on how long a cached dashboard fragment is served (seconds)
+DASHBOARD_CACHE_TTL = int(os.environ.get("DASHBOARD_CACHE_TTL", 600))
+
+# Active access grants (access_control.grants) are cached in the default
+# cache until they expire; each worker also keeps them in memory for at
+# most ACCESS_GRANT_LOCAL_TTL seconds. With a shared default cache that
+# bounds how long a revoked grant can still be honoured by another
+# process; with the per-process LocMemCache it lasts until the grant's
+# expires_at.
+ACCESS_GRANT_LOCAL_TTL = float(os.environ.get("ACCESS_GRANT_LOCAL_TTL", 5))
+ACCESS_GRANT_LOCAL_SIZE = int(os.environ.get("ACCESS_GRANT_LOCAL_SIZE", 10000))
+
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -326,4 +366,52 @@ EMAIL_TIMEOUT = 30
 # ======================================================
 # 🏥 FHIR SERVER CONFIG
 # ======================================================
-FHIR_SERVER_URL = os.environ.get('FHIR_SERVER_URL', 'http://localhost:8080/fhir')
\ No newline at end of file
+FHIR_SERVER_URL = os.environ.get('FHIR_SERVER_URL', 'http://localhost:8080/fhir')
+
+# "local" = fhir/store.py on disk | "hapi" = FHIR_SERVER_URL
+# (switchable at runtime with fhir.backends.set_backend)
+FHIR_BACKEND = os.environ.get('FHIR_BACKEND', 'local')
+
+# HAPI circuit breaker: open after this many consecutive failures,
+# then probe again after FHIR_BREAKER_RESET_SECONDS
+FHIR_BREAKER_FAILURES = int(os.environ.get('FHIR_BREAKER_FAILURES', 5))
+FHIR_BREAKER_RESET_SECONDS = float(os.environ.get('FHIR_BREAKER_RESET_SECONDS', 30))
+
+# Largest page a FHIR search may return (?_count is capped to this)
+FHIR_MAX_PAGE_SIZE = int(os.environ.get('FHIR_MAX_PAGE_SIZE', 200))
+
+# Pooled HTTP client for the FHIR server (fhir/client.py)
+FHIR_HTTP_POOL_SIZE = int(os.environ.get('FHIR_HTTP_POOL_SIZE', 10))
+FHIR_HTTP_MAX_RETRIES = int(os.environ.get('FHIR_HTTP_MAX_RETRIES', 3))
+FHIR_HTTP_BACKOFF = float(os.environ.get('FHIR_HTTP_BACKOFF', 0.3))
+
+# Concurrent DocumentReference fetches for dashboards
+FHIR_FANOUT_WORKERS = int(os.environ.get('FHIR_FANOUT_WORKERS', 8))
+FHIR_FANOUT_DEADLINE = float(os.environ.get('FHIR_FANOUT_DEADLINE', 6))
+
+# Local FHIR document store engine (used when FHIR_BACKEND = "local")
+# "sqlite" = single indexed sqlite file | "json" = legacy index.json layout
+# "segment" = sharded packed segment files read via mmap. Opt in only
+# after copying the existing tree across with
+# `manage.py migrate_fhir_local --source sqlite --target segment`:
+# each engine reads only its own files.
+FHIR_LOCAL_STORE = os.environ.get('FHIR_LOCAL_STORE', 'sqlite')
+
+# Bulk Data $export (written by `manage.py run_fhir_exports`, never served from MEDIA)
+FHIR_EXPORT_DIR = os.environ.get('FHIR_EXPORT_DIR', str(BASE_DIR / 'fhir_exports'))
+FHIR_EXPORT_PART_SIZE = int(os.environ.get('FHIR_EXPORT_PART_SIZE', 10000))
+FHIR_EXPORT_STALE_SECONDS = int(os.environ.get('FHIR_EXPORT_STALE_SECONDS', 300))
+
+# Largest batch/transaction Bundle accepted by POST /fhir/
+FHIR_BUNDLE_MAX_ENTRIES = int(os.environ.get('FHIR_BUNDLE_MAX_ENTRIES', 20000))
+
+# _sort=_lastUpdated change feed: rows younger than this (seconds) are held
+# back until concurrent write transactions have committed
+FHIR_CHANGE_FEED_LAG = int(os.environ.get('FHIR_CHANGE_FEED_LAG', 5))
+
+# Decoded inline attachments (fhir/attachments.py), LRU-evicted past this size
+FHIR_ATTACHMENT_CACHE_BYTES = int(os.environ.get('FHIR_ATTACHMENT_CACHE_BYTES', 512 * 1024 * 1024))
+
+# Outbox for remote FHIR writes (fhir/outbox.py, manage.py run_fhir_outbox)
+FHIR_OUTBOX_BATCH_SIZE = int(os.environ.get('FHIR_OUTBOX_BATCH_SIZE', 50))
+FHIR_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('FHIR_OUTBOX_MAX_ATTEMPTS', 8))
@@ -0,0 +1,130 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+
+from access_control.grants import active_grants
+
+from .models import Doctor
+
+# ============================================================
+# Doctor dashboard cache
+# Rendered section fragments (and the page's counts) are cached
+# per doctor user under a version counter:
+#   dashboard:v:<user_id>                      -> version
+#   dashboard:<user_id>:<version>:<fragment>   -> cached value
+# Saving a Report / Prescription / Encounter / PatientAccess bumps
+# the counter of every doctor whose dashboard shows the row (see
+# doctor_app.signals), so old entries are never read again and
+# simply age out. An unchanged dashboard is served from the cache
+# without touching the database.
+#
+# Grants expire without a write, so an entry never outlives the
+# doctor's next grant expiry (next_grant_expiry on the Doctor row).
+# ============================================================
+DASHBOARD_CACHE_ALIAS = "dashboard"
+
+
+def _cache():
+    return caches[DASHBOARD_CACHE_ALIAS]
+
+
+def _version_key(user_id):
+    return f"dashboard:v:{user_id}"
+
+
+def dashboard_version(user_id):
+    cache = _cache()
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        # start from a number no evicted counter can have handed out
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def fragment_key(user_id, fragment):
+    """
+    Cache key for `fragment` at the doctor's current version. Taken
+    before rendering, so a bump while rendering leaves the result
+    under a key nobody reads.
+    """
+    digest = hashlib.md5(fragment.encode()).hexdigest()
+    return f"dashboard:{user_id}:{dashboard_version(user_id)}:{digest}"
+
+
+def get_fragment(key):
+    return _cache().get(key)
+
+
+def set_fragment(key, value, doctor):
+    timeout = settings.DASHBOARD_CACHE_TTL
+    if doctor.next_grant_expiry is not None:
+        remaining = (doctor.next_grant_expiry - timezone.now()).total_seconds()
+        timeout = min(timeout, max(int(remaining), 0))
+    if timeout > 0:
+        _cache().set(key, value, timeout)
+
+
+def dashboard_doctor():
+    """Doctor queryset carrying what set_fragment needs (one query)."""
+    next_expiry = active_grants().filter(
+        doctor=OuterRef("pk")
+    ).order_by("expires_at").values("expires_at")[:1]
+
+    return Doctor.objects.select_related("hospital").annotate(
+        next_grant_expiry=Subquery(next_expiry)
+    )
+
+
+# ---------- invalidation ----------
+
+def bump_users(user_ids):
+    cache = _cache()
+    for user_id in set(user_ids):
+        if user_id is None:
+            continue
+        try:
+            cache.incr(_version_key(user_id))
+        except ValueError:
+            pass    # no counter yet: nothing cached under it
+
+
+def _bump_on_commit(user_ids):
+    user_ids = list(user_ids)
+    if user_ids:
+        transaction.on_commit(lambda: bump_users(user_ids))
+
+
+def bump_doctors(doctor_ids):
+    """Invalidate the dashboards of these doctors once the transaction commits."""
+    doctor_ids = {d for d in doctor_ids if d}
+    if doctor_ids:
+        _bump_on_commit(
+            Doctor.objects.filter(id__in=doctor_ids).values_list("user_id", flat=True)
+        )
+
+
+def bump_patient(patient_id, doctor_ids=()):
+    """
+    Invalidate the dashboards showing this patient's records: every
+    doctor with a live verified grant on the patient, plus `doctor_ids`.
+    """
+    doctor_ids = {d for d in doctor_ids if d}
+    if not patient_id:
+        return bump_doctors(doctor_ids)
+
+    granted = Q(
+        patientaccess__patient_id=patient_id,
+        patientaccess__is_verified=True,
+        patientaccess__expires_at__gt=timezone.now()
+    )
+    _bump_on_commit(
+        Doctor.objects.filter(granted | Q(id__in=doctor_ids))
+        .values_list("user_id", flat=True).distinct()
+    )
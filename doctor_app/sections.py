@@ -0,0 +1,158 @@
+from django.core import signing
+from django.db.models import OuterRef, Q, Subquery
+from django.utils.dateparse import parse_datetime
+
+from access_control.grants import active_grants
+from access_control.models import PatientAccess
+from fhir.documents import authored_documents
+from fhir.utils import get_document_references_many
+from patients.models import Patient
+from records.models import Encounter, Prescription, Report
+
+# ============================================================
+# Doctor dashboard sections
+# Each section is served as an HTML fragment by
+# doctor_app:dashboard_section, newest first, DASHBOARD_PAGE_SIZE
+# rows at a time. The signed ?cursor= holds the last row's sort
+# key, so every page is one indexed range query with its related
+# rows joined in - the query count per page never grows with the
+# doctor's history.
+# ============================================================
+DASHBOARD_PAGE_SIZE = 20
+CURSOR_SALT = "doctor_app.dashboard"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _sign(data):
+    return signing.dumps(data, salt=CURSOR_SALT)
+
+
+def _unsign(cursor):
+    try:
+        return signing.loads(cursor, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        raise InvalidCursor("Invalid or tampered cursor")
+
+
+def _cursor_id(cursor):
+    try:
+        return int(_unsign(cursor)["k"])
+    except (KeyError, TypeError, ValueError):
+        raise InvalidCursor("Invalid or tampered cursor")
+
+
+def _trim(rows, size):
+    """(page rows, has more) from a query that read size + 1 rows."""
+    return rows[:size], len(rows) > size
+
+
+def verified_patient_ids(doctor):
+    """Subquery of patients this doctor holds a live, verified grant for."""
+    return active_grants().filter(doctor=doctor).values("patient_id")
+
+
+# ---------- sections ----------
+
+def appointments_page(doctor, cursor=None, size=DASHBOARD_PAGE_SIZE):
+    """The doctor's encounters by (started_at, id), newest first."""
+    latest_access = PatientAccess.objects.filter(
+        doctor=doctor, patient=OuterRef("patient_id")
+    ).order_by("-id")
+
+    queryset = Encounter.objects.filter(doctor=doctor).select_related("patient__user").annotate(
+        access_id=Subquery(latest_access.values("id")[:1]),
+        access_verified=Subquery(latest_access.values("is_verified")[:1]),
+    )
+
+    if cursor:
+        data = _unsign(cursor)
+        try:
+            started_at, pk = parse_datetime(data["t"]), int(data["k"])
+        except (KeyError, TypeError, ValueError):
+            raise InvalidCursor("Invalid or tampered cursor")
+        if started_at is None:
+            raise InvalidCursor("Invalid or tampered cursor")
+        queryset = queryset.filter(Q(started_at__lt=started_at) | Q(started_at=started_at, id__lt=pk))
+
+    rows, more = _trim(list(queryset.order_by("-started_at", "-id")[:size + 1]), size)
+    next_cursor = _sign({"t": rows[-1].started_at.isoformat(), "k": rows[-1].id}) if more else None
+    return rows, next_cursor
+
+
+def reports_page(doctor, cursor=None, size=DASHBOARD_PAGE_SIZE):
+    """Reports of verified patients, newest first."""
+    queryset = Report.objects.filter(
+        patient_id__in=verified_patient_ids(doctor)
+    ).select_related("patient__user")
+
+    if cursor:
+        queryset = queryset.filter(id__lt=_cursor_id(cursor))
+
+    rows, more = _trim(list(queryset.order_by("-id")[:size + 1]), size)
+    return rows, _sign({"k": rows[-1].id}) if more else None
+
+
+def prescriptions_page(doctor, cursor=None, size=DASHBOARD_PAGE_SIZE):
+    """Prescriptions from verified patients' encounters, newest first."""
+    queryset = Prescription.objects.filter(
+        encounter__patient_id__in=verified_patient_ids(doctor)
+    ).select_related("encounter__patient__user")
+
+    if cursor:
+        queryset = queryset.filter(id__lt=_cursor_id(cursor))
+
+    rows, more = _trim(list(queryset.order_by("-id")[:size + 1]), size)
+    return rows, _sign({"k": rows[-1].id}) if more else None
+
+
+def fhir_documents_page(doctor, cursor=None, size=DASHBOARD_PAGE_SIZE):
+    """
+    FHIR documents this doctor uploaded for verified patients, newest
+    first, grouped per patient: [{"patient", "reports": [entries]}].
+    Paged over the upload-time DocumentIndex; only the bundles of
+    patients on this page are fetched.
+    """
+    fhir_ids = Patient.objects.filter(
+        id__in=verified_patient_ids(doctor), fhir_patient_id__isnull=False
+    ).values("fhir_patient_id")
+
+    queryset = authored_documents(doctor, fhir_ids)
+    if cursor:
+        queryset = queryset.filter(id__lt=_cursor_id(cursor))
+
+    index_rows, more = _trim(
+        list(queryset.order_by("-id").values_list("id", "patient_fhir_id", "doc_id")[:size + 1]),
+        size
+    )
+    next_cursor = _sign({"k": index_rows[-1][0]}) if more else None
+
+    page_fhir_ids = list(dict.fromkeys(pid for _, pid, _ in index_rows))
+    patients = {
+        p.fhir_patient_id: p
+        for p in Patient.objects.filter(fhir_patient_id__in=page_fhir_ids).select_related("user")
+    }
+    bundles = get_document_references_many(page_fhir_ids)
+
+    entries = {
+        pid: {e.get("resource", {}).get("id"): e for e in (bundle or {}).get("entry", [])}
+        for pid, bundle in bundles.items()
+    }
+
+    groups = {}
+    for _, pid, doc_id in index_rows:
+        entry = entries.get(pid, {}).get(doc_id)
+        if entry and pid in patients:
+            groups.setdefault(pid, {"patient": patients[pid], "reports": []})["reports"].append(entry)
+
+    return list(groups.values()), next_cursor
+
+
+SECTIONS = {
+    "appointments": appointments_page,
+    "reports": reports_page,
+    "prescriptions": prescriptions_page,
+    "fhir-documents": fhir_documents_page,
+}
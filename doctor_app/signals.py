@@ -0,0 +1,39 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from access_control.models import PatientAccess
+from records.models import Encounter, Prescription, Report
+
+from .dashboard_cache import bump_doctors, bump_patient
+from .models import Doctor
+
+
+@receiver([post_save, post_delete], sender=Report)
+def invalidate_report_dashboards(sender, instance, **kwargs):
+    bump_patient(instance.patient_id, [instance.doctor_id])
+
+
+@receiver([post_save, post_delete], sender=Prescription)
+def invalidate_prescription_dashboards(sender, instance, **kwargs):
+    patient_id = instance.patient_id
+    if patient_id is None and instance.encounter_id:
+        patient_id = Encounter.objects.filter(id=instance.encounter_id).values_list(
+            "patient_id", flat=True
+        ).first()
+    bump_patient(patient_id, [instance.doctor_id])
+
+
+@receiver([post_save, post_delete], sender=Encounter)
+def invalidate_encounter_dashboards(sender, instance, **kwargs):
+    # encounters decide which prescriptions a patient's doctors see
+    bump_patient(instance.patient_id, [instance.doctor_id])
+
+
+@receiver([post_save, post_delete], sender=PatientAccess)
+def invalidate_access_dashboards(sender, instance, **kwargs):
+    bump_doctors([instance.doctor_id])
+
+
+@receiver(post_save, sender=Doctor)
+def invalidate_doctor_dashboard(sender, instance, **kwargs):
+    bump_doctors([instance.id])
@@ -1,3 +1,79 @@
+import datetime
+import re
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
 from django.test import TestCase
+from django.utils import timezone
+
+from access_control.models import PatientAccess
+from hospital_app.models import Hospital
+from patients.models import Patient
+from records.models import Encounter, Report
+
+from .dashboard_cache import DASHBOARD_CACHE_ALIAS, fragment_key
+from .models import Doctor
+from .sections import DASHBOARD_PAGE_SIZE
+
+
+class DashboardSectionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        hospital = Hospital.objects.create(name="H", location="L", email="h@example.com", phone="1")
+        user = User.objects.create_user("drbob", password="pw")
+        cls.doctor = Doctor.objects.create(user=user, hospital=hospital, specialization="x",
+                                           contact_number="1", qualification="MBBS")
+        patient = Patient.objects.create(user=User.objects.create_user("pat", password="pw"))
+        PatientAccess.objects.create(doctor=cls.doctor, patient=patient, otp="123456", is_verified=True,
+                                     expires_at=timezone.now() + datetime.timedelta(hours=1))
+
+        for i in range(DASHBOARD_PAGE_SIZE + 5):
+            Encounter.objects.create(patient=patient, doctor=cls.doctor, reason=f"Visit {i}",
+                                     started_at=timezone.now() - datetime.timedelta(days=i))
+            Report.objects.create(patient=patient, title=f"Report {i}")
+
+    def setUp(self):
+        caches[DASHBOARD_CACHE_ALIAS].clear()
+        self.client.login(username="drbob", password="pw")
+
+    def _pages(self, section):
+        url, pages = f"/doctor/dashboard/section/{section}/", []
+        while url:
+            with self.assertNumQueries(4):   # session, user, doctor, page
+                response = self.client.get(url)
+            html = response.content.decode()
+            pages.append(html.count("patient-name"))
+            match = re.search(r'data-url="([^"]+)"', html)
+            url = match.group(1) if match else None
+        return pages
+
+    def test_sections_are_keyset_paged(self):
+        self.assertEqual(self._pages("appointments"), [DASHBOARD_PAGE_SIZE, 5])
+        self.assertEqual(self._pages("reports"), [DASHBOARD_PAGE_SIZE, 5])
+
+    def test_bad_cursor_and_section(self):
+        self.assertEqual(self.client.get("/doctor/dashboard/section/reports/?cursor=x").status_code, 400)
+        self.assertEqual(self.client.get("/doctor/dashboard/section/billing/").status_code, 404)
+
+    def test_unchanged_dashboard_is_served_from_cache(self):
+        url = "/doctor/dashboard/section/reports/"
+        first = self.client.get(url).content
+        with self.assertNumQueries(2):   # session, user
+            self.assertEqual(self.client.get(url).content, first)
+        self.client.get("/doctor/dashboard/")
+        with self.assertNumQueries(3):   # session, user, doctor
+            self.assertContains(self.client.get("/doctor/dashboard/"), "drbob")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Report.objects.create(patient=Patient.objects.get(), title="Fresh report")
+        self.assertIn(b"Fresh report", self.client.get(url).content)
+
+    def test_dashboard_caches_counts_not_the_doctor(self):
+        self.client.get("/doctor/dashboard/")
+        self.assertEqual(
+            set(caches[DASHBOARD_CACHE_ALIAS].get(fragment_key(self.doctor.user_id, "counts"))),
+            {"appointment_count", "report_count", "prescription_count"}
+        )
 
-# Create your tests here.
+        Doctor.objects.filter(id=self.doctor.id).update(specialization="Cardiology")
+        self.assertContains(self.client.get("/doctor/dashboard/"), "Cardiology")
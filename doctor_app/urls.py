@@ -5,6 +5,7 @@ app_name = "doctor_app"
 
 urlpatterns = [
     path("dashboard/", views.doctor_dashboard, name="doctor_dashboard"),
+    path("dashboard/section/<str:section>/", views.dashboard_section, name="dashboard_section"),
     path("report/<int:report_id>/explain/", views.explain_report, name="explain_report"),
 
     path("patient/<int:patient_id>/request-access/", views.request_patient_access, name="request_patient_access"),
@@ -4,8 +4,11 @@ import sendgrid
 import cloudinary.uploader
 from sendgrid.helpers.mail import Mail
 from datetime import timedelta
+from urllib.parse import urlencode
 
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.utils import timezone
@@ -13,13 +16,17 @@ from django.core.mail import send_mail
 from django.conf import settings
 
 from .models import Doctor
+from .dashboard_cache import dashboard_doctor, fragment_key, get_fragment, set_fragment
+from .sections import SECTIONS, InvalidCursor, verified_patient_ids
 from records.models import Encounter, Report, Prescription
 from patients.models import Patient
+from access_control.grants import grant_required
 from access_control.models import PatientAccess
 
+from fhir.models import OutboxEntry
+from fhir.outbox import submit_document_reference
 from fhir.utils import (
     get_document_references,
-    upload_document_reference,
     check_patient_exists,
     create_fhir_patient
 )
@@ -31,100 +38,67 @@ from fhir.utils import (
 @login_required
 def doctor_dashboard(request):
 
+    # The doctor is loaded on every request; the counts come from the
+    # dashboard cache while nothing the doctor can see has changed.
+    # Section rows are loaded lazily from dashboard_section.
     try:
-        doctor = get_object_or_404(Doctor, user=request.user)
+        doctor = get_object_or_404(dashboard_doctor().select_related("user"), user=request.user)
     except Doctor.DoesNotExist:
         messages.error(request, "No Doctor profile found.")
         return redirect("login")
 
-    # appointments
-    appointments = Encounter.objects.filter(
-        doctor=doctor
-    ).order_by("-started_at")
+    key = fragment_key(request.user.id, "counts")
+    counts = get_fragment(key)
 
-    # verified patients
-    verified_patients = PatientAccess.objects.filter(
-        doctor=doctor,
-        is_verified=True,
-        expires_at__gt=timezone.now()
-    ).values_list("patient_id", flat=True)
-
-    # reports
-    reports = Report.objects.select_related("patient").filter(
-        patient_id__in=verified_patients
-    )
-
-    # prescriptions
-    prescriptions = Prescription.objects.filter(
-        encounter__patient_id__in=verified_patients
-    )
-
-    # ALL PATIENTS (for dashboard list)
-    # patients doctor does NOT yet have access to
-    patients = Patient.objects.filter(id__in=verified_patients)
-    all_patients = Patient.objects.all()
-    
-
-    # ========================================================
-    # FHIR REPORT FETCH
-    # ========================================================
-    fhir_reports = []
-
-    for p in patients:
-
-        if not p.fhir_patient_id:
-            continue
+    if counts is None:
+        verified_patients = verified_patient_ids(doctor)
+        counts = {
+            "appointment_count": Encounter.objects.filter(doctor=doctor).count(),
+            "report_count": Report.objects.filter(patient_id__in=verified_patients).count(),
+            "prescription_count": Prescription.objects.filter(
+                encounter__patient_id__in=verified_patients
+            ).count(),
+        }
+        set_fragment(key, counts, doctor)
 
-        try:
-            data = get_document_references(p.fhir_patient_id)
-
-            if not data or "entry" not in data:
-                continue
-
-            filtered_entries = []
-
-            for entry in data["entry"]:
-
-                resource = entry.get("resource", {})
-                description = resource.get("description", "")
-                authors = resource.get("author", [])
+    return render(request, "doctor_app/dashboard.html", dict(
+        counts, doctor=doctor, current_time=timezone.now()
+    ))
 
-                is_current_doctor_report = False
 
-                for author in authors:
-                    display = author.get("display", "")
-
-                    if doctor.user.username in display or doctor.user.get_full_name() in display:
-                        is_current_doctor_report = True
-                        break
+# ============================================================
+# DASHBOARD SECTION (HTML fragment, keyset paged)
+# ============================================================
+@login_required
+def dashboard_section(request, section):
 
-                if not is_current_doctor_report:
-                    if doctor.user.username.lower() in description.lower():
-                        is_current_doctor_report = True
+    page = SECTIONS.get(section)
+    if page is None:
+        raise Http404("Unknown dashboard section")
 
-                if is_current_doctor_report:
-                    filtered_entries.append(entry)
+    cursor = request.GET.get("cursor")
+    key = fragment_key(request.user.id, f"{section}:{cursor or ''}")
+    html = get_fragment(key)
+    if html is not None:
+        return HttpResponse(html)
 
-            if filtered_entries:
-                fhir_reports.append({
-                    "patient": p,
-                    "reports": filtered_entries
-                })
+    doctor = get_object_or_404(dashboard_doctor(), user=request.user)
+    try:
+        rows, next_cursor = page(doctor, cursor)
+    except InvalidCursor as e:
+        return HttpResponseBadRequest(str(e))
 
-        except Exception as e:
-            print(f"[FHIR ERROR] {e}")
-            continue
+    next_url = None
+    if next_cursor:
+        next_url = f"{request.path}?{urlencode({'cursor': next_cursor})}"
 
-    return render(request, "doctor_app/dashboard.html", {
-        "doctor": doctor,
-        "appointments": appointments,
-        "reports": reports,
-        "prescriptions": prescriptions,
-        "fhir_reports": fhir_reports,
-        "patients": patients,
-        "all_patients": all_patients,
-        "current_time": timezone.now(),
-    })
+    html = render_to_string(f"doctor_app/sections/{section}.html", {
+        "rows": rows,
+        "first_page": cursor is None,
+        "next_url": next_url,
+    }, request=request)
+    set_fragment(key, html, doctor)
+    return HttpResponse(html)
 
 
 # ============================================================
@@ -228,24 +202,15 @@ def verify_patient_otp(request, access_id):
 # VIEW FHIR RECORDS
 # ============================================================
 @login_required
+@grant_required
 def view_patient_fhir_records(request, patient_id):
 
-    doctor = get_object_or_404(Doctor, user=request.user)
-
-    access = PatientAccess.objects.filter(
-        doctor=doctor,
-        patient_id=patient_id,
-        is_verified=True,
-        expires_at__gt=timezone.now()
-    ).first()
-
-    if not access:
-        messages.error(request, "OTP verification required.")
-        return redirect("doctor_app:doctor_dashboard")
+    doctor = request.doctor
 
     patient = get_object_or_404(Patient, id=patient_id)
 
     fhir_data = None
+    outbox_entries = []
 
     if patient.fhir_patient_id:
         try:
@@ -254,6 +219,12 @@ def view_patient_fhir_records(request, patient_id):
             print(f"[FHIR ERROR] {e}")
             messages.error(request, "FHIR fetch failed.")
 
+        # Uploads still waiting for (or recently through) the outbox
+        outbox_entries = OutboxEntry.objects.filter(
+            patient_fhir_id=patient.fhir_patient_id,
+            created_at__gte=timezone.now() - timedelta(days=1)
+        ).exclude(status="synced", synced_at__lt=timezone.now() - timedelta(hours=1)).order_by("-created_at")[:20]
+
     qualifications = [q.strip() for q in doctor.qualification.split(",") if q.strip()] if doctor.qualification else []
 
     return render(request, "doctor_app/fhir_records.html", {
@@ -262,26 +233,17 @@ def view_patient_fhir_records(request, patient_id):
         "doctor": doctor,
         "current_time": timezone.now(),
         "qualifications": qualifications,
+        "outbox_entries": outbox_entries,
     })
 
 # ============================================================
 # UPLOAD REPORT TO FHIR
 # ============================================================
 @login_required
+@grant_required
 def upload_patient_report_to_fhir(request, patient_id):
 
-    doctor = get_object_or_404(Doctor, user=request.user)
-
-    access = PatientAccess.objects.filter(
-        doctor=doctor,
-        patient_id=patient_id,
-        is_verified=True,
-        expires_at__gt=timezone.now()
-    ).first()
-
-    if not access:
-        messages.error(request, "OTP verification required.")
-        return redirect("doctor_app:doctor_dashboard")
+    doctor = request.doctor
 
     patient = get_object_or_404(Patient, id=patient_id)
 
@@ -326,14 +288,19 @@ def upload_patient_report_to_fhir(request, patient_id):
 
         description_text = f"Report uploaded by Dr. {doctor.user.username}"
 
-        status, text = upload_document_reference(
+        # The file itself is already durable on Cloudinary; the FHIR
+        # write goes through the outbox when a FHIR server is used.
+        status, text = submit_document_reference(
             patient.fhir_patient_id,
             file_url,
-            description_text
+            description_text,
+            author=doctor
         )
 
         if status in [200, 201]:
             messages.success(request, "Report uploaded successfully!")
+        elif status == 202:
+            messages.success(request, "Report uploaded; it will appear in the records once synced.")
         else:
             messages.error(request, f"FHIR upload failed: {text}")
 
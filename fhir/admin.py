@@ -1,3 +1,24 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import ExportJob, OutboxEntry
+from .outbox import retry_failed
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "requested_by", "resource_types", "status", "created_at", "completed_at")
+    list_filter = ("status",)
+    readonly_fields = ("progress", "error", "created_at", "updated_at", "completed_at")
+
+
+@admin.register(OutboxEntry)
+class OutboxEntryAdmin(admin.ModelAdmin):
+    list_display = ("idempotency_key", "resource_type", "patient_fhir_id", "status", "attempts", "next_attempt_at", "synced_at")
+    list_filter = ("status", "resource_type")
+    search_fields = ("patient_fhir_id", "remote_id")
+    readonly_fields = ("idempotency_key", "resource", "remote_id", "last_error", "created_at", "synced_at", "claimed_at")
+    actions = ("retry",)
+
+    @admin.action(description="Retry failed rows")
+    def retry(self, request, queryset):
+        retry_failed(queryset)
@@ -0,0 +1,176 @@
+import base64
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+# ============================================================
+# Decoded-attachment cache for inline (base64) attachments
+# Each attachment is decoded once to
+#   MEDIA_ROOT/fhir_downloads/<aa>/<key><ext>
+# keyed by the resource version it came from
+# (DocumentReference/<id>/_history/<versionId>), which names
+# immutable content, so different documents with the same title
+# never collide and a hit hashes a few bytes however large the
+# data is. Attachments without a version fall back to a SHA-256
+# of the encoded data. The key is always computed here - a
+# client-supplied attachment.hash is only checked against the
+# decoded bytes, never trusted as a key. A hit is a single
+# stat() - no decode, no write.
+# mtime doubles as the LRU clock; once the
+# cache grows past FHIR_ATTACHMENT_CACHE_BYTES the least recently
+# used files are evicted.
+# ============================================================
+ATTACHMENT_CACHE_DIR = "fhir_downloads"
+
+# 4 base64 chars -> 3 bytes, so decode slices must be a multiple of 4
+B64_DECODE_CHUNK = 4 * 256 * 1024  # 1 MB encoded -> 768 KB raw
+
+# Refresh a hit's mtime at most this often (keeps hits to a stat())
+LRU_TOUCH_INTERVAL = 3600
+
+# Evict down to this fraction of the limit, so evictions are batched
+EVICT_TO = 0.9
+
+
+class AttachmentCache:
+
+    def __init__(self, base_dir=None, url_prefix=None, max_bytes=None):
+        self.base_dir = base_dir or os.path.join(settings.MEDIA_ROOT, ATTACHMENT_CACHE_DIR)
+        self.url_prefix = url_prefix or settings.MEDIA_URL + ATTACHMENT_CACHE_DIR + "/"
+        self.max_bytes = max_bytes or settings.FHIR_ATTACHMENT_CACHE_BYTES
+        self._lock = threading.Lock()
+        self._size = None   # this process's running estimate of the cache size
+
+    @staticmethod
+    def cache_key(attachment, version=None):
+        """SHA-256 of the resource version, else of the encoded data."""
+        # ":" is not a base64 character, so the two never share a key
+        source = f"version:{version}" if version else attachment["data"]
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _extension(attachment):
+        ext = os.path.splitext(attachment.get("title") or "")[1].lower()
+        return ext if ext[1:].isalnum() and len(ext) <= 10 else ""
+
+    def _relative_path(self, key, ext):
+        shard = key[-2:]
+        return f"{shard}/{key}{ext}"
+
+    def get_or_decode(self, attachment, version=None):
+        """
+        Return the cached file URL, decoding the data on a miss.
+        `version` names the content, e.g. "DocumentReference/7/_history/2".
+        """
+        key = self.cache_key(attachment, version)
+        relative_path = self._relative_path(key, self._extension(attachment))
+        path = os.path.join(self.base_dir, relative_path)
+
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._decode_to(attachment["data"], path, attachment.get("hash"))
+        else:
+            if time.time() - st.st_mtime > LRU_TOUCH_INTERVAL:
+                os.utime(path)
+
+        return self.url_prefix + relative_path
+
+    @staticmethod
+    def _decoded_chunks(encoded):
+        """
+        Decode base64 a slice at a time. Line breaks (allowed in FHIR
+        base64Binary, produced by base64.encodebytes) are dropped, and
+        characters past the last whole 4-char group carry over to the
+        next slice, so slices never split a group.
+        """
+        carry = ""
+        for start in range(0, len(encoded), B64_DECODE_CHUNK):
+            chunk = carry + "".join(encoded[start:start + B64_DECODE_CHUNK].split())
+            usable = len(chunk) - len(chunk) % 4
+            carry = chunk[usable:]
+            if usable:
+                yield base64.b64decode(chunk[:usable])
+        if carry:
+            # malformed tail; let b64decode raise on it
+            yield base64.b64decode(carry)
+
+    def _decode_to(self, encoded, path, expected_hash=None):
+        """
+        Stream-decode base64 into a temp file, then rename into place.
+        Raises ValueError when `expected_hash` (attachment.hash, base64
+        SHA-1) does not match the decoded data.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        sha1 = hashlib.sha1()
+        written = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in self._decoded_chunks(encoded):
+                    f.write(chunk)
+                    sha1.update(chunk)
+                    written += len(chunk)
+            if expected_hash and base64.b64decode(expected_hash) != sha1.digest():
+                raise ValueError("attachment.hash does not match the attachment data")
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self._added(written)
+
+    # ---------- LRU eviction ----------
+
+    def _scan(self):
+        files = []
+        for shard in os.scandir(self.base_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, entry.path))
+        return files
+
+    def _added(self, size):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._scan())
+            else:
+                self._size += size
+
+            if self._size > self.max_bytes:
+                self._size = self.evict()
+
+    def evict(self):
+        """Drop least recently used files until under the limit; returns the new size."""
+        files = sorted(self._scan())
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * EVICT_TO
+
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass    # another process evicted it first
+            total -= size
+        return total
+
+
+_attachment_cache = None
+_attachment_cache_lock = threading.Lock()
+
+
+def get_attachment_cache():
+    global _attachment_cache
+    with _attachment_cache_lock:
+        if _attachment_cache is None:
+            _attachment_cache = AttachmentCache()
+        return _attachment_cache
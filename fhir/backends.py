@@ -0,0 +1,170 @@
+import threading
+import time
+
+import requests
+from django.conf import settings
+
+# ============================================================
+# FHIR backend registry + circuit breaker
+# settings.FHIR_BACKEND picks "local" (fhir/store.py) or "hapi"
+# (settings.FHIR_SERVER_URL); set_backend() switches at runtime.
+#
+# Every HAPI call goes through one process-wide breaker:
+#   closed     calls go through; K consecutive failures open it
+#   open       calls fail fast with BackendUnavailable for
+#              FHIR_BREAKER_RESET_SECONDS, no network round-trip
+#   half-open  one probe call is let through; success closes the
+#              breaker, failure opens it again
+# While HAPI is unavailable, fhir.utils serves reads from the
+# local store instead.
+# ============================================================
+BACKENDS = ("local", "hapi")
+
+
+class BackendUnavailable(requests.ConnectionError):
+    """Raised instead of calling HAPI while the breaker is open."""
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+        # counters for metrics()
+        self.opened = 0
+        self.rejected = 0
+        self.probes = 0
+
+    def allow(self):
+        """May a call go through now? Moves open -> half-open when due."""
+        with self._lock:
+            if self.state == "closed":
+                return True
+
+            if self.state == "open" and self.clock() - self.opened_at >= self.reset_timeout:
+                self.state = "half-open"
+                self._probe_in_flight = False
+
+            if self.state == "half-open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                self.probes += 1
+                return True
+
+            self.rejected += 1
+            return False
+
+    def is_open(self):
+        """Open and not yet due for a probe (cheap check, no state change)."""
+        with self._lock:
+            return self.state == "open" and self.clock() - self.opened_at < self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.state = "closed"
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == "half-open" or (
+                self.state == "closed" and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.state = "open"
+                self.opened_at = self.clock()
+                self.opened += 1
+            self._probe_in_flight = False
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_seconds": self.reset_timeout,
+                "open_for_seconds": self.clock() - self.opened_at if self.state != "closed" else 0.0,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "probes": self.probes,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._probe_in_flight = False
+            self.opened = self.rejected = self.probes = 0
+
+
+_breaker = None
+_breaker_lock = threading.Lock()
+
+
+def get_breaker():
+    """Return the process-wide breaker for the HAPI server."""
+    global _breaker
+    with _breaker_lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker(
+                failure_threshold=getattr(settings, "FHIR_BREAKER_FAILURES", 5),
+                reset_timeout=getattr(settings, "FHIR_BREAKER_RESET_SECONDS", 30),
+            )
+        return _breaker
+
+
+# ---------- backend registry ----------
+
+_backend = None
+_fallbacks = {}
+_fallbacks_lock = threading.Lock()
+
+
+def get_backend():
+    return _backend or settings.FHIR_BACKEND
+
+
+def set_backend(name):
+    """Switch backends at runtime; None goes back to settings.FHIR_BACKEND."""
+    global _backend
+    if name is not None and name not in BACKENDS:
+        raise ValueError(f"Unknown FHIR backend {name!r}; choose from {', '.join(BACKENDS)}")
+    _backend = name
+
+
+def use_local_storage():
+    return get_backend() == "local"
+
+
+def reads_from_local():
+    """True when reads should skip HAPI: local backend, or breaker open."""
+    return use_local_storage() or get_breaker().is_open()
+
+
+def record_fallback(operation):
+    with _fallbacks_lock:
+        _fallbacks[operation] = _fallbacks.get(operation, 0) + 1
+
+
+def backend_metrics():
+    with _fallbacks_lock:
+        fallbacks = dict(_fallbacks)
+    return {
+        "backend": get_backend(),
+        "breaker": get_breaker().metrics(),
+        "local_fallbacks": fallbacks,
+    }
+
+
+def reset_metrics():
+    with _fallbacks_lock:
+        _fallbacks.clear()
+    get_breaker().reset()
@@ -0,0 +1,152 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from .store import SQLiteConnection
+
+# ============================================================
+# Content-addressed blob store for DocumentReference attachments
+# Files are stored once per SHA-256 under
+#   MEDIA_ROOT/fhir_blobs/<aa>/<bb>/<sha256>
+# and served through /fhir/Binary/<sha256>/
+#
+# Garbage collection is mark-and-sweep (manage.py gc_fhir_blobs):
+# blobs no stored DocumentReference points at are deleted once
+# they are older than a grace period. A blob's mtime is refreshed
+# whenever it is uploaded again, so an upload whose document has
+# not been written yet is never swept.
+# ============================================================
+LOCAL_BLOB_DIR = os.path.join(settings.MEDIA_ROOT, "fhir_blobs")
+
+CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+# Unreferenced blobs younger than this are kept (upload in flight)
+SWEEP_GRACE_SECONDS = 24 * 3600
+
+BINARY_URL_DIGEST = re.compile(r"/fhir/Binary/([0-9a-f]{64})/?$")
+
+
+class BlobStore:
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blob (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            content_type TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, base_dir=LOCAL_BLOB_DIR):
+        self.base_dir = base_dir
+        self._db = SQLiteConnection(os.path.join(base_dir, "blobs.sqlite3"), self.SCHEMA)
+
+    def path_for(self, digest):
+        """Sharded on-disk path for a digest."""
+        return os.path.join(self.base_dir, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    @staticmethod
+    def hash_file(file_path):
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def _copy_in(self, file_path, dest_path):
+        """Stream file_path to dest_path via a temp file + atomic rename."""
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        tmp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(file_path, "rb") as src, open(tmp_path, "wb") as dst:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                    dst.write(chunk)
+            os.replace(tmp_path, dest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def put_file(self, file_path, content_type="application/octet-stream"):
+        """
+        Add a file to the store. Re-uploading identical bytes only
+        hashes the source: no copy, no extra disk space.
+        Returns the SHA-256 hex digest.
+        """
+        digest = self.hash_file(file_path)
+        dest_path = self.path_for(digest)
+
+        if os.path.exists(dest_path):
+            os.utime(dest_path)     # restarts the sweep grace period
+        else:
+            self._copy_in(file_path, dest_path)
+
+        self._db.get().execute(
+            "INSERT OR IGNORE INTO blob (sha256, size, content_type) VALUES (?, ?, ?)",
+            (digest, os.path.getsize(dest_path), content_type)
+        )
+        return digest
+
+    def info(self, digest):
+        """Return {"size", "content_type"} or None."""
+        row = self._db.get().execute(
+            "SELECT size, content_type FROM blob WHERE sha256 = ?", (digest,)
+        ).fetchone()
+        if not row:
+            return None
+        return {"size": row[0], "content_type": row[1]}
+
+    def sweep(self, live, grace=SWEEP_GRACE_SECONDS):
+        """
+        Delete blobs whose digest is not in `live` and whose file is
+        older than `grace` seconds. Returns (blobs removed, bytes freed).
+        """
+        conn = self._db.get()
+        cutoff = time.time() - grace
+        removed, freed = 0, 0
+
+        for digest, size in conn.execute("SELECT sha256, size FROM blob").fetchall():
+            if digest in live:
+                continue
+            path = self.path_for(digest)
+            try:
+                if os.path.getmtime(path) > cutoff:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                pass    # row without a file: drop the row
+            conn.execute("DELETE FROM blob WHERE sha256 = ?", (digest,))
+            removed += 1
+            freed += size
+        return removed, freed
+
+
+def referenced_digests(documents):
+    """Digests of the /fhir/Binary/ attachments of (patient, document) pairs."""
+    digests = set()
+    for _, doc_data in documents:
+        for content in doc_data.get("content") or []:
+            url = (content.get("attachment") or {}).get("url") or ""
+            match = BINARY_URL_DIGEST.search(url)
+            if match:
+                digests.add(match.group(1))
+    return digests
+
+
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+
+def get_blob_store():
+    """Return the shared BlobStore instance."""
+    global _blob_store
+    with _blob_store_lock:
+        if _blob_store is None:
+            _blob_store = BlobStore()
+        return _blob_store
@@ -0,0 +1,72 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+# ============================================================
+# Streaming Bundle writer
+# Entries are serialized one at a time as the queryset is read,
+# so neither the row list nor the JSON body is ever held in full.
+# ============================================================
+ITERATOR_CHUNK_SIZE = 500          # rows fetched per DB round-trip
+WRITE_BUFFER_SIZE = 64 * 1024      # bytes sent per response chunk
+
+
+def _dumps(value):
+    return json.dumps(value, cls=DjangoJSONEncoder)
+
+
+def iter_bundle(resources, header=None, trailer=None, bundle_type="searchset"):
+    """
+    Yield a Bundle as JSON text.
+    `resources` is any iterable of resource dicts.
+    `header` keys are written before "entry"; `trailer` is a callable
+    returning keys written after it, evaluated once all entries are
+    out (e.g. "link" or "total", which depend on what was read).
+    """
+    parts = [f'{{"resourceType": "Bundle", "type": {_dumps(bundle_type)}']
+    for key, value in (header or {}).items():
+        parts.append(f", {_dumps(key)}: {_dumps(value)}")
+    parts.append(', "entry": [')
+
+    buffered = sum(len(p) for p in parts)
+    first = True
+
+    for resource in resources:
+        chunk = ("" if first else ", ") + _dumps({"resource": resource})
+        first = False
+        parts.append(chunk)
+        buffered += len(chunk)
+        if buffered >= WRITE_BUFFER_SIZE:
+            yield "".join(parts)
+            parts, buffered = [], 0
+
+    parts.append("]")
+    for key, value in (trailer() if trailer else {}).items():
+        parts.append(f", {_dumps(key)}: {_dumps(value)}")
+    parts.append("}")
+
+    yield "".join(parts)
+
+
+class StreamingBundleResponse(StreamingHttpResponse):
+
+    def __init__(self, resources, header=None, trailer=None, bundle_type="searchset", **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(
+            iter_bundle(resources, header=header, trailer=trailer, bundle_type=bundle_type),
+            **kwargs
+        )
+
+
+class Counter:
+    """Pass-through iterable that counts what went through it (for Bundle.total)."""
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.count = 0
+
+    def __iter__(self):
+        for item in self.iterable:
+            self.count += 1
+            yield item
@@ -0,0 +1,68 @@
+import threading
+
+from django.core.cache import caches
+
+# ============================================================
+# DocumentReference bundle cache
+# Bundles only change when upload_document_reference or
+# create_fhir_patient run, and both invalidate explicitly.
+# LRU size and TTL come from the "fhir" entry in settings.CACHES.
+# ============================================================
+BUNDLE_CACHE_ALIAS = "fhir"
+
+
+class BundleCache:
+
+    def __init__(self, alias=BUNDLE_CACHE_ALIAS, prefix="fhir:bundle:"):
+        self.alias = alias
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    def _key(self, patient_fhir_id):
+        return f"{self.prefix}{patient_fhir_id}"
+
+    def _count(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def get(self, patient_fhir_id):
+        bundle = self.backend.get(self._key(patient_fhir_id))
+        self._count(int(bundle is not None), int(bundle is None))
+        return bundle
+
+    def get_many(self, patient_fhir_ids):
+        """Return {patient_fhir_id: bundle} for the ids that are cached."""
+        keys = {self._key(pid): pid for pid in patient_fhir_ids}
+        found = self.backend.get_many(keys.keys())
+        self._count(len(found), len(keys) - len(found))
+        return {keys[key]: bundle for key, bundle in found.items()}
+
+    def set(self, patient_fhir_id, bundle):
+        self.backend.set(self._key(patient_fhir_id), bundle)
+
+    def invalidate(self, patient_fhir_id):
+        self.backend.delete(self._key(patient_fhir_id))
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+bundle_cache = BundleCache()
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .backends import BackendUnavailable, get_breaker
+
+# ============================================================
+# Shared FHIR HTTP client
+# One pooled keep-alive Session per process, bounded retries
+# with backoff on 5xx, and per-operation latency/error counters.
+# With a breaker (fhir/backends.py), connection errors and 5xx
+# count as failures and calls fail fast while it is open.
+# ============================================================
+
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class FHIRClient:
+
+    def __init__(self, base_url, pool_size=10, max_retries=3, backoff_factor=0.3, timeout=5, breaker=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.breaker = breaker
+
+        # Status/read retries only for idempotent methods: a POST that
+        # reached the server must not be replayed. Connection failures
+        # (request never sent) are retried for every method.
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+
+    def _record(self, operation, elapsed, error):
+        with self._metrics_lock:
+            stats = self._metrics.setdefault(operation, {
+                "calls": 0,
+                "errors": 0,
+                "total_seconds": 0.0,
+                "max_seconds": 0.0,
+            })
+            stats["calls"] += 1
+            stats["total_seconds"] += elapsed
+            stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+            if error:
+                stats["errors"] += 1
+
+    def request(self, operation, method, path, **kwargs):
+        """
+        Send one request to the FHIR server.
+        `operation` is the metrics key (e.g. "get_document_references").
+        Connection errors are recorded and re-raised; 4xx/5xx responses
+        are returned and counted as errors. Raises BackendUnavailable
+        without sending anything while the breaker is open.
+        """
+        if self.breaker is not None and not self.breaker.allow():
+            self._record(operation, 0.0, True)
+            raise BackendUnavailable(f"FHIR server circuit open; {operation} not sent")
+
+        kwargs.setdefault("timeout", self.timeout)
+        url = f"{self.base_url}/{path.lstrip('/')}"
+
+        started = time.monotonic()
+        error = True
+        server_down = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            error = response.status_code >= 400
+            server_down = response.status_code in RETRY_STATUSES
+            return response
+        finally:
+            self._record(operation, time.monotonic() - started, error)
+            if self.breaker is not None:
+                if server_down:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+
+    def get(self, operation, path, **kwargs):
+        return self.request(operation, "GET", path, **kwargs)
+
+    def post(self, operation, path, **kwargs):
+        return self.request(operation, "POST", path, **kwargs)
+
+    def metrics(self):
+        """Snapshot of per-operation counters, with average latency."""
+        with self._metrics_lock:
+            snapshot = {}
+            for operation, stats in self._metrics.items():
+                snapshot[operation] = dict(
+                    stats,
+                    avg_seconds=stats["total_seconds"] / stats["calls"] if stats["calls"] else 0.0
+                )
+            return snapshot
+
+    def reset_metrics(self):
+        with self._metrics_lock:
+            self._metrics.clear()
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_fhir_client():
+    """Return the process-wide FHIRClient built from settings."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = FHIRClient(
+                settings.FHIR_SERVER_URL,
+                pool_size=getattr(settings, "FHIR_HTTP_POOL_SIZE", 10),
+                max_retries=getattr(settings, "FHIR_HTTP_MAX_RETRIES", 3),
+                backoff_factor=getattr(settings, "FHIR_HTTP_BACKOFF", 0.3),
+                breaker=get_breaker(),
+            )
+        return _client
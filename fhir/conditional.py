@@ -0,0 +1,70 @@
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+# ============================================================
+# Conditional reads (ETag / Last-Modified -> 304)
+# Validators come from version_id / last_updated (see
+# fhir.models.VersionedResource), read with one small query, so
+# an unchanged resource or search page is answered with a 304
+# before anything is serialized. A search page's validators come
+# from the page's own rows (page_validators), never from an
+# aggregate over every match.
+# ============================================================
+
+
+def resource_etag(version_id):
+    """Strong ETag of a single resource: its meta.versionId."""
+    return f'"{version_id}"'
+
+
+def collection_etag(*parts):
+    """Strong ETag of a search result / compartment, from its state parts."""
+    digest = hashlib.sha256("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def collection_state(queryset):
+    """
+    (row count, newest last_updated) of a result set in one aggregate.
+    Any create or update moves the newest timestamp; the count
+    catches deletes.
+    """
+    state = queryset.aggregate(count=Count("id"), last_updated=Max("last_updated"))
+    return state["count"], state["last_updated"]
+
+
+def page_validators(rows, *parts):
+    """
+    (ETag, Last-Modified) of one search page, from the rows it returns
+    (.values() dicts): any create, update or delete that changes the
+    page changes an id or versionId, without aggregating over the
+    whole result set.
+    """
+    stamps = [row["last_updated"] for row in rows if row.get("last_updated")]
+    etag = collection_etag(*parts, *((row["id"], row.get("version_id")) for row in rows))
+    return etag, max(stamps) if stamps else None
+
+
+def not_modified(request, etag, last_modified=None):
+    """
+    HttpResponseNotModified if the client's If-None-Match /
+    If-Modified-Since still match, else None.
+    """
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=int(last_modified.timestamp()) if last_modified else None,
+    )
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified=None):
+    response["ETag"] = etag
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+    return response
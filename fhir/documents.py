@@ -0,0 +1,120 @@
+import re
+
+from django.db.models import Q
+
+from doctor_app.dashboard_cache import bump_doctors
+from doctor_app.models import Doctor
+
+from .models import DocumentIndex
+
+# ============================================================
+# Write-time DocumentReference classification
+# Category and author are worked out once, when a document is
+# stored, and kept in DocumentIndex. Views read them back with
+# one indexed query instead of string-matching every entry.
+# ============================================================
+
+CATEGORY_KEYWORDS = (
+    ("Lab", ("lab", "blood")),
+    ("Radiology", ("mri", "xray")),
+)
+
+# "Report uploaded by Dr. bob" (legacy local author.display) -> "bob"
+_AUTHOR_PREFIX = re.compile(r"^(?:report uploaded by\s+)?(?:dr\.?\s+)?")
+
+
+def classify_document(description):
+    text = (description or "").lower()
+    for category, keywords in CATEGORY_KEYWORDS:
+        if any(keyword in text for keyword in keywords):
+            return category
+    return "Document"
+
+
+def normalize_author(display):
+    key = " ".join((display or "").split()).casefold()
+    return _AUTHOR_PREFIX.sub("", key)[:150]
+
+
+def author_keys(user):
+    """Normalized keys a doctor's documents may carry as author.display."""
+    keys = {normalize_author(user.username), normalize_author(user.get_full_name())}
+    keys.discard("")
+    return keys
+
+
+def document_category(resource):
+    for concept in resource.get("category") or []:
+        if concept.get("text") in dict(DocumentIndex.CATEGORY_CHOICES):
+            return concept["text"]
+    return classify_document(resource.get("description"))
+
+
+def _practitioner_id(author):
+    reference = author.get("reference") or ""
+    if reference.startswith("Practitioner/") and reference[len("Practitioner/"):].isdigit():
+        return int(reference[len("Practitioner/"):])
+    return None
+
+
+def index_documents(items):
+    """
+    Index stored DocumentReferences.
+    items: iterable of (patient_fhir_id, resource), resource with "id".
+    Documents already indexed are left alone.
+    """
+    rows = []
+    for patient_fhir_id, resource in items:
+        if not resource.get("id"):
+            continue
+        authors = resource.get("author") or [{}]
+        rows.append(DocumentIndex(
+            doc_id=resource["id"],
+            patient_fhir_id=str(patient_fhir_id),
+            category=document_category(resource),
+            author_practitioner_id=_practitioner_id(authors[0]),
+            author_key=normalize_author(authors[0].get("display")),
+        ))
+
+    # drop references to practitioners we do not have
+    practitioner_ids = {row.author_practitioner_id for row in rows if row.author_practitioner_id}
+    if practitioner_ids:
+        known = set(Doctor.objects.filter(id__in=practitioner_ids).values_list("id", flat=True))
+        for row in rows:
+            if row.author_practitioner_id not in known:
+                row.author_practitioner_id = None
+
+    DocumentIndex.objects.bulk_create(rows, batch_size=1000, ignore_conflicts=True)
+    # bulk_create skips signals; authors see their uploads on the dashboard
+    bump_doctors(row.author_practitioner_id for row in rows)
+    return len(rows)
+
+
+def authored_documents(doctor, patient_fhir_ids):
+    """DocumentIndex rows authored by `doctor` (ids may be a subquery)."""
+    if not hasattr(patient_fhir_ids, "query"):
+        patient_fhir_ids = list(patient_fhir_ids)
+    return DocumentIndex.objects.filter(
+        Q(author_practitioner=doctor) | Q(author_key__in=author_keys(doctor.user)),
+        patient_fhir_id__in=patient_fhir_ids,
+    )
+
+
+def documents_by_author(doctor, patient_fhir_ids):
+    """{patient_fhir_id: {doc ids}} of documents authored by `doctor` - one query."""
+    rows = authored_documents(doctor, patient_fhir_ids).values_list("patient_fhir_id", "doc_id")
+
+    result = {}
+    for patient_fhir_id, doc_id in rows:
+        result.setdefault(patient_fhir_id, set()).add(doc_id)
+    return result
+
+
+def index_rows_for(doc_ids):
+    """{doc_id: (category, author_practitioner_id, author_key)} - one query."""
+    return {
+        doc_id: (category, practitioner_id, key)
+        for doc_id, category, practitioner_id, key in DocumentIndex.objects.filter(
+            doc_id__in=list(doc_ids)
+        ).values_list("doc_id", "category", "author_practitioner_id", "author_key")
+    }
@@ -0,0 +1,119 @@
+from django.db.models import Q
+
+from patients.models import Appointment
+from records.models import Encounter, Observation, Prescription, Report
+
+from .paging import get_page_size, page_url, parse_since, sign_cursor, unsign_cursor, InvalidCursor
+from .serializers import (
+    appointment_serializer,
+    diagnostic_report_serializer,
+    encounter_serializer,
+    medication_request_serializer,
+    observation_serializer,
+    subset_for,
+)
+
+# ============================================================
+# Patient/<id>/$everything
+# Resource types are read one after another, each in id order.
+# A page runs at most one query per type, and the _cursor records
+# (type index, last id) so the next page resumes exactly there. A
+# page that fills up at a type boundary checks that a row follows
+# before it links to a next page.
+# ============================================================
+
+
+def everything_sections(patient_id):
+    """(serializer, queryset) per resource type, in paging order."""
+    return [
+        (encounter_serializer, Encounter.objects.filter(patient_id=patient_id)),
+        (observation_serializer, Observation.objects.filter(encounter__patient_id=patient_id)),
+        (diagnostic_report_serializer, Report.objects.filter(patient_id=patient_id)),
+        (medication_request_serializer, Prescription.objects.filter(
+            Q(patient_id=patient_id) | Q(patient__isnull=True, encounter__patient_id=patient_id)
+        )),
+        (appointment_serializer, Appointment.objects.filter(patient_id=patient_id)),
+    ]
+
+
+class EverythingPage:
+    """
+    One page of a patient's $everything Bundle.
+    The Patient resource itself leads the first page.
+    Iterate for resources, then call links().
+    """
+
+    def __init__(self, request, patient_row, patient_serializer):
+        self.request = request
+        self.patient_row = patient_row
+        self.patient_serializer = subset_for(request, patient_serializer)
+        self.size = get_page_size(request)
+        self.since = parse_since(request)
+        # _elements / _summary=true narrow every section's columns
+        self.sections = [
+            (subset_for(request, serializer), queryset)
+            for serializer, queryset in everything_sections(patient_row["id"])
+        ]
+
+        self.cursor = request.GET.get("_cursor")
+        self.section, self.key = 0, None
+        if self.cursor:
+            data = unsign_cursor(self.cursor)
+            try:
+                self.section, self.key = int(data["s"]), int(data["k"])
+            except (KeyError, TypeError, ValueError):
+                raise InvalidCursor("Invalid or tampered _cursor")
+            if not 0 <= self.section < len(self.sections):
+                raise InvalidCursor("Invalid or tampered _cursor")
+
+        self.next_position = None
+
+    def __iter__(self):
+        remaining = self.size
+
+        if self.cursor is None:
+            yield self.patient_serializer.to_resource(self.patient_row)
+            remaining -= 1
+
+        for index in range(self.section, len(self.sections)):
+            serializer, queryset = self.sections[index]
+
+            if remaining == 0:
+                # page filled at a section boundary: link on only if a row follows
+                following = self._first_section_with_rows(index)
+                if following is not None:
+                    self.next_position = (following, 0)
+                return
+
+            queryset = serializer.filter_since(queryset, self.since)
+            if index == self.section and self.key is not None:
+                queryset = queryset.filter(id__gt=self.key)
+
+            rows = serializer.rows(queryset).order_by("id")[:remaining + 1]
+            last_id = None
+            for row in rows.iterator(chunk_size=remaining + 1):
+                if remaining == 0:
+                    # one row past the page: more left in this section
+                    self.next_position = (index, last_id)
+                    return
+                yield serializer.to_resource(row)
+                last_id = row["id"]
+                remaining -= 1
+
+    def _first_section_with_rows(self, start):
+        """Index of the first section from `start` with a row to send, else None."""
+        for index in range(start, len(self.sections)):
+            serializer, queryset = self.sections[index]
+            if serializer.filter_since(queryset, self.since).exists():
+                return index
+        return None
+
+    def links(self):
+        links = [{"relation": "self", "url": page_url(self.request, self.cursor)}]
+        if self.next_position is not None:
+            section, key = self.next_position
+            links.append({
+                "relation": "next",
+                "url": page_url(self.request, sign_cursor({"s": section, "k": key}))
+            })
+        return links
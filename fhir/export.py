@@ -0,0 +1,166 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max
+from django.utils import timezone
+
+from patients.models import Appointment, Patient
+from records.models import Encounter, Observation, Prescription, Report
+
+from .models import ExportJob
+from .serializers import (
+    appointment_serializer,
+    diagnostic_report_serializer,
+    encounter_serializer,
+    medication_request_serializer,
+    observation_serializer,
+    patient_serializer,
+)
+
+# ============================================================
+# FHIR Bulk Data $export
+# Jobs are run by `manage.py run_fhir_exports`, never in a request.
+# Each resource type is written as numbered gzipped NDJSON parts
+# of FHIR_EXPORT_PART_SIZE rows. A part is written to a temp file,
+# renamed into place and only then recorded in job.progress, so a
+# crashed job resumes from its last finished part.
+# ============================================================
+EXPORT_TYPES = {
+    "Patient": (Patient, patient_serializer),
+    "Encounter": (Encounter, encounter_serializer),
+    "Observation": (Observation, observation_serializer),
+    "DiagnosticReport": (Report, diagnostic_report_serializer),
+    "MedicationRequest": (Prescription, medication_request_serializer),
+    "Appointment": (Appointment, appointment_serializer),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def export_dir(job):
+    return os.path.join(settings.FHIR_EXPORT_DIR, str(job.id))
+
+
+def part_file_name(resource_type, part):
+    return f"{resource_type}-{part:04d}.ndjson.gz"
+
+
+def delete_export_files(job):
+    shutil.rmtree(export_dir(job), ignore_errors=True)
+
+
+def claim_next_job():
+    """
+    Take one runnable job: a new one, or an in-progress one whose
+    worker stopped sending heartbeats (crashed). The conditional
+    UPDATE makes sure only one worker wins each job.
+    """
+    stale_before = timezone.now() - datetime.timedelta(
+        seconds=settings.FHIR_EXPORT_STALE_SECONDS
+    )
+
+    candidates = ExportJob.objects.filter(status="accepted") | ExportJob.objects.filter(
+        status="in-progress", updated_at__lt=stale_before
+    )
+
+    for job in candidates.order_by("created_at")[:10]:
+        claimed = ExportJob.objects.filter(
+            pk=job.pk, status=job.status, updated_at=job.updated_at
+        ).update(status="in-progress", updated_at=timezone.now())
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def _write_part(path, resources):
+    """Write one gzipped NDJSON part atomically; returns the row count."""
+    tmp_path = f"{path}.tmp"
+    count = 0
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        for resource in resources:
+            f.write(json.dumps(resource, cls=DjangoJSONEncoder))
+            f.write("\n")
+            count += 1
+    os.replace(tmp_path, path)
+    return count
+
+
+def run_export_job(job):
+    """Run (or resume) a claimed job until it completes or fails."""
+    part_size = settings.FHIR_EXPORT_PART_SIZE
+    os.makedirs(export_dir(job), exist_ok=True)
+
+    try:
+        for resource_type in job.type_list():
+            model, serializer = EXPORT_TYPES[resource_type]
+            state = job.progress.get(resource_type)
+
+            if state is None:
+                # Snapshot the id range on first start, so a resumed
+                # job exports the same rows it would have originally.
+                max_id = model.objects.aggregate(max_id=Max("id"))["max_id"] or 0
+                state = {"max_id": max_id, "last_id": 0, "parts": [], "done": False}
+                job.progress[resource_type] = state
+                job.save(update_fields=["progress", "updated_at"])
+
+            queryset = serializer.filter_since(
+                model.objects.filter(id__lte=state["max_id"]), job.since
+            )
+
+            while not state["done"]:
+                rows = list(
+                    serializer.rows(queryset.filter(id__gt=state["last_id"]))
+                    .order_by("id")[:part_size]
+                )
+
+                if not rows:
+                    state["done"] = True
+                else:
+                    path = os.path.join(export_dir(job), part_file_name(resource_type, len(state["parts"])))
+                    state["parts"].append(
+                        _write_part(path, (serializer.to_resource(row) for row in rows))
+                    )
+                    state["last_id"] = rows[-1]["id"]
+                    state["done"] = len(rows) < part_size
+
+                # progress save doubles as the worker heartbeat
+                job.save(update_fields=["progress", "updated_at"])
+
+        job.status = "completed"
+        job.completed_at = timezone.now()
+        job.save(update_fields=["status", "completed_at", "updated_at"])
+
+    except Exception as e:
+        logger.exception("FHIR export %s failed", job.id)
+        job.status = "failed"
+        job.error = str(e)
+        job.save(update_fields=["status", "error", "updated_at"])
+        raise
+
+
+def export_manifest(job, build_url):
+    """Bulk Data completion manifest. build_url(file_name) -> absolute URL."""
+    output = []
+    for resource_type in job.type_list():
+        state = job.progress.get(resource_type, {})
+        for part, count in enumerate(state.get("parts", [])):
+            output.append({
+                "type": resource_type,
+                "url": build_url(part_file_name(resource_type, part)),
+                "count": count,
+            })
+
+    return {
+        "transactionTime": job.created_at.isoformat(),
+        "request": job.request_url,
+        "requiresAccessToken": True,
+        "output": output,
+        "error": [],
+    }
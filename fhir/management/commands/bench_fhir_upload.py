@@ -0,0 +1,101 @@
+import base64
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.core.management.base import BaseCommand
+
+from fhir.utils import document_reference_body
+
+
+class _DiscardHandler(BaseHTTPRequestHandler):
+    """Stand-in FHIR server: reads and drops the request body."""
+
+    def do_POST(self):
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark peak RSS of a remote DocumentReference upload: "
+        "the old buffered base64 payload vs. the streaming body."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="1,10,100",
+            help="Comma separated file sizes in MB"
+        )
+        # internal: run one upload in a fresh process
+        parser.add_argument("--worker", nargs=3, metavar=("MODE", "FILE", "URL"))
+
+    def handle(self, *args, **options):
+        if options["worker"]:
+            return self._run_worker(*options["worker"])
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _DiscardHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/fhir/DocumentReference"
+
+        self.stdout.write(f"{'size':>8} {'mode':>10} {'peak RSS':>10} {'time':>8}")
+
+        try:
+            for size_mb in [int(s) for s in options["sizes"].split(",")]:
+                with tempfile.NamedTemporaryFile(suffix=".pdf") as f:
+                    block = os.urandom(1024 * 1024)
+                    for _ in range(size_mb):
+                        f.write(block)
+                    f.flush()
+
+                    for mode in ("buffered", "streaming"):
+                        out = subprocess.run(
+                            [sys.executable, sys.argv[0], "bench_fhir_upload",
+                             "--worker", mode, f.name, url],
+                            capture_output=True, text=True, check=True
+                        ).stdout.split()
+                        self.stdout.write(
+                            f"{size_mb:>6}MB {mode:>10} {float(out[0]):>8.1f}MB {float(out[1]):>7.2f}s"
+                        )
+        finally:
+            server.shutdown()
+
+    def _run_worker(self, mode, file_path, url):
+        headers = {"Content-Type": "application/fhir+json"}
+        started = time.monotonic()
+
+        if mode == "buffered":
+            # The pre-streaming implementation
+            with open(file_path, "rb") as f:
+                encoded_data = base64.b64encode(f.read()).decode("utf-8")
+            payload = {
+                "resourceType": "DocumentReference",
+                "content": [{"attachment": {"data": encoded_data}}]
+            }
+            response = requests.post(url, json=payload, headers=headers, timeout=60)
+        else:
+            body = document_reference_body("bench", file_path, "Benchmark upload")
+            response = requests.post(url, data=body, headers=headers, timeout=60)
+
+        response.raise_for_status()
+        self.stdout.write(f"{_peak_rss_mb():.1f} {time.monotonic() - started:.3f}")
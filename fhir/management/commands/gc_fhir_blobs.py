@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from fhir.blobs import SWEEP_GRACE_SECONDS, get_blob_store, referenced_digests
+from fhir.store import get_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete attachment blobs that no DocumentReference in the local "
+        "FHIR store points at any more (mark and sweep)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--grace-hours",
+            type=float,
+            default=SWEEP_GRACE_SECONDS / 3600,
+            help="Keep unreferenced blobs younger than this (uploads in flight)"
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+
+        live = referenced_digests(get_store().iter_all())
+        removed, freed = get_blob_store().sweep(live, grace=options["grace_hours"] * 3600)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Removed {removed} blob(s), {freed} bytes freed, {len(live)} in use, "
+            f"in {time.monotonic() - started:.2f}s"
+        ))
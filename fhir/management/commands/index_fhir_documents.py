@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from fhir.documents import index_documents
+from fhir.store import STORE_ENGINES, get_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Backfill DocumentIndex (category / author) for DocumentReferences "
+        "already in the local FHIR store. New uploads are indexed as they "
+        "are written; documents already indexed are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--engine",
+            choices=sorted(STORE_ENGINES),
+            help="Store engine to read (default: settings.FHIR_LOCAL_STORE)"
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        store = get_store(options["engine"])
+
+        indexed = 0
+        batch = []
+        for item in store.iter_all():
+            batch.append(item)
+            if len(batch) >= options["batch_size"]:
+                indexed += index_documents(batch)
+                batch = []
+        if batch:
+            indexed += index_documents(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {indexed} DocumentReference(s) in {time.monotonic() - started:.2f}s"
+        ))
@@ -0,0 +1,70 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from fhir.store import LOCAL_FHIR_DIR, STORE_ENGINES
+
+
+class Command(BaseCommand):
+    help = (
+        "Offline migration/compaction of the local FHIR store. "
+        "Copies every DocumentReference from one engine into another "
+        "(default: sqlite store -> segment files) and compacts the target."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--source", default="sqlite", choices=sorted(STORE_ENGINES))
+        parser.add_argument("--target", default="segment", choices=sorted(STORE_ENGINES))
+        parser.add_argument(
+            "--base-dir",
+            default=LOCAL_FHIR_DIR,
+            help="fhir_local/ directory to migrate (default: MEDIA_ROOT/fhir_local)"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Documents written per target transaction"
+        )
+        parser.add_argument(
+            "--compact-only",
+            action="store_true",
+            help="Skip the copy and only compact the target store"
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        base_dir = options["base_dir"]
+
+        target = STORE_ENGINES[options["target"]](base_dir)
+
+        copied = 0
+
+        if not options["compact_only"]:
+            if options["source"] == options["target"]:
+                raise CommandError("--source and --target must differ (use --compact-only).")
+
+            if not os.path.isdir(base_dir):
+                raise CommandError(f"No local FHIR tree found at {base_dir}")
+
+            source = STORE_ENGINES[options["source"]](base_dir)
+
+            batch = []
+            for item in source.iter_all():
+                batch.append(item)
+                if len(batch) >= options["batch_size"]:
+                    target.add_many(batch)
+                    copied += len(batch)
+                    batch = []
+            if batch:
+                target.add_many(batch)
+                copied += len(batch)
+
+        target.compact()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Migrated {copied} DocumentReference(s) "
+            f"{options['source']} -> {options['target']} "
+            f"in {time.monotonic() - started:.2f}s"
+        ))
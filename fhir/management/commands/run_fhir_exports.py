@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from fhir.export import claim_next_job, run_export_job
+
+
+class Command(BaseCommand):
+    help = (
+        "Worker for FHIR Bulk Data $export jobs. Claims accepted jobs "
+        "(and in-progress jobs whose worker died) and writes their "
+        "gzipped NDJSON files, resuming from the last finished part."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Run every pending job, then exit instead of polling"
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=5.0,
+            help="Seconds to sleep when no job is waiting"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            job = claim_next_job()
+
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["poll_interval"])
+                continue
+
+            started = time.monotonic()
+            self.stdout.write(f"Running export {job.id} ({job.resource_types})")
+
+            try:
+                run_export_job(job)
+            except Exception as e:
+                # run_export_job has logged the traceback and failed the job
+                self.stderr.write(f"Export {job.id} failed: {e}")
+                continue
+
+            total = sum(sum(state["parts"]) for state in job.progress.values())
+            self.stdout.write(self.style.SUCCESS(
+                f"Export {job.id} completed: {total} resources "
+                f"in {time.monotonic() - started:.1f}s"
+            ))
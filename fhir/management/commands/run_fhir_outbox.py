@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from fhir.outbox import claim_batch, send_batch
+
+
+class Command(BaseCommand):
+    help = (
+        "Worker for the FHIR outbox. Sends queued DocumentReference "
+        "writes to the FHIR server in batches, retrying failures with "
+        "exponential backoff."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Send every due row, then exit instead of polling"
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=2.0,
+            help="Seconds to sleep when nothing is due"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="Rows per batch Bundle (default FHIR_OUTBOX_BATCH_SIZE)"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            entries = claim_batch(options["batch_size"])
+
+            if not entries:
+                if options["once"]:
+                    return
+                time.sleep(options["poll_interval"])
+                continue
+
+            started = time.monotonic()
+            synced = send_batch(entries)
+            self.stdout.write(
+                f"Outbox batch: {synced}/{len(entries)} synced "
+                f"in {time.monotonic() - started:.2f}s"
+            )
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.7 on 2026-10-17 20:43
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('request_url', models.TextField()),
+                ('resource_types', models.CharField(max_length=255)),
+                ('since', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('accepted', 'Accepted'), ('in-progress', 'In progress'), ('completed', 'Completed'), ('failed', 'Failed')], db_index=True, default='accepted', max_length=20)),
+                ('progress', models.JSONField(blank=True, default=dict)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('requested_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='fhir_export_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
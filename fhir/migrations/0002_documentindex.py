@@ -0,0 +1,30 @@
+# Generated by Django 5.1.7 on 2026-10-17 20:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctor_app', '0001_initial'),
+        ('fhir', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doc_id', models.CharField(max_length=200, unique=True)),
+                ('patient_fhir_id', models.CharField(max_length=200)),
+                ('category', models.CharField(choices=[('Document', 'Document'), ('Lab', 'Lab'), ('Radiology', 'Radiology')], default='Document', max_length=20)),
+                ('author_key', models.CharField(blank=True, default='', max_length=150)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('author_practitioner', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='fhir_documents', to='doctor_app.doctor')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient_fhir_id', 'category'], name='fhir_docidx_patient_cat'), models.Index(fields=['author_practitioner', 'patient_fhir_id'], name='fhir_docidx_practitioner'), models.Index(fields=['author_key', 'patient_fhir_id'], name='fhir_docidx_author_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.7 on 2026-10-17 20:56
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctor_app', '0001_initial'),
+        ('fhir', '0002_documentindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('resource_type', models.CharField(default='DocumentReference', max_length=50)),
+                ('patient_fhir_id', models.CharField(max_length=200)),
+                ('resource', models.JSONField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('synced', 'Synced'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('remote_id', models.CharField(blank=True, default='', max_length=200)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('synced_at', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='fhir_outbox', to='doctor_app.doctor')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='fhir_outbox_due'), models.Index(fields=['patient_fhir_id', 'created_at'], name='fhir_outbox_patient')],
+            },
+        ),
+    ]
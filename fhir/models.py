@@ -1,3 +1,188 @@
+import uuid
+
+from django.contrib.auth.models import User
 from django.db import models
+from django.utils import timezone
+
+
+# =========================
+# FHIR resource version (meta.versionId / meta.lastUpdated)
+# =========================
+class VersionedResource(models.Model):
+    """
+    Abstract base for models served as FHIR resources.
+    Every save() bumps version_id and stamps last_updated, which
+    back meta.versionId / meta.lastUpdated and the ETag and
+    Last-Modified headers of the read endpoints.
+    bulk_create() rows start at version 1; queryset.update()
+    does not bump the version.
+    """
+
+    version_id = models.PositiveIntegerField(default=1, editable=False)
+    last_updated = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        abstract = True
+        # _since / _lastUpdated filters and the (last_updated, id) change feed
+        indexes = [
+            models.Index(fields=["last_updated", "id"], name="%(app_label)s_%(class)s_lu_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            self.version_id = (self.version_id or 0) + 1
+        self.last_updated = timezone.now()
+
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, "version_id", "last_updated"}
+
+        super().save(*args, **kwargs)
+
+
+# =========================
+# Bulk Data $export job
+# =========================
+class ExportJob(models.Model):
+    STATUS_CHOICES = (
+        ("accepted", "Accepted"),
+        ("in-progress", "In progress"),
+        ("completed", "Completed"),
+        ("failed", "Failed"),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+
+    requested_by = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="fhir_export_jobs"
+    )
+
+    request_url = models.TextField()
+    resource_types = models.CharField(max_length=255)
+    since = models.DateTimeField(null=True, blank=True)
+
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default="accepted",
+        db_index=True
+    )
+
+    # per resource type: {"max_id", "last_id", "parts": [rows per file], "done"}
+    progress = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True, default="")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def type_list(self):
+        return [t for t in self.resource_types.split(",") if t]
+
+    def __str__(self):
+        return f"Export {self.id} ({self.status})"
+
+
+# =========================
+# DocumentReference index
+# One row per stored DocumentReference, written at upload time,
+# so dashboards filter by category / author with index lookups.
+# =========================
+class DocumentIndex(models.Model):
+    CATEGORY_CHOICES = (
+        ("Document", "Document"),
+        ("Lab", "Lab"),
+        ("Radiology", "Radiology"),
+    )
+
+    doc_id = models.CharField(max_length=200, unique=True)
+    patient_fhir_id = models.CharField(max_length=200)
+
+    category = models.CharField(
+        max_length=20,
+        choices=CATEGORY_CHOICES,
+        default="Document"
+    )
+
+    # Practitioner/<id> of the first author, when it is one of our doctors
+    author_practitioner = models.ForeignKey(
+        "doctor_app.Doctor",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="fhir_documents"
+    )
+
+    # normalized author.display (see fhir.documents.normalize_author)
+    author_key = models.CharField(max_length=150, blank=True, default="")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["patient_fhir_id", "category"], name="fhir_docidx_patient_cat"),
+            models.Index(fields=["author_practitioner", "patient_fhir_id"], name="fhir_docidx_practitioner"),
+            models.Index(fields=["author_key", "patient_fhir_id"], name="fhir_docidx_author_key"),
+        ]
+
+    def __str__(self):
+        return f"{self.doc_id} ({self.category})"
+
+
+# =========================
+# Outbox for remote FHIR writes
+# Views add a row and return; `manage.py run_fhir_outbox` sends.
+# =========================
+class OutboxEntry(models.Model):
+    STATUS_CHOICES = (
+        ("pending", "Pending"),
+        ("sending", "Sending"),
+        ("synced", "Synced"),
+        ("failed", "Failed"),
+    )
+
+    # sent as the resource identifier + If-None-Exist, so a retried
+    # send never creates a second copy on the FHIR server
+    idempotency_key = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+
+    resource_type = models.CharField(max_length=50, default="DocumentReference")
+    patient_fhir_id = models.CharField(max_length=200)
+    resource = models.JSONField()
+
+    created_by = models.ForeignKey(
+        "doctor_app.Doctor",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="fhir_outbox"
+    )
+
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default="pending"
+    )
+
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default="")
+
+    # id assigned by the FHIR server once synced
+    remote_id = models.CharField(max_length=200, blank=True, default="")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    synced_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"], name="fhir_outbox_due"),
+            models.Index(fields=["patient_fhir_id", "created_at"], name="fhir_outbox_patient"),
+        ]
 
-# Create your models here.
+    def __str__(self):
+        return f"{self.resource_type} for {self.patient_fhir_id} ({self.status})"
@@ -0,0 +1,156 @@
+import datetime
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import utils
+from .backends import BackendUnavailable, get_breaker, use_local_storage
+from .models import OutboxEntry
+
+# ============================================================
+# Outbox for remote FHIR writes
+# Upload views record the DocumentReference here and return at
+# once; `manage.py run_fhir_outbox` sends due rows in batches
+# (one batch Bundle per claim). Every resource carries its
+# idempotency key as an identifier and is POSTed with
+# If-None-Exist, so a batch that times out after the server
+# committed it is resent without creating duplicates.
+# While the HAPI circuit breaker is open nothing is sent, so a
+# batch it refuses is put back for when the breaker may probe
+# again without counting against FHIR_OUTBOX_MAX_ATTEMPTS.
+# ============================================================
+OUTBOX_IDENTIFIER_SYSTEM = "urn:ietf:rfc:3986"
+
+# A "sending" row older than this belongs to a worker that died
+SENDING_STALE_SECONDS = 300
+
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+
+
+def submit_document_reference(patient_fhir_id, file_url, description, author=None):
+    """
+    Record a DocumentReference for an already hosted file.
+    The local store is written at once (200); with a FHIR server the
+    write is queued in the outbox (202).
+    """
+    resource = utils.hosted_document_reference(patient_fhir_id, file_url, description, author)
+
+    if use_local_storage():
+        try:
+            utils.add_document_references([(patient_fhir_id, resource)])
+        except Exception as e:
+            print(f"[FHIR] storing DocumentReference failed: {e}")
+            return 500, str(e)
+        return 200, "Stored"
+
+    enqueue_document_reference(patient_fhir_id, resource, author)
+    return 202, "Queued"
+
+
+def enqueue_document_reference(patient_fhir_id, resource, author=None):
+    key = uuid.uuid4()
+    resource["id"] = utils.new_document_id(patient_fhir_id)
+    resource["identifier"] = [{"system": OUTBOX_IDENTIFIER_SYSTEM, "value": f"urn:uuid:{key}"}]
+    return OutboxEntry.objects.create(
+        idempotency_key=key,
+        resource_type="DocumentReference",
+        patient_fhir_id=patient_fhir_id,
+        resource=resource,
+        created_by=author,
+    )
+
+
+def claim_batch(size=None):
+    """
+    Claim up to `size` due rows for this worker. Each row is taken
+    with a conditional UPDATE, so concurrent workers never send the
+    same row twice.
+    """
+    size = size or settings.FHIR_OUTBOX_BATCH_SIZE
+    now = timezone.now()
+    stale_before = now - datetime.timedelta(seconds=SENDING_STALE_SECONDS)
+
+    candidates = OutboxEntry.objects.filter(
+        status="pending", next_attempt_at__lte=now
+    ) | OutboxEntry.objects.filter(
+        status="sending", claimed_at__lt=stale_before
+    )
+
+    claimed = []
+    for entry in candidates.order_by("next_attempt_at", "id")[:size]:
+        won = OutboxEntry.objects.filter(
+            pk=entry.pk, status=entry.status, claimed_at=entry.claimed_at
+        ).update(status="sending", claimed_at=now)
+        if won:
+            entry.status, entry.claimed_at = "sending", now
+            claimed.append(entry)
+    return claimed
+
+
+def retry_delay(attempts):
+    return min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+
+
+def _failed_attempt(entry, error):
+    entry.attempts += 1
+    entry.last_error = error[:2000]
+    if entry.attempts >= settings.FHIR_OUTBOX_MAX_ATTEMPTS:
+        entry.status = "failed"
+    else:
+        entry.status = "pending"
+        entry.next_attempt_at = timezone.now() + datetime.timedelta(
+            seconds=retry_delay(entry.attempts)
+        )
+    entry.save(update_fields=["attempts", "last_error", "status", "next_attempt_at"])
+
+
+def _breaker_open(entries, error):
+    """Requeue rows the breaker refused; no attempt was made."""
+    OutboxEntry.objects.filter(pk__in=[entry.pk for entry in entries]).update(
+        status="pending",
+        last_error=error[:2000],
+        next_attempt_at=timezone.now() + datetime.timedelta(seconds=get_breaker().reset_timeout),
+    )
+
+
+def send_batch(entries):
+    """Send claimed rows as one batch Bundle; returns the number synced."""
+    if not entries:
+        return 0
+
+    items = [(entry.patient_fhir_id, dict(entry.resource)) for entry in entries]
+    try:
+        ids = utils.add_document_references(items)
+    except BackendUnavailable as e:
+        print(f"[FHIR] outbox batch of {len(entries)} deferred: {e}")
+        _breaker_open(entries, str(e))
+        return 0
+    except Exception as e:
+        print(f"[FHIR] outbox batch of {len(entries)} failed: {e}")
+        for entry in entries:
+            _failed_attempt(entry, str(e))
+        return 0
+
+    synced = 0
+    for entry, doc_id in zip(entries, ids):
+        if not doc_id:
+            _failed_attempt(entry, "Rejected by the FHIR server")
+            continue
+        entry.status = "synced"
+        entry.remote_id = doc_id
+        entry.synced_at = timezone.now()
+        entry.last_error = ""
+        entry.attempts += 1
+        entry.save(update_fields=["status", "remote_id", "synced_at", "last_error", "attempts"])
+        synced += 1
+    return synced
+
+
+def retry_failed(queryset=None):
+    """Put failed rows back in the queue (admin action / manual retry)."""
+    queryset = queryset if queryset is not None else OutboxEntry.objects.all()
+    return queryset.filter(status="failed").update(
+        status="pending", attempts=0, next_attempt_at=timezone.now()
+    )
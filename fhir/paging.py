@@ -0,0 +1,283 @@
+import datetime
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core import signing
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+# ============================================================
+# Keyset paging for FHIR searches
+# ?_count=N           page size (capped at FHIR_MAX_PAGE_SIZE)
+# ?_cursor=<opaque>   signed cursor taken from a Bundle next/previous link
+# Rows are ordered by primary key, so each page is one indexed
+# range scan no matter how deep the client pages.
+#
+# Incremental sync
+# ?_since=<instant>            rows modified at or after the instant
+# ?_lastUpdated=[gt|ge|lt|le|eq]<instant>   (repeatable, e.g. a range)
+# ?_sort=_lastUpdated          change feed: (last_updated, id) order
+# ============================================================
+DEFAULT_PAGE_SIZE = 50
+DEFAULT_CHANGE_FEED_LAG = 5
+CURSOR_SALT = "fhir.paging"
+
+
+class InvalidSearchParameter(ValueError):
+    pass
+
+
+class InvalidCursor(InvalidSearchParameter):
+    pass
+
+
+def get_page_size(request):
+    max_size = getattr(settings, "FHIR_MAX_PAGE_SIZE", 200)
+    try:
+        size = int(request.GET.get("_count", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        size = DEFAULT_PAGE_SIZE
+    return max(1, min(size, max_size))
+
+
+def _parse_instant(value, param):
+    """(aware datetime, is_date_only) for an instant or date value."""
+    is_date = False
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            if day is None:
+                raise ValueError(value)
+            parsed = datetime.datetime.combine(day, datetime.time.min)
+            is_date = True
+    except ValueError:
+        raise InvalidSearchParameter(f"Invalid {param}: {value}")
+
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed, is_date
+
+
+def parse_since(request, param="_since"):
+    """
+    Parse an instant/date search parameter into an aware datetime.
+    Returns None when the parameter is absent.
+    """
+    value = request.GET.get(param)
+    if not value:
+        return None
+    return _parse_instant(value, param)[0]
+
+
+LAST_UPDATED_PREFIXES = {
+    "gt": "gt",
+    "ge": "gte",
+    "lt": "lt",
+    "le": "lte",
+}
+
+
+def filter_last_updated(request, queryset, field="last_updated"):
+    """
+    Apply every ?_lastUpdated=<prefix><instant> to `queryset`.
+    No prefix (or "eq") matches the value's precision: the whole day
+    for a date, the exact instant otherwise.
+    """
+    for value in request.GET.getlist("_lastUpdated"):
+        prefix, instant = value[:2], value[2:]
+        if prefix not in LAST_UPDATED_PREFIXES and prefix != "eq":
+            prefix, instant = "eq", value
+
+        parsed, is_date = _parse_instant(instant, "_lastUpdated")
+
+        if prefix != "eq":
+            queryset = queryset.filter(**{f"{field}__{LAST_UPDATED_PREFIXES[prefix]}": parsed})
+        elif is_date:
+            queryset = queryset.filter(**{
+                f"{field}__gte": parsed,
+                f"{field}__lt": parsed + datetime.timedelta(days=1),
+            })
+        else:
+            queryset = queryset.filter(**{field: parsed})
+    return queryset
+
+
+def sign_cursor(data):
+    return signing.dumps(data, salt=CURSOR_SALT)
+
+
+def unsign_cursor(cursor):
+    try:
+        return signing.loads(cursor, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        raise InvalidCursor("Invalid or tampered _cursor")
+
+
+def encode_cursor(direction, key):
+    return sign_cursor({"d": direction, "k": key})
+
+
+def decode_cursor(cursor):
+    data = unsign_cursor(cursor)
+    try:
+        return data["d"], int(data["k"])
+    except (KeyError, TypeError, ValueError):
+        raise InvalidCursor("Invalid or tampered _cursor")
+
+
+def _row_id(row):
+    return row["id"] if isinstance(row, dict) else row.id
+
+
+def page_url(request, cursor=None):
+    params = [(k, v) for k, values in request.GET.lists() if k != "_cursor" for v in values]
+    if cursor:
+        params.append(("_cursor", cursor))
+    query = urlencode(params)
+    url = request.build_absolute_uri(request.path)
+    return f"{url}?{query}" if query else url
+
+
+class KeysetPage:
+    """
+    One page of `queryset` (models or .values() dicts with "id").
+    Iterate it to read the rows - forward pages stream straight from
+    the DB cursor - then call links() for the Bundle.link list.
+    The cursor is validated up front, so InvalidCursor is raised
+    before any response has started.
+    """
+
+    def __init__(self, request, queryset):
+        self.request = request
+        self.queryset = queryset
+        self.size = get_page_size(request)
+        self.cursor = request.GET.get("_cursor")
+        self.direction, self.key = "n", None
+        if self.cursor:
+            self.direction, self.key = decode_cursor(self.cursor)
+
+        self.has_more = False
+        self.first_id = None
+        self.last_id = None
+
+    def _rows(self):
+        if self.direction == "p":
+            # Read backwards from the key, then flip into id order
+            rows = list(self.queryset.filter(id__lt=self.key).order_by("-id")[:self.size + 1])
+            self.has_more = len(rows) > self.size
+            rows = rows[:self.size]
+            rows.reverse()
+            yield from rows
+            return
+
+        queryset = self.queryset
+        if self.key is not None:
+            queryset = queryset.filter(id__gt=self.key)
+
+        rows = queryset.order_by("id")[:self.size + 1].iterator(chunk_size=self.size + 1)
+        for index, row in enumerate(rows):
+            if index == self.size:
+                self.has_more = True
+                break
+            yield row
+
+    def __iter__(self):
+        for row in self._rows():
+            if self.first_id is None:
+                self.first_id = _row_id(row)
+            self.last_id = _row_id(row)
+            yield row
+
+    def links(self):
+        if self.direction == "p":
+            has_next, has_prev = True, self.has_more
+        else:
+            has_next, has_prev = self.has_more, self.key is not None
+
+        links = [{"relation": "self", "url": page_url(self.request, self.cursor)}]
+
+        if self.last_id is not None and has_next:
+            links.append({
+                "relation": "next",
+                "url": page_url(self.request, encode_cursor("n", self.last_id))
+            })
+        if self.first_id is not None and has_prev:
+            links.append({
+                "relation": "previous",
+                "url": page_url(self.request, encode_cursor("p", self.first_id))
+            })
+
+        return links
+
+
+def is_change_feed(request):
+    return request.GET.get("_sort") == "_lastUpdated"
+
+
+class ChangeFeedPage:
+    """
+    One forward page of `queryset` in (last_updated, id) order, for
+    clients mirroring our data. Same interface as KeysetPage.
+
+    last_updated is stamped before commit, so a slow transaction can
+    commit a row older than one already served. Rows newer than
+    FHIR_CHANGE_FEED_LAG seconds are therefore held back until they
+    settle. As long as no write transaction runs longer than the lag,
+    a client that follows `next` links (and later resumes from its
+    last lastUpdated) never skips a change.
+    """
+
+    def __init__(self, request, queryset, field="last_updated"):
+        self.request = request
+        self.field = field
+        self.size = get_page_size(request)
+        self.cursor = request.GET.get("_cursor")
+
+        self.key = None
+        if self.cursor:
+            data = unsign_cursor(self.cursor)
+            try:
+                self.key = (_parse_instant(data["t"], "_cursor")[0], int(data["k"]))
+            except (KeyError, TypeError, ValueError):
+                raise InvalidCursor("Invalid or tampered _cursor")
+
+        settled = timezone.now() - datetime.timedelta(
+            seconds=getattr(settings, "FHIR_CHANGE_FEED_LAG", DEFAULT_CHANGE_FEED_LAG)
+        )
+        self.queryset = queryset.filter(**{f"{field}__lt": settled})
+
+        self.has_more = False
+        self.last_key = None
+
+    def _rows(self):
+        queryset = self.queryset
+        if self.key is not None:
+            stamp, pk = self.key
+            queryset = queryset.filter(
+                Q(**{f"{self.field}__gt": stamp}) | Q(**{self.field: stamp, "id__gt": pk})
+            )
+
+        rows = queryset.order_by(self.field, "id")[:self.size + 1].iterator(chunk_size=self.size + 1)
+        for index, row in enumerate(rows):
+            if index == self.size:
+                self.has_more = True
+                break
+            yield row
+
+    def __iter__(self):
+        for row in self._rows():
+            stamp = row[self.field] if isinstance(row, dict) else getattr(row, self.field)
+            self.last_key = (stamp, _row_id(row))
+            yield row
+
+    def links(self):
+        links = [{"relation": "self", "url": page_url(self.request, self.cursor)}]
+        if self.has_more and self.last_key is not None:
+            stamp, pk = self.last_key
+            links.append({
+                "relation": "next",
+                "url": page_url(self.request, sign_cursor({"t": stamp.isoformat(), "k": pk}))
+            })
+        return links
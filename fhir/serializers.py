@@ -0,0 +1,320 @@
+from .bundle import ITERATOR_CHUNK_SIZE
+from .paging import InvalidSearchParameter
+
+# ============================================================
+# FHIR resource serializers
+# Each serializer names the exact columns it needs (joins included)
+# and builds resources from .values() rows, so serializing N rows is
+# always one query - no model instances, no per-row FK lookups.
+#
+# ?_elements=a,b and ?_summary=true narrow a serializer to some
+# top-level elements (see subset_for); only the columns those
+# elements are built from are SELECTed.
+# ============================================================
+
+GENDER_CODES = {
+    "M": "male",
+    "F": "female",
+    "O": "other",
+}
+
+
+class ResourceSerializer:
+    fields = ()
+    # column used for _since filtering (None: not filterable)
+    since_field = "last_updated"
+
+    # columns every subset reads (id + meta)
+    base_fields = ("id", "version_id", "last_updated")
+    # top-level element -> columns it is built from
+    element_fields = {}
+    # elements kept by _summary=true (None: all of them)
+    summary_elements = None
+
+    def rows(self, queryset):
+        """Restrict `queryset` to the columns this serializer reads."""
+        return queryset.values(*self.fields)
+
+    def to_resource(self, row):
+        raise NotImplementedError
+
+    @staticmethod
+    def meta(row):
+        return {
+            "versionId": str(row["version_id"]),
+            "lastUpdated": row["last_updated"].isoformat(),
+        }
+
+    def filter_since(self, queryset, since):
+        if since is None or self.since_field is None:
+            return queryset
+        return queryset.filter(**{f"{self.since_field}__gte": since})
+
+    def iter_resources(self, queryset):
+        """Stream resources for `queryset` (one query, chunked fetch)."""
+        for row in self.rows(queryset).iterator(chunk_size=ITERATOR_CHUNK_SIZE):
+            yield self.to_resource(row)
+
+    def subset(self, elements):
+        return ElementSubset(self, elements)
+
+    def summary(self):
+        elements = self.summary_elements
+        return self.subset(self.element_fields if elements is None else elements)
+
+
+# meta.tag marking a resource that is missing elements on purpose
+SUBSETTED_TAG = {
+    "system": "http://terminology.hl7.org/CodeSystem/v3-ObservationValue",
+    "code": "SUBSETTED",
+}
+
+# returned whatever _elements asks for
+MANDATORY_ELEMENTS = ("resourceType", "id", "meta")
+
+
+class _PartialRow(dict):
+    """A .values() row missing unselected columns; they read as None."""
+
+    def __missing__(self, key):
+        return None
+
+
+class ElementSubset:
+    """
+    `serializer` restricted to some top-level elements. Same interface
+    as ResourceSerializer; rows() selects only the columns behind the
+    requested elements, and resources are built from those then pruned.
+    """
+
+    def __init__(self, serializer, elements):
+        self.serializer = serializer
+        self.since_field = serializer.since_field
+        self.elements = set(elements) | set(MANDATORY_ELEMENTS)
+
+        columns = list(serializer.base_fields)
+        for element in elements:
+            columns.extend(serializer.element_fields.get(element, ()))
+        self.fields = tuple(dict.fromkeys(columns))
+
+    def rows(self, queryset):
+        return queryset.values(*self.fields)
+
+    def to_resource(self, row):
+        resource = self.serializer.to_resource(_PartialRow(row))
+        resource = {k: v for k, v in resource.items() if k in self.elements}
+        resource["meta"] = dict(resource.get("meta", {}), tag=[SUBSETTED_TAG])
+        return resource
+
+    def filter_since(self, queryset, since):
+        return self.serializer.filter_since(queryset, since)
+
+    def iter_resources(self, queryset):
+        for row in self.rows(queryset).iterator(chunk_size=ITERATOR_CHUNK_SIZE):
+            yield self.to_resource(row)
+
+
+def parse_summary(request):
+    """?_summary: "true", "count" or None (full resources)."""
+    value = request.GET.get("_summary")
+    if value in (None, "", "false", "data"):
+        # "data" drops only the narrative, which we never generate
+        return None
+    if value in ("true", "count"):
+        return value
+    raise InvalidSearchParameter(f"Unsupported _summary: {value}")
+
+
+def subset_for(request, serializer):
+    """
+    The serializer to use for this request's _elements / _summary=true
+    (`serializer` itself when neither is given). _summary=count is left
+    to the caller, which answers with a total and no entries.
+    """
+    elements = [e.strip() for e in request.GET.get("_elements", "").split(",") if e.strip()]
+    if parse_summary(request) == "true":
+        return serializer.summary()
+    if elements:
+        return serializer.subset(elements)
+    return serializer
+
+
+class PatientSerializer(ResourceSerializer):
+    fields = ("id", "user__username", "gender", "version_id", "last_updated")
+    element_fields = {
+        "name": ("user__username",),
+        "gender": ("gender",),
+        "birthDate": (),
+    }
+
+    def to_resource(self, row):
+        return {
+            "resourceType": "Patient",
+            "id": str(row["id"]),
+            "meta": self.meta(row),
+            "name": [{
+                "use": "official",
+                "text": row["user__username"],
+            }],
+            "gender": GENDER_CODES.get(row["gender"], "unknown"),
+            "birthDate": None,
+        }
+
+
+class EncounterSerializer(ResourceSerializer):
+    fields = ("id", "patient_id", "started_at", "reason", "version_id", "last_updated")
+    element_fields = {
+        "status": (),
+        "subject": ("patient_id",),
+        "period": ("started_at",),
+        "reasonCode": ("reason",),
+    }
+
+    def to_resource(self, row):
+        return {
+            "resourceType": "Encounter",
+            "id": str(row["id"]),
+            "meta": self.meta(row),
+            "status": "finished",
+            "subject": {"reference": f"Patient/{row['patient_id']}"},
+            "period": {
+                "start": str(row["started_at"]) if row["started_at"] else None,
+            },
+            "reasonCode": [{"text": row["reason"]}]
+        }
+
+
+class ObservationSerializer(ResourceSerializer):
+    fields = ("id", "encounter__patient_id", "code", "value", "recorded_at", "version_id", "last_updated")
+    element_fields = {
+        "status": (),
+        "subject": ("encounter__patient_id",),
+        "code": ("code",),
+        "valueString": ("value",),
+        "effectiveDateTime": ("recorded_at",),
+    }
+
+    def to_resource(self, row):
+        return {
+            "resourceType": "Observation",
+            "id": str(row["id"]),
+            "meta": self.meta(row),
+            "status": "final",
+            "subject": {"reference": f"Patient/{row['encounter__patient_id']}"},
+            "code": {"text": row["code"]},
+            "valueString": str(row["value"]),
+            "effectiveDateTime": str(row["recorded_at"])
+        }
+
+
+REPORT_STATUS_CODES = {
+    "pending": "preliminary",
+    "explained": "final",
+}
+
+
+class DiagnosticReportSerializer(ResourceSerializer):
+    """records.Report -> DiagnosticReport"""
+    fields = ("id", "patient_id", "encounter_id", "doctor_id", "laboratory_id",
+              "title", "status", "created_at", "uploaded_at", "version_id", "last_updated")
+    element_fields = {
+        "status": ("status",),
+        "code": ("title",),
+        "subject": ("patient_id",),
+        "effectiveDateTime": ("created_at",),
+        "issued": ("uploaded_at",),
+        "encounter": ("encounter_id",),
+        "performer": ("laboratory_id", "doctor_id"),
+    }
+
+    def to_resource(self, row):
+        resource = {
+            "resourceType": "DiagnosticReport",
+            "id": str(row["id"]),
+            "meta": self.meta(row),
+            "status": REPORT_STATUS_CODES.get(row["status"], "registered"),
+            "code": {"text": row["title"]},
+            "subject": {"reference": f"Patient/{row['patient_id']}"},
+            "effectiveDateTime": str(row["created_at"]),
+            "issued": str(row["uploaded_at"]),
+        }
+        if row["encounter_id"]:
+            resource["encounter"] = {"reference": f"Encounter/{row['encounter_id']}"}
+        performers = []
+        if row["laboratory_id"]:
+            performers.append({"reference": f"Organization/lab-{row['laboratory_id']}"})
+        if row["doctor_id"]:
+            performers.append({"reference": f"Practitioner/{row['doctor_id']}"})
+        if performers:
+            resource["performer"] = performers
+        return resource
+
+
+class MedicationRequestSerializer(ResourceSerializer):
+    """records.Prescription -> MedicationRequest"""
+    fields = ("id", "patient_id", "encounter__patient_id", "encounter_id", "doctor_id",
+              "medicines", "notes", "created_at", "version_id", "last_updated")
+    element_fields = {
+        "status": (),
+        "intent": (),
+        "medicationCodeableConcept": ("medicines",),
+        "subject": ("patient_id", "encounter__patient_id"),
+        "authoredOn": ("created_at",),
+        "encounter": ("encounter_id",),
+        "requester": ("doctor_id",),
+        "note": ("notes",),
+    }
+    summary_elements = ("status", "intent", "medicationCodeableConcept", "subject",
+                        "authoredOn", "encounter", "requester")
+
+    def to_resource(self, row):
+        patient_id = row["patient_id"] or row["encounter__patient_id"]
+        resource = {
+            "resourceType": "MedicationRequest",
+            "id": str(row["id"]),
+            "meta": self.meta(row),
+            "status": "active",
+            "intent": "order",
+            "medicationCodeableConcept": {"text": row["medicines"]},
+            "subject": {"reference": f"Patient/{patient_id}"},
+            "authoredOn": str(row["created_at"]),
+        }
+        if row["encounter_id"]:
+            resource["encounter"] = {"reference": f"Encounter/{row['encounter_id']}"}
+        if row["doctor_id"]:
+            resource["requester"] = {"reference": f"Practitioner/{row['doctor_id']}"}
+        if row["notes"]:
+            resource["note"] = [{"text": row["notes"]}]
+        return resource
+
+
+class AppointmentSerializer(ResourceSerializer):
+    """patients.Appointment -> Appointment"""
+    fields = ("id", "patient_id", "doctor_id", "date", "time")
+    since_field = "created_at"
+    base_fields = ("id",)
+    element_fields = {
+        "status": (),
+        "start": ("date", "time"),
+        "participant": ("patient_id", "doctor_id"),
+    }
+
+    def to_resource(self, row):
+        return {
+            "resourceType": "Appointment",
+            "id": str(row["id"]),
+            "status": "booked",
+            "start": f"{row['date']}T{row['time']}",
+            "participant": [
+                {"actor": {"reference": f"Patient/{row['patient_id']}"}, "status": "accepted"},
+                {"actor": {"reference": f"Practitioner/{row['doctor_id']}"}, "status": "accepted"},
+            ]
+        }
+
+
+patient_serializer = PatientSerializer()
+encounter_serializer = EncounterSerializer()
+observation_serializer = ObservationSerializer()
+diagnostic_report_serializer = DiagnosticReportSerializer()
+medication_request_serializer = MedicationRequestSerializer()
+appointment_serializer = AppointmentSerializer()
@@ -0,0 +1,529 @@
+import json
+import mmap
+import os
+import sqlite3
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: single process, no flock needed
+    fcntl = None
+
+from django.conf import settings
+
+# ============================================================
+# Local FHIR store engines
+# Used by fhir.utils when settings.FHIR_BACKEND = "local" (and as the
+# read fallback while the HAPI circuit breaker is open).
+# Pick the engine with settings.FHIR_LOCAL_STORE ("segment" / "sqlite" / "json")
+# ============================================================
+LOCAL_FHIR_DIR = os.path.join(settings.MEDIA_ROOT, "fhir_local")
+LOCAL_PATIENTS_DIR = os.path.join(LOCAL_FHIR_DIR, "patients")
+LOCAL_DOCUMENTS_DIR = os.path.join(LOCAL_FHIR_DIR, "documents")
+LOCAL_INDEX_FILE = os.path.join(LOCAL_FHIR_DIR, "index.json")
+
+
+class SQLiteConnection:
+    """
+    Lazily opened sqlite3 connection, one per thread and per process.
+    sqlite3 connections must not cross threads or forked gunicorn workers.
+    """
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self._local = threading.local()
+
+    def get(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.schema)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+class BaseDocumentStore:
+    """
+    Interface for a local DocumentReference store.
+    Documents are plain FHIR DocumentReference dicts with an "id".
+    """
+
+    def add(self, patient_fhir_id, doc_data):
+        raise NotImplementedError
+
+    def add_many(self, items):
+        """items: iterable of (patient_fhir_id, doc_data)."""
+        for patient_fhir_id, doc_data in items:
+            self.add(patient_fhir_id, doc_data)
+
+    def list_for_patient(self, patient_fhir_id):
+        raise NotImplementedError
+
+    def iter_all(self):
+        """Yield (patient_fhir_id, doc_data) for every stored document."""
+        raise NotImplementedError
+
+    def compact(self):
+        pass
+
+
+# ============================================================
+# LEGACY ENGINE: one JSON file per document + index.json
+# Kept so old fhir_local/ trees can still be read and migrated.
+# ============================================================
+class JSONIndexStore(BaseDocumentStore):
+
+    def __init__(self, base_dir=LOCAL_FHIR_DIR):
+        self.documents_dir = os.path.join(base_dir, "documents")
+        self.index_file = os.path.join(base_dir, "index.json")
+
+    def _load_index(self):
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "r") as f:
+                return json.load(f)
+        return {}
+
+    def _save_index(self, index):
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_file, self.index_file)
+
+    def add(self, patient_fhir_id, doc_data):
+        os.makedirs(self.documents_dir, exist_ok=True)
+        doc_file = os.path.join(self.documents_dir, f"{doc_data['id']}.json")
+        with open(doc_file, "w") as f:
+            json.dump(doc_data, f, indent=2)
+
+        index = self._load_index()
+        index.setdefault(str(patient_fhir_id), []).append(doc_data["id"])
+        self._save_index(index)
+
+    def add_many(self, items):
+        os.makedirs(self.documents_dir, exist_ok=True)
+        index = self._load_index()
+        for patient_fhir_id, doc_data in items:
+            doc_file = os.path.join(self.documents_dir, f"{doc_data['id']}.json")
+            with open(doc_file, "w") as f:
+                json.dump(doc_data, f, indent=2)
+            doc_ids = index.setdefault(str(patient_fhir_id), [])
+            if doc_data["id"] not in doc_ids:
+                doc_ids.append(doc_data["id"])
+        self._save_index(index)
+
+    def _read_doc(self, doc_id):
+        doc_file = os.path.join(self.documents_dir, f"{doc_id}.json")
+        if not os.path.exists(doc_file):
+            return None
+        with open(doc_file, "r") as f:
+            return json.load(f)
+
+    def list_for_patient(self, patient_fhir_id):
+        docs = []
+        for doc_id in self._load_index().get(str(patient_fhir_id), []):
+            doc_data = self._read_doc(doc_id)
+            if doc_data is not None:
+                docs.append(doc_data)
+        return docs
+
+    def iter_all(self):
+        for pid, doc_ids in self._load_index().items():
+            for doc_id in doc_ids:
+                doc_data = self._read_doc(doc_id)
+                if doc_data is not None:
+                    yield pid, doc_data
+
+
+# ============================================================
+# SQLITE ENGINE
+# WAL mode + one INSERT per upload: appends are atomic across
+# gunicorn workers and per-patient reads use an index.
+# ============================================================
+class SQLiteDocumentStore(BaseDocumentStore):
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS document_reference (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            patient_id TEXT NOT NULL,
+            resource TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS document_reference_patient
+            ON document_reference (patient_id, seq);
+    """
+
+    def __init__(self, base_dir=LOCAL_FHIR_DIR):
+        self.path = os.path.join(base_dir, "store.sqlite3")
+        self._db = SQLiteConnection(self.path, self.SCHEMA)
+
+    def _connect(self):
+        return self._db.get()
+
+    def add(self, patient_fhir_id, doc_data):
+        self._connect().execute(
+            "INSERT INTO document_reference (id, patient_id, resource) VALUES (?, ?, ?)",
+            (doc_data["id"], str(patient_fhir_id), json.dumps(doc_data, separators=(",", ":")))
+        )
+
+    def add_many(self, items):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO document_reference (id, patient_id, resource) VALUES (?, ?, ?)",
+                (
+                    (doc_data["id"], str(pid), json.dumps(doc_data, separators=(",", ":")))
+                    for pid, doc_data in items
+                )
+            )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def list_for_patient(self, patient_fhir_id):
+        rows = self._connect().execute(
+            "SELECT resource FROM document_reference WHERE patient_id = ? ORDER BY seq",
+            (str(patient_fhir_id),)
+        )
+        return [json.loads(resource) for (resource,) in rows]
+
+    def iter_all(self):
+        rows = self._connect().execute(
+            "SELECT patient_id, resource FROM document_reference ORDER BY seq"
+        )
+        for pid, resource in rows:
+            yield pid, json.loads(resource)
+
+    def compact(self):
+        conn = self._connect()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+
+
+# ============================================================
+# SEGMENT ENGINE
+# segments/<shard>/MANIFEST             ordered list of live segments
+# segments/<shard>/<n>.dat              packed compact-JSON documents
+# segments/<shard>/<n>.idx              one [patient, doc id, offset, length]
+#                                       line per document, append-only
+# Patients hash to one of SEGMENT_SHARDS directories. Writers append
+# under an flock on the shard and roll over to a new segment at
+# SEGMENT_ROLLOVER_BYTES; readers keep the offset index in memory and
+# read documents through mmap, so listing a patient costs a couple of
+# stat() calls instead of one open() per document. compact() merges
+# runs of small sealed segments into segments of up to
+# SEGMENT_TARGET_BYTES. Reads go through a per-MANIFEST snapshot
+# (_ShardView) rather than the shard lock; a reader that finds a
+# segment compacted away re-reads the manifest and carries on.
+# ============================================================
+SEGMENT_SHARDS = 16
+SEGMENT_ROLLOVER_BYTES = 4 * 1024 * 1024
+SEGMENT_TARGET_BYTES = 128 * 1024 * 1024
+
+
+class _ShardView:
+    """
+    Read state of one shard for one MANIFEST version: the live
+    segments, the offset index loaded so far and the open mmaps.
+    A compaction swaps in a new view instead of changing this one,
+    so a reader holding a view never needs the shard lock.
+    """
+
+    def __init__(self, path, key, segments, next_segment):
+        self.path = path
+        self.key = key
+        self.segments = segments
+        self.next_segment = next_segment
+        self.index = {}         # patient id -> [(segment, offset, length, doc id)]
+        self.doc_ids = set()
+        self.idx_pos = {}       # segment -> bytes of its .idx already loaded
+        self.maps = {}          # segment -> mmap of its .dat
+
+    def file(self, segment, ext):
+        return os.path.join(self.path, f"{segment}.{ext}")
+
+    def load_index(self, segment):
+        """Pick up index lines appended since the last call (shard lock held)."""
+        pos = self.idx_pos.get(segment, 0)
+        idx_path = self.file(segment, "idx")
+        if os.path.getsize(idx_path) == pos:
+            return
+
+        with open(idx_path, "rb") as f:
+            f.seek(pos)
+            data = f.read()
+
+        # ignore a trailing line another process is still writing
+        complete = data[:data.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            pid, doc_id, offset, length = json.loads(line)
+            self.index.setdefault(pid, []).append((segment, offset, length, doc_id))
+            self.doc_ids.add(doc_id)
+        self.idx_pos[segment] = pos + len(complete)
+
+    def read(self, segment, offset, length):
+        """
+        One document. Raises FileNotFoundError when a compaction has
+        removed the segment since this view was taken.
+        """
+        m = self.maps.get(segment)
+        if m is None or offset + length > len(m):
+            # a map that predates later appends is replaced, not closed:
+            # another thread may still be reading through it
+            with open(self.file(segment, "dat"), "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = m
+        return json.loads(m[offset:offset + length])
+
+    def locations(self, pid=None):
+        """(pid, location) pairs in append order (segment order, then offset)."""
+        if pid is not None:
+            return [(pid, location) for location in list(self.index.get(pid, ()))]
+        order = {segment: i for i, segment in enumerate(self.segments)}
+        locations = [
+            (pid, location)
+            for pid, entries in list(self.index.items())
+            for location in list(entries)
+        ]
+        locations.sort(key=lambda item: (order[item[1][0]], item[1][1]))
+        return locations
+
+
+class _SegmentShard:
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.join(path, "MANIFEST")
+        self.lock_path = os.path.join(path, "LOCK")
+        self._lock = threading.Lock()   # guards view refreshes only
+        self._view = _ShardView(path, None, [], 1)
+
+    def _file(self, segment, ext):
+        return os.path.join(self.path, f"{segment}.{ext}")
+
+    # ---------- cross-process lock ----------
+
+    def _flock(self):
+        os.makedirs(self.path, exist_ok=True)
+        lock_file = open(self.lock_path, "a")
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    # ---------- manifest ----------
+
+    def _write_manifest(self, segments, next_segment):
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"segments": segments, "next": next_segment}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _current(self, force=False):
+        """
+        The view for the current MANIFEST, with new index lines of the
+        active segment loaded. Only this refresh runs under the lock;
+        callers read through the returned view without it.
+        """
+        with self._lock:
+            try:
+                st = os.stat(self.manifest_path)
+                key = (st.st_ino, st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                key = None
+
+            view = self._view
+            if force or key != view.key:
+                manifest = {"segments": [], "next": 1}
+                if key is not None:
+                    with open(self.manifest_path) as f:
+                        manifest = json.load(f)
+                view = _ShardView(self.path, key, manifest["segments"], manifest["next"])
+                for segment in view.segments:
+                    view.load_index(segment)
+                self._view = view
+            elif view.segments:
+                # only the newest segment is still being appended to
+                view.load_index(view.segments[-1])
+            return view
+
+    # ---------- reads ----------
+
+    def list_for_patient(self, pid):
+        for attempt in (0, 1):
+            try:
+                view = self._current(force=attempt == 1)
+                return [view.read(*location[:3]) for _, location in view.locations(pid)]
+            except FileNotFoundError:
+                # a compaction removed a segment under us: re-read the manifest once
+                if attempt:
+                    raise
+
+    def iter_all(self):
+        yielded = set()
+        for attempt in (0, 1, 2):
+            try:
+                view = self._current(force=attempt > 0)
+                for pid, (segment, offset, length, doc_id) in view.locations():
+                    if doc_id in yielded:
+                        continue
+                    doc_data = view.read(segment, offset, length)
+                    yielded.add(doc_id)
+                    yield pid, doc_data
+                return
+            except FileNotFoundError:
+                # compacted mid-iteration: carry on from the new manifest
+                if attempt == 2:
+                    raise
+
+    # ---------- writes ----------
+
+    def append(self, items):
+        """items: [(pid, doc_data)]; documents already stored are skipped."""
+        with self._flock():
+            view = self._current()
+
+            if not view.segments or os.path.getsize(view.file(view.segments[-1], "dat")) >= SEGMENT_ROLLOVER_BYTES:
+                segment = f"{view.next_segment:06d}"
+                open(self._file(segment, "dat"), "ab").close()
+                open(self._file(segment, "idx"), "ab").close()
+                self._write_manifest(view.segments + [segment], view.next_segment + 1)
+                view = self._current()
+
+            segment = view.segments[-1]
+            seen = set(view.doc_ids)
+            index_lines = []
+            with open(self._file(segment, "dat"), "ab") as dat:
+                for pid, doc_data in items:
+                    if doc_data["id"] in seen:
+                        continue
+                    seen.add(doc_data["id"])
+                    body = json.dumps(doc_data, separators=(",", ":")).encode("utf-8")
+                    offset = dat.tell()
+                    dat.write(body + b"\n")
+                    index_lines.append(json.dumps([pid, doc_data["id"], offset, len(body)]) + "\n")
+
+            # documents become visible only once the index line lands
+            if index_lines:
+                with open(self._file(segment, "idx"), "a") as idx:
+                    idx.write("".join(index_lines))
+            self._current()
+
+    def compact(self):
+        """Merge runs of small sealed segments; returns segments removed."""
+        with self._flock():
+            view = self._current(force=True)
+            sealed = view.segments[:-1]
+            sizes = {segment: os.path.getsize(self._file(segment, "dat")) for segment in sealed}
+
+            runs, run, run_size = [], [], 0
+            for segment in sealed:
+                if run and run_size + sizes[segment] > SEGMENT_TARGET_BYTES:
+                    runs.append(run)
+                    run, run_size = [], 0
+                run.append(segment)
+                run_size += sizes[segment]
+            runs.append(run)
+            runs = [run for run in runs if len(run) > 1]
+            if not runs:
+                return 0
+
+            segments, next_segment = list(view.segments), view.next_segment
+            for run in runs:
+                merged = f"{next_segment:06d}"
+                next_segment += 1
+                self._merge(run, merged)
+                position = segments.index(run[0])
+                segments[position:position + len(run)] = [merged]
+
+            self._write_manifest(segments, next_segment)
+            for run in runs:
+                for segment in run:
+                    os.remove(self._file(segment, "dat"))
+                    os.remove(self._file(segment, "idx"))
+            self._current(force=True)
+            return sum(len(run) - 1 for run in runs)
+
+    def _merge(self, run, merged):
+        dat_tmp = self._file(merged, "dat.tmp")
+        idx_tmp = self._file(merged, "idx.tmp")
+        with open(dat_tmp, "wb") as dat, open(idx_tmp, "w") as idx:
+            for segment in run:
+                with open(self._file(segment, "dat"), "rb") as src, open(self._file(segment, "idx")) as src_idx:
+                    for line in src_idx:
+                        if not line.endswith("\n"):
+                            break
+                        pid, doc_id, offset, length = json.loads(line)
+                        src.seek(offset)
+                        body = src.read(length)
+                        idx.write(json.dumps([pid, doc_id, dat.tell(), length]) + "\n")
+                        dat.write(body + b"\n")
+            dat.flush()
+            os.fsync(dat.fileno())
+            idx.flush()
+            os.fsync(idx.fileno())
+        os.replace(dat_tmp, self._file(merged, "dat"))
+        os.replace(idx_tmp, self._file(merged, "idx"))
+
+
+class SegmentDocumentStore(BaseDocumentStore):
+
+    def __init__(self, base_dir=LOCAL_FHIR_DIR):
+        self.root = os.path.join(base_dir, "segments")
+        self._shards = [
+            _SegmentShard(os.path.join(self.root, f"{n:02x}"))
+            for n in range(SEGMENT_SHARDS)
+        ]
+
+    def _shard(self, patient_fhir_id):
+        return self._shards[zlib.crc32(str(patient_fhir_id).encode("utf-8")) % SEGMENT_SHARDS]
+
+    def add(self, patient_fhir_id, doc_data):
+        self.add_many([(patient_fhir_id, doc_data)])
+
+    def add_many(self, items):
+        by_shard = {}
+        for patient_fhir_id, doc_data in items:
+            pid = str(patient_fhir_id)
+            by_shard.setdefault(self._shard(pid), []).append((pid, doc_data))
+        for shard, shard_items in by_shard.items():
+            shard.append(shard_items)
+
+    def list_for_patient(self, patient_fhir_id):
+        pid = str(patient_fhir_id)
+        return self._shard(pid).list_for_patient(pid)
+
+    def iter_all(self):
+        for shard in self._shards:
+            yield from shard.iter_all()
+
+    def compact(self):
+        return sum(shard.compact() for shard in self._shards)
+
+
+STORE_ENGINES = {
+    "segment": SegmentDocumentStore,
+    "sqlite": SQLiteDocumentStore,
+    "json": JSONIndexStore,
+}
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(engine=None):
+    """Return the shared store instance for the configured engine."""
+    engine = engine or getattr(settings, "FHIR_LOCAL_STORE", "sqlite")
+    with _stores_lock:
+        if engine not in _stores:
+            if engine not in STORE_ENGINES:
+                raise ValueError(f"Unknown FHIR local store engine: {engine}")
+            _stores[engine] = STORE_ENGINES[engine]()
+        return _stores[engine]
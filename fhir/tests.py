@@ -1,3 +1,1378 @@
-from django.test import TestCase
+import base64
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, quote, urlparse
 
-# Create your tests here.
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from access_control.grants import clear_local_grants
+from access_control.models import PatientAccess
+from accounts.models import UserProfile
+from doctor_app.models import Doctor
+from hospital_app.models import Hospital
+from laboratory.models import Laboratory
+from patients.models import Patient
+from records.models import Encounter, Observation, Report
+
+from . import export, outbox, paging, utils
+from .attachments import B64_DECODE_CHUNK, AttachmentCache
+from .blobs import BlobStore, referenced_digests
+from .bundle import Counter, iter_bundle
+from .backends import BackendUnavailable, CircuitBreaker
+from .client import FHIRClient
+from .documents import classify_document, documents_by_author, index_documents
+from .models import DocumentIndex, ExportJob, OutboxEntry
+from .paging import sign_cursor, unsign_cursor
+from .store import JSONIndexStore, SegmentDocumentStore, SQLiteDocumentStore
+from .transaction import BundleProcessor, TransactionFailed
+
+
+class _StandInFHIRHandler(BaseHTTPRequestHandler):
+    """Answers with the next queued status code (default 200)."""
+
+    protocol_version = "HTTP/1.1"
+
+    def _respond(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path))
+            server.client_ports.add(self.client_address[1])
+            status = server.statuses.pop(0) if server.statuses else 200
+
+        body = b'{"resourceType": "Bundle", "type": "searchset"}'
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class FHIRClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _StandInFHIRHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.client_ports = set()
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.client = FHIRClient(
+            f"http://127.0.0.1:{self.server.server_port}/fhir",
+            pool_size=2,
+            max_retries=2,
+            backoff_factor=0,
+        )
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_retries_on_5xx(self):
+        self.server.statuses = [503, 502]
+
+        response = self.client.get("get_document_references", "DocumentReference")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.requests), 3)
+        stats = self.client.metrics()["get_document_references"]
+        self.assertEqual(stats["calls"], 1)
+        self.assertEqual(stats["errors"], 0)
+
+    def test_retries_are_bounded(self):
+        self.server.statuses = [500, 500, 500, 500]
+
+        response = self.client.get("check_patient_exists", "Patient/1")
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.client.metrics()["check_patient_exists"]["errors"], 1)
+
+    def test_post_is_not_replayed_on_5xx(self):
+        self.server.statuses = [503]
+
+        response = self.client.post("create_fhir_patient", "Patient", json={})
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.client.metrics()["create_fhir_patient"]["errors"], 1)
+
+    def test_connections_are_reused(self):
+        for _ in range(5):
+            self.client.get("check_patient_exists", "Patient/1")
+
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(self.server.client_ports), 1)
+        self.assertEqual(self.client.metrics()["check_patient_exists"]["calls"], 5)
+
+    def test_connection_errors_are_counted(self):
+        port = self.server.server_port
+        self.server.shutdown()
+        self.server.server_close()
+        client = FHIRClient(f"http://127.0.0.1:{port}/fhir", max_retries=0)
+
+        with self.assertRaises(requests.ConnectionError):
+            client.get("get_document_references", "DocumentReference")
+
+        self.assertEqual(client.metrics()["get_document_references"]["errors"], 1)
+
+
+class FHIRCircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: self.now)
+
+    def test_opens_after_threshold_then_probes(self):
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+
+        # half-open: exactly one probe goes through
+        self.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.metrics()["state"], "open")
+
+        self.now = 20
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        metrics = self.breaker.metrics()
+        self.assertEqual((metrics["state"], metrics["opened"], metrics["probes"]), ("closed", 2, 2))
+
+    def test_client_fails_fast_while_open(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _StandInFHIRHandler)
+        server.lock = threading.Lock()
+        server.requests, server.client_ports, server.statuses = [], set(), [503, 503]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = FHIRClient(f"http://127.0.0.1:{server.server_port}/fhir", max_retries=0, breaker=self.breaker)
+
+        try:
+            for _ in range(2):
+                client.get("get_document_references", "DocumentReference")
+            with self.assertRaises(BackendUnavailable):
+                client.get("get_document_references", "DocumentReference")
+            self.assertEqual(len(server.requests), 2)
+
+            self.now = 10
+            self.assertEqual(client.get("get_document_references", "DocumentReference").status_code, 200)
+            self.assertEqual(self.breaker.metrics()["state"], "closed")
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+
+
+class FHIRQueryCountTests(TestCase):
+    """Every FHIR read endpoint runs a fixed number of queries."""
+
+    @classmethod
+    def setUpTestData(cls):
+        hospital = Hospital.objects.create(
+            name="City Hospital", location="Bengaluru", email="city@example.com", phone="1"
+        )
+        cls.patients = []
+        for i in range(3):
+            user = User.objects.create_user(f"patient{i}", password="pw")
+            cls.patients.append(Patient.objects.create(user=user, hospital=hospital))
+
+    def _add_rows(self, patient, encounters, observations_each):
+        for i in range(encounters):
+            encounter = Encounter.objects.create(patient=patient, reason=f"Visit {i}")
+            for j in range(observations_each):
+                Observation.objects.create(encounter=encounter, code="hr", value=str(60 + j))
+
+    def _get_json(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        if response.streaming:
+            return json.loads(b"".join(response.streaming_content))
+        return response.json()
+
+    def _assert_constant_queries(self, url, expected):
+        patient = self.patients[0]
+
+        for encounters, observations_each in ((1, 1), (10, 5)):
+            self._add_rows(patient, encounters, observations_each)
+            with self.assertNumQueries(expected):
+                self._get_json(url.format(patient_id=patient.id))
+
+    def test_patient(self):
+        self._assert_constant_queries("/fhir/Patient/{patient_id}/", 1)
+
+    # searches: the page alone (its validators come from its own rows)
+    def test_encounter_search(self):
+        self._assert_constant_queries("/fhir/Encounter/", 1)
+        self._assert_constant_queries("/fhir/Encounter/?patient={patient_id}", 1)
+
+    def test_observation_search(self):
+        self._assert_constant_queries("/fhir/Observation/", 1)
+        self._assert_constant_queries("/fhir/Observation/?patient={patient_id}", 1)
+
+    def test_search_runs_no_aggregate(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self._get_json("/fhir/Encounter/")
+        self.assertNotIn("COUNT(", ctx.captured_queries[0]["sql"].upper())
+
+    def test_medical_history(self):
+        self._assert_constant_queries("/fhir/medical-history/{patient_id}/", 3)
+
+    def test_patient_everything(self):
+        # session + user, then one query for the Patient + one per resource type
+        User.objects.create_user("admin", password="pw", is_staff=True)
+        self.client.login(username="admin", password="pw")
+        self._assert_constant_queries("/fhir/Patient/{patient_id}/$everything?_count=200", 8)
+
+    def _everything_pages(self, patient, count):
+        url, pages = f"/fhir/Patient/{patient.id}/$everything?_count={count}", []
+        while url:
+            bundle = self._get_json(url)
+            pages.append([e["resource"]["resourceType"] for e in bundle["entry"]])
+            url = next((urlparse(link["url"]).path + "?" + urlparse(link["url"]).query
+                        for link in bundle["link"] if link["relation"] == "next"), None)
+        return pages
+
+    def test_patient_everything_next_link_only_when_rows_follow(self):
+        User.objects.create_user("admin", password="pw", is_staff=True)
+        self.client.login(username="admin", password="pw")
+        patient = self.patients[2]
+        Encounter.objects.create(patient=patient, reason="Visit")
+
+        # Patient + Encounter fill the page exactly, and nothing follows
+        self.assertEqual(self._everything_pages(patient, 2), [["Patient", "Encounter"]])
+
+        # a later section's rows are reached across the boundary
+        Report.objects.create(patient=patient, title="CBC")
+        self.assertEqual(self._everything_pages(patient, 2),
+                         [["Patient", "Encounter"], ["DiagnosticReport"]])
+
+    def test_patient_everything_needs_access(self):
+        url = f"/fhir/Patient/{self.patients[0].id}/$everything"
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        self.client.login(username="patient1", password="pw")
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.login(username="patient0", password="pw")
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_diagnostic_reports_are_scoped_to_the_caller(self):
+        for patient in self.patients:
+            Report.objects.create(patient=patient, title=f"CBC {patient.id}")
+        self.assertEqual(self.client.get("/fhir/DiagnosticReport/").status_code, 302)
+
+        self.client.login(username="patient0", password="pw")
+        bundle = self._get_json("/fhir/DiagnosticReport/")
+        self.assertEqual([e["resource"]["subject"]["reference"] for e in bundle["entry"]],
+                         [f"Patient/{self.patients[0].id}"])
+        bundle = self._get_json(f"/fhir/DiagnosticReport/?patient={self.patients[1].id}")
+        self.assertEqual(bundle["entry"], [])
+
+    def test_observation_subject_comes_from_join(self):
+        patient = self.patients[1]
+        self._add_rows(patient, 2, 2)
+
+        bundle = self._get_json(f"/fhir/Observation/?patient={patient.id}")
+
+        self.assertEqual(len(bundle["entry"]), 4)
+        for entry in bundle["entry"]:
+            self.assertEqual(entry["resource"]["subject"]["reference"], f"Patient/{patient.id}")
+
+
+class FHIRConditionalReadTests(TestCase):
+    """Unchanged resources are answered with a 304 after one query."""
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("patient", password="pw")
+        cls.patient = Patient.objects.create(user=user)
+        encounter = Encounter.objects.create(patient=cls.patient, reason="Visit")
+        Observation.objects.create(encounter=encounter, code="hr", value="72")
+
+    def _assert_revalidates(self, url, change):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        change()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_patient_version(self):
+        response = self.client.get(f"/fhir/Patient/{self.patient.id}/")
+        self.assertEqual(response.json()["meta"]["versionId"], "1")
+
+        self.patient.save()
+
+        response = self.client.get(f"/fhir/Patient/{self.patient.id}/")
+        self.assertEqual(response.json()["meta"]["versionId"], "2")
+        self.assertEqual(response["ETag"], '"2"')
+
+    def test_patient_if_none_match(self):
+        self._assert_revalidates(f"/fhir/Patient/{self.patient.id}/", self.patient.save)
+
+    def test_patient_if_modified_since(self):
+        url = f"/fhir/Patient/{self.patient.id}/"
+        last_modified = self.client.get(url)["Last-Modified"]
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_search_if_none_match(self):
+        self._assert_revalidates(
+            f"/fhir/Observation/?patient={self.patient.id}",
+            lambda: Observation.objects.first().save()
+        )
+
+    def test_search_page_etag_sees_deletes(self):
+        encounter = Encounter.objects.get()
+        Observation.objects.create(encounter=encounter, code="bp", value="120")
+        self._assert_revalidates(
+            f"/fhir/Observation/?patient={self.patient.id}",
+            lambda: Observation.objects.last().delete()
+        )
+
+    def test_medical_history_if_none_match(self):
+        self._assert_revalidates(
+            f"/fhir/medical-history/{self.patient.id}/",
+            lambda: Observation.objects.first().delete()
+        )
+
+
+@override_settings(FHIR_CHANGE_FEED_LAG=0)
+class FHIRIncrementalSyncTests(TestCase):
+    """_since / _lastUpdated filters and the _sort=_lastUpdated change feed."""
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("patient", password="pw")
+        patient = Patient.objects.create(user=user)
+        cls.encounters = [Encounter.objects.create(patient=patient, reason=f"Visit {i}") for i in range(6)]
+
+        cls.old = timezone.now() - datetime.timedelta(days=3)
+        Encounter.objects.filter(id__in=[e.id for e in cls.encounters[:4]]).update(last_updated=cls.old)
+
+    def _ids(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        bundle = json.loads(b"".join(response.streaming_content))
+        next_urls = [link["url"] for link in bundle["link"] if link["relation"] == "next"]
+        return [int(entry["resource"]["id"]) for entry in bundle["entry"]], next_urls
+
+    def test_since_and_last_updated(self):
+        cutoff = (self.old + datetime.timedelta(days=1)).isoformat()
+        recent = [e.id for e in self.encounters[4:]]
+
+        self.assertEqual(self._ids(f"/fhir/Encounter/?_since={quote(cutoff)}")[0], recent)
+        self.assertEqual(self._ids(f"/fhir/Encounter/?_lastUpdated=gt{quote(cutoff)}")[0], recent)
+        self.assertEqual(len(self._ids(f"/fhir/Encounter/?_lastUpdated=le{quote(cutoff)}")[0]), 4)
+
+    def test_invalid_last_updated(self):
+        response = self.client.get("/fhir/Encounter/?_lastUpdated=gtyesterday")
+        self.assertEqual(response.status_code, 400)
+
+    def test_change_feed_order(self):
+        # touching a row moves it to the end of the feed
+        self.encounters[0].save()
+
+        seen, url = [], "/fhir/Encounter/?_sort=_lastUpdated&_count=4"
+        while url:
+            ids, next_urls = self._ids(url)
+            seen += ids
+            url = next_urls[0] if next_urls else None
+
+        expected = [e.id for e in self.encounters[1:4]] + [e.id for e in self.encounters[4:]] + [self.encounters[0].id]
+        self.assertEqual(seen, expected)
+
+    def test_change_feed_holds_back_unsettled_rows_by_default(self):
+        with override_settings():
+            del settings.FHIR_CHANGE_FEED_LAG
+            ids, _ = self._ids("/fhir/Encounter/?_sort=_lastUpdated")
+        self.assertEqual(ids, [e.id for e in self.encounters[:4]])
+
+    def test_change_feed_cursor_round_trip_and_tamper(self):
+        ids, next_urls = self._ids("/fhir/Encounter/?_sort=_lastUpdated&_count=3")
+        cursor = parse_qs(urlparse(next_urls[0]).query)["_cursor"][0]
+        self.assertEqual(unsign_cursor(cursor)["k"], ids[-1])
+
+        rest, _ = self._ids(f"/fhir/Encounter/?_sort=_lastUpdated&_count=3&_cursor={quote(cursor)}")
+        self.assertEqual(ids + rest, [e.id for e in self.encounters])
+
+        forged = sign_cursor({"t": "yesterday", "k": ids[-1]})
+        for bad in (cursor[:-1] + ("A" if cursor[-1] != "A" else "B"), forged):
+            response = self.client.get(f"/fhir/Encounter/?_sort=_lastUpdated&_cursor={quote(bad)}")
+            self.assertEqual(response.status_code, 400)
+
+
+class FHIRCursorTests(TestCase):
+    """Signed keyset cursors: next/previous round trips and tampering."""
+
+    @classmethod
+    def setUpTestData(cls):
+        patient = Patient.objects.create(user=User.objects.create_user("patient", password="pw"))
+        cls.encounters = [Encounter.objects.create(patient=patient, reason=f"Visit {i}") for i in range(5)]
+        cls.ids = [e.id for e in cls.encounters]
+
+    def _page(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        bundle = json.loads(b"".join(response.streaming_content))
+        links = {link["relation"]: link["url"] for link in bundle["link"]}
+        return [int(entry["resource"]["id"]) for entry in bundle["entry"]], links
+
+    def test_next_and_previous_round_trip(self):
+        pages, url = [], "/fhir/Encounter/?_count=2"
+        while url:
+            ids, links = self._page(url)
+            pages.append(ids)
+            url = links.get("next")
+        self.assertEqual(pages, [self.ids[0:2], self.ids[2:4], self.ids[4:]])
+
+        # walk back from the last page
+        ids, links = self._page(self._page("/fhir/Encounter/?_count=2")[1]["next"])
+        ids, links = self._page(self._page(links["next"])[1]["previous"])
+        self.assertEqual(ids, self.ids[2:4])
+        ids, links = self._page(links["previous"])
+        self.assertEqual(ids, self.ids[0:2])
+        self.assertNotIn("previous", links)
+
+    def test_cursor_keeps_other_parameters(self):
+        _, links = self._page("/fhir/Encounter/?_count=2&_elements=reasonCode")
+        query = parse_qs(urlparse(links["next"]).query)
+        self.assertEqual(query["_elements"], ["reasonCode"])
+        self.assertEqual(query["_count"], ["2"])
+        self.assertEqual(paging.decode_cursor(query["_cursor"][0]), ("n", self.ids[1]))
+
+    def test_tampered_cursors_are_rejected(self):
+        cursor = paging.encode_cursor("n", self.ids[1])
+        forged = [
+            cursor[:-1] + ("A" if cursor[-1] != "A" else "B"),       # bad signature
+            signing.dumps({"d": "n", "k": self.ids[1]}, salt="other"),  # wrong salt
+            sign_cursor({"d": "n", "k": "x"}),                        # bad key
+            sign_cursor({"k": self.ids[1]}),                          # no direction
+        ]
+        for bad in forged:
+            response = self.client.get(f"/fhir/Encounter/?_cursor={quote(bad)}")
+            self.assertEqual(response.status_code, 400, bad)
+            self.assertEqual(response.json()["resourceType"], "OperationOutcome")
+
+    def test_everything_cursor_section_is_checked(self):
+        User.objects.create_user("admin", password="pw", is_staff=True)
+        self.client.login(username="admin", password="pw")
+        url = f"/fhir/Patient/{self.encounters[0].patient_id}/$everything"
+        for data in ({"s": 99, "k": 0}, {"s": "x", "k": 0}):
+            response = self.client.get(url, {"_cursor": sign_cursor(data)})
+            self.assertEqual(response.status_code, 400)
+
+
+@override_settings(FHIR_BACKEND="hapi")
+class FHIROutboxTests(TestCase):
+
+    def _queue(self, n):
+        for i in range(n):
+            status, _ = outbox.submit_document_reference(
+                "p1", f"https://files.example/report{i}.pdf", "Lab report"
+            )
+            self.assertEqual(status, 202)
+
+    def test_batch_send_and_idempotency_keys(self):
+        self._queue(3)
+        sent = []
+
+        def fake_remote(items):
+            sent.append(items)
+            return [f"remote-{i}" for i in range(len(items))]
+
+        with mock.patch("fhir.utils._remote_add_document_references", side_effect=fake_remote):
+            self.assertEqual(outbox.send_batch(outbox.claim_batch()), 3)
+            self.assertEqual(outbox.claim_batch(), [])
+
+        self.assertEqual(len(sent), 1)
+        keys = {resource["identifier"][0]["value"] for _, resource in sent[0]}
+        expected = {f"urn:uuid:{key}" for key in OutboxEntry.objects.values_list("idempotency_key", flat=True)}
+        self.assertEqual(keys, expected)
+        self.assertEqual(OutboxEntry.objects.filter(status="synced").count(), 3)
+
+    def test_failed_send_is_retried_with_backoff(self):
+        self._queue(1)
+
+        with mock.patch("fhir.utils._remote_add_document_references", side_effect=RuntimeError("down")):
+            self.assertEqual(outbox.send_batch(outbox.claim_batch()), 0)
+
+        entry = OutboxEntry.objects.get()
+        self.assertEqual((entry.status, entry.attempts), ("pending", 1))
+        self.assertGreater(entry.next_attempt_at, timezone.now())
+        self.assertEqual(outbox.claim_batch(), [])
+
+        OutboxEntry.objects.update(next_attempt_at=timezone.now())
+        with mock.patch("fhir.utils._remote_add_document_references", return_value=["42"]):
+            self.assertEqual(outbox.send_batch(outbox.claim_batch()), 1)
+
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, entry.remote_id, entry.attempts), ("synced", "42", 2))
+
+    def test_open_breaker_defers_without_using_attempts(self):
+        self._queue(2)
+
+        with mock.patch("fhir.utils._remote_add_document_references",
+                        side_effect=BackendUnavailable("FHIR server circuit open")):
+            for _ in range(settings.FHIR_OUTBOX_MAX_ATTEMPTS + 1):
+                self.assertEqual(outbox.send_batch(outbox.claim_batch()), 0)
+                self.assertEqual(outbox.claim_batch(), [])     # waits for the breaker
+                OutboxEntry.objects.update(next_attempt_at=timezone.now())
+
+        self.assertEqual(
+            list(OutboxEntry.objects.values_list("status", "attempts")), [("pending", 0)] * 2
+        )
+
+    def test_remote_ids_from_absolute_locations(self):
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {"entry": [
+            {"response": {"status": "201 Created",
+                          "location": "https://fhir.example/fhir/DocumentReference/123/_history/1"}},
+            {"response": {"status": "400 Bad Request"}},
+        ]}
+
+        with mock.patch("fhir.utils.get_fhir_client") as client:
+            client.return_value.post.return_value = response
+            self.assertEqual(utils._remote_add_document_references([("p1", {}), ("p1", {})]), ["123", None])
+            # a response that does not line up with the request is an error
+            with self.assertRaises(RuntimeError):
+                utils._remote_add_document_references([("p1", {})])
+
+
+class FHIRElementsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("patient", password="pw")
+        cls.patient = Patient.objects.create(user=user)
+        for i in range(3):
+            Encounter.objects.create(patient=cls.patient, reason=f"Visit {i}")
+
+    def test_elements_selects_only_needed_columns(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get("/fhir/Encounter/?_elements=period")
+            bundle = json.loads(b"".join(response.streaming_content))
+
+        resource = bundle["entry"][0]["resource"]
+        self.assertEqual(set(resource), {"resourceType", "id", "meta", "period"})
+        self.assertEqual(resource["meta"]["tag"][0]["code"], "SUBSETTED")
+        page_sql = ctx.captured_queries[-1]["sql"]
+        self.assertIn("started_at", page_sql)
+        self.assertNotIn("reason", page_sql)
+
+    def test_summary_count(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(f"/fhir/Encounter/?patient={self.patient.id}&_summary=count")
+
+        self.assertEqual(json.loads(response.content), {"resourceType": "Bundle", "type": "searchset", "total": 3})
+        self.assertEqual(self.client.get("/fhir/Encounter/?_summary=text").status_code, 400)
+
+
+class FHIRAttachmentCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = AttachmentCache(base_dir=self.tmp.name, url_prefix="/media/", max_bytes=64 * 1024 * 1024)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _read(self, url):
+        with open(os.path.join(self.tmp.name, url[len("/media/"):]), "rb") as f:
+            return f.read()
+
+    def test_line_wrapped_data_over_one_chunk(self):
+        raw = os.urandom(B64_DECODE_CHUNK * 2)
+        url = self.cache.get_or_decode({"data": base64.encodebytes(raw).decode(), "title": "scan.pdf"})
+
+        self.assertTrue(url.endswith(".pdf"))
+        self.assertEqual(self._read(url), raw)
+
+    def test_supplied_hash_is_checked_not_trusted(self):
+        original, forged = b"real report", b"forged report"
+        sha1 = base64.b64encode(hashlib.sha1(original).digest()).decode()
+
+        url = self.cache.get_or_decode({"data": base64.b64encode(original).decode(), "hash": sha1})
+        with self.assertRaises(ValueError):
+            self.cache.get_or_decode({"data": base64.b64encode(forged).decode(), "hash": sha1})
+
+        self.assertEqual(self._read(url), original)
+        self.assertEqual(
+            self.cache.get_or_decode({"data": base64.b64encode(original).decode(), "hash": sha1}), url
+        )
+
+    def test_versioned_entries_are_keyed_without_hashing_the_data(self):
+        def entry(raw, version_id):
+            return {"resource": {"resourceType": "DocumentReference", "id": "7",
+                                 "meta": {"versionId": version_id},
+                                 "content": [{"attachment": {"data": base64.b64encode(raw).decode(),
+                                                             "title": "scan.pdf"}}]}}
+
+        with mock.patch("fhir.utils.get_attachment_cache", return_value=self.cache), \
+                mock.patch.object(self.cache, "_decode_to", wraps=self.cache._decode_to) as decoded, \
+                mock.patch("fhir.attachments.hashlib.sha256", wraps=hashlib.sha256) as sha256:
+            first = utils.save_fhir_attachment_locally(entry(b"report v1", "1"))
+            again = utils.save_fhir_attachment_locally(entry(b"report v1", "1"))
+            second = utils.save_fhir_attachment_locally(entry(b"report v2", "2"))
+
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, second)
+        self.assertEqual(decoded.call_count, 2)
+        self.assertEqual([c.args[0] for c in sha256.call_args_list],
+                         [f"version:DocumentReference/7/_history/{v}".encode() for v in "112"])
+        self.assertEqual(self._read(second), b"report v2")
+
+
+class FHIRBundleTests(TestCase):
+    """POST /fhir/ batch and transaction Bundles."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.patient = Patient.objects.create(user=User.objects.create_user("patient", password="pw"),
+                                             fhir_patient_id="MRN-1")
+        User.objects.create_user("admin", password="pw", is_staff=True)
+
+    @staticmethod
+    def _bundle(bundle_type, *entries):
+        return {"resourceType": "Bundle", "type": bundle_type, "entry": list(entries)}
+
+    @staticmethod
+    def _observation(encounter_reference, value="72"):
+        return {"resource": {"resourceType": "Observation", "code": {"text": "hr"},
+                             "valueString": value, "encounter": {"reference": encounter_reference}}}
+
+    def _encounter(self, subject=None, full_url=None):
+        entry = {"resource": {"resourceType": "Encounter", "reasonCode": [{"text": "Visit"}],
+                              "subject": {"reference": subject or f"Patient/{self.patient.id}"}}}
+        if full_url:
+            entry["fullUrl"] = full_url
+        return entry
+
+    @staticmethod
+    def _statuses(result):
+        return [entry["response"]["status"] for entry in result["entry"]]
+
+    def test_transaction_rolls_back(self):
+        bundle = self._bundle("transaction", self._encounter(), self._observation("Encounter/999999"))
+
+        with self.assertRaises(TransactionFailed):
+            BundleProcessor(bundle).process()
+
+        self.assertFalse(Encounter.objects.exists())
+
+    def test_batch_commits_good_entries(self):
+        encounter = Encounter.objects.create(patient=self.patient, reason="Visit")
+        result = BundleProcessor(self._bundle(
+            "batch",
+            self._observation(f"Encounter/{encounter.id}"),
+            self._observation("Encounter/999999"),
+            {"resource": {"resourceType": "Medication"}},
+        )).process()
+
+        self.assertEqual(self._statuses(result), ["201 Created", "400 Bad Request", "400 Bad Request"])
+        self.assertEqual(result["entry"][1]["response"]["outcome"]["issue"][0]["code"], "not-found")
+        self.assertEqual(Observation.objects.get().encounter, encounter)
+
+    def test_impossible_dates_fail_only_their_entry(self):
+        entries = [self._encounter() for _ in range(3)]
+        entries[1]["resource"]["period"] = {"start": "2024-02-30T10:00:00"}
+        entries[2]["resource"]["period"] = {"start": "2024-02-28", "end": "2024-02-30"}
+
+        result = BundleProcessor(self._bundle("batch", *entries)).process()
+
+        self.assertEqual(self._statuses(result), ["201 Created", "400 Bad Request", "400 Bad Request"])
+        self.assertEqual(result["entry"][1]["response"]["outcome"]["issue"][0]["diagnostics"],
+                         "period.start is not a valid dateTime")
+        self.assertEqual(result["entry"][2]["response"]["outcome"]["issue"][0]["diagnostics"],
+                         "period.end is not a valid dateTime")
+        self.assertEqual(Encounter.objects.count(), 1)
+
+    def test_urn_uuid_references(self):
+        result = BundleProcessor(self._bundle(
+            "transaction",
+            self._observation("urn:uuid:enc-1"),
+            self._encounter(subject="urn:uuid:pat-1", full_url="urn:uuid:enc-1"),
+            {"fullUrl": "urn:uuid:pat-1",
+             "resource": {"resourceType": "Patient", "name": [{"family": "Rao", "given": ["Asha"]}]}},
+        )).process()
+
+        observation_id = int(result["entry"][0]["response"]["location"].split("/")[1])
+        patient_id = int(result["entry"][2]["response"]["location"].split("/")[1])
+        observation = Observation.objects.select_related("encounter").get(id=observation_id)
+        self.assertEqual(observation.encounter.patient_id, patient_id)
+        self.assertEqual(Patient.objects.get(id=patient_id).user.last_name, "Rao")
+
+    def test_conditional_create(self):
+        existing = {"fullUrl": "urn:uuid:pat-1",
+                    "resource": {"resourceType": "Patient", "identifier": [{"value": "MRN-1"}]},
+                    "request": {"method": "POST", "url": "Patient", "ifNoneExist": "identifier=urn:mrn|MRN-1"}}
+        duplicate = {"resource": {"resourceType": "Patient", "identifier": [{"value": "MRN-1"}]}}
+
+        result = BundleProcessor(self._bundle(
+            "batch", existing, duplicate, self._encounter(subject="urn:uuid:pat-1")
+        )).process()
+
+        self.assertEqual(self._statuses(result), ["200 OK", "400 Bad Request", "201 Created"])
+        self.assertEqual(result["entry"][0]["response"]["location"], f"Patient/{self.patient.id}")
+        self.assertEqual(Patient.objects.count(), 1)
+        self.assertEqual(Encounter.objects.get().patient, self.patient)
+
+    def test_document_store_failure(self):
+        document = {"resource": {"resourceType": "DocumentReference",
+                                 "subject": {"reference": f"Patient/{self.patient.id}"},
+                                 "content": [{"attachment": {"url": "https://files.example/r.pdf"}}]}}
+        self.client.login(username="admin", password="pw")
+
+        with mock.patch("fhir.transaction.add_document_references", side_effect=RuntimeError("down")):
+            result = BundleProcessor(self._bundle("batch", self._encounter(), document)).process()
+            self.assertEqual(self._statuses(result), ["201 Created", "502 Bad Gateway"])
+
+            response = self.client.post("/fhir/", self._bundle("transaction", self._encounter(), document),
+                                        content_type="application/fhir+json")
+            self.assertEqual(response.status_code, 502)
+
+        self.assertEqual(Encounter.objects.count(), 1)
+
+    def test_transaction_documents_are_stored_all_or_nothing(self):
+        document = {"resource": {"resourceType": "DocumentReference",
+                                 "subject": {"reference": f"Patient/{self.patient.id}"},
+                                 "content": [{"attachment": {"url": "https://files.example/r.pdf"}}]}}
+
+        with mock.patch("fhir.utils.use_local_storage", return_value=False), \
+                mock.patch("fhir.utils.get_fhir_client") as client:
+            client.return_value.post.return_value = mock.Mock(status_code=400, text="second entry invalid")
+            with self.assertRaises(TransactionFailed):
+                BundleProcessor(self._bundle("transaction", self._encounter(), document, document)).process()
+
+        # the server applies a transaction Bundle whole or not at all
+        sent = client.return_value.post.call_args.kwargs["json"]
+        self.assertEqual((sent["type"], len(sent["entry"])), ("transaction", 2))
+        self.assertFalse(Encounter.objects.exists())
+
+    def test_doctor_needs_a_grant_on_every_patient(self):
+        cache.clear()
+        clear_local_grants()
+        hospital = Hospital.objects.create(name="H", location="L", email="h@example.com", phone="1")
+        doctor = Doctor.objects.create(user=User.objects.create_user("drbob", password="pw"), hospital=hospital,
+                                       specialization="x", contact_number="1", qualification="MBBS")
+        PatientAccess.objects.create(doctor=doctor, patient=self.patient, otp="123456", is_verified=True,
+                                     expires_at=timezone.now() + datetime.timedelta(minutes=10))
+        other = Patient.objects.create(user=User.objects.create_user("other", password="pw"),
+                                       fhir_patient_id="MRN-2")
+        visit = Encounter.objects.create(patient=other, reason="Visit")
+        match = {"fullUrl": "urn:uuid:pat-2",
+                 "resource": {"resourceType": "Patient", "identifier": [{"value": "MRN-2"}]},
+                 "request": {"method": "POST", "url": "Patient", "ifNoneExist": "identifier=MRN-2"}}
+        document = {"resource": {"resourceType": "DocumentReference",
+                                 "subject": {"reference": f"Patient/{other.id}"},
+                                 "content": [{"attachment": {"url": "https://files.example/r.pdf"}}]}}
+
+        with mock.patch("fhir.transaction.add_document_references") as stored:
+            result = BundleProcessor(self._bundle(
+                "batch",
+                self._encounter(),
+                self._encounter(subject=f"Patient/{other.id}"),
+                self._observation(f"Encounter/{visit.id}"),
+                document,
+                match,
+            ), user=doctor.user).process()
+
+        self.assertEqual(self._statuses(result), ["201 Created"] + ["403 Forbidden"] * 4)
+        self.assertEqual(result["entry"][1]["response"]["outcome"]["issue"][0]["code"], "forbidden")
+        self.assertEqual(list(Encounter.objects.filter(patient=other)), [visit])
+        self.assertFalse(Observation.objects.exists())
+        stored.assert_not_called()
+
+        with self.assertRaises(TransactionFailed):
+            BundleProcessor(self._bundle("transaction", match, self._encounter(subject="urn:uuid:pat-2")),
+                            user=doctor.user).process()
+
+    def test_laboratory_writes_only_for_its_hospital(self):
+        own, elsewhere = [
+            Hospital.objects.create(name=name, location="L", email=f"{name}@example.com", phone="1")
+            for name in ("own", "elsewhere")
+        ]
+        lab_user = User.objects.create_user("lab", password="pw")
+        UserProfile.objects.filter(user=lab_user).update(role="laboratory")
+        Laboratory.objects.create(user=lab_user, hospital=own, name="Lab")
+        Patient.objects.filter(id=self.patient.id).update(hospital=own)
+        stranger = Patient.objects.create(user=User.objects.create_user("stranger", password="pw"),
+                                          hospital=elsewhere)
+        self.client.login(username="lab", password="pw")
+
+        response = self.client.post("/fhir/", self._bundle(
+            "batch", self._encounter(), self._encounter(subject=f"Patient/{stranger.id}")
+        ), content_type="application/fhir+json")
+        self.assertEqual(self._statuses(response.json()), ["201 Created", "403 Forbidden"])
+
+        response = self.client.post("/fhir/", self._bundle(
+            "transaction", self._encounter(), self._encounter(subject=f"Patient/{stranger.id}")
+        ), content_type="application/fhir+json")
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()["issue"][0]["code"], "forbidden")
+
+        self.assertEqual(Encounter.objects.filter(patient=self.patient).count(), 1)
+        self.assertFalse(Encounter.objects.filter(patient=stranger).exists())
+
+
+class FHIRBlobStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = BlobStore(base_dir=os.path.join(self.tmp.name, "blobs"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _file(self, name, data):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_identical_uploads_are_stored_once(self):
+        first = self.store.put_file(self._file("a.pdf", b"report"), "application/pdf")
+        second = self.store.put_file(self._file("b.pdf", b"report"), "application/pdf")
+
+        self.assertEqual(first, second)
+        self.assertEqual(first, hashlib.sha256(b"report").hexdigest())
+        self.assertEqual(self.store.info(first), {"size": 6, "content_type": "application/pdf"})
+        self.assertEqual(len(os.listdir(os.path.dirname(self.store.path_for(first)))), 1)
+
+    def test_sweep_removes_only_old_unreferenced_blobs(self):
+        kept = self.store.put_file(self._file("a", b"kept"))
+        dropped = self.store.put_file(self._file("b", b"dropped"))
+        fresh = self.store.put_file(self._file("c", b"fresh"))
+        for digest in (kept, dropped):
+            os.utime(self.store.path_for(digest), (0, 0))
+
+        live = referenced_digests([
+            ("p1", {"content": [{"attachment": {"url": f"/fhir/Binary/{kept}/"}}]}),
+            ("p1", {"content": [{"attachment": {"url": "https://files.example/x.pdf"}}]}),
+        ])
+        self.assertEqual(self.store.sweep(live, grace=3600), (1, len(b"dropped")))
+
+        self.assertIsNone(self.store.info(dropped))
+        self.assertFalse(self.store.exists(dropped))
+        self.assertTrue(self.store.exists(kept))
+        self.assertTrue(self.store.exists(fresh))
+
+
+@mock.patch("fhir.store.SEGMENT_ROLLOVER_BYTES", 1)
+class FHIRSegmentStoreTests(SimpleTestCase):
+    # rolling over after every append leaves one segment per add_many()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = SegmentDocumentStore(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _doc(self, n):
+        return {"resourceType": "DocumentReference", "id": f"doc-{n}", "status": "current"}
+
+    def _fill(self, pid="p1", count=6):
+        for n in range(count):
+            self.store.add(pid, self._doc(n))
+
+    def test_append_and_read(self):
+        self._fill()
+        self.store.add("p1", self._doc(0))     # already stored: skipped
+        self.store.add("p2", self._doc(99))
+
+        self.assertEqual(
+            [d["id"] for d in self.store.list_for_patient("p1")],
+            [f"doc-{n}" for n in range(6)]
+        )
+        self.assertEqual(self.store.list_for_patient("p2"), [self._doc(99)])
+        self.assertEqual(self.store.list_for_patient("nobody"), [])
+
+        # a second handle on the tree (another process) sees the same documents
+        other = SegmentDocumentStore(self.tmp.name)
+        self.assertEqual(sorted(d["id"] for _, d in other.iter_all()),
+                         sorted([f"doc-{n}" for n in range(6)] + ["doc-99"]))
+
+    def test_compaction_keeps_documents_and_order(self):
+        self._fill()
+        shard = self.store._shard("p1")
+        before = len(shard._current().segments)
+
+        removed = self.store.compact()
+
+        self.assertEqual(removed, before - 2)     # sealed run merged into one
+        self.assertEqual(len(shard._current().segments), 2)
+        self.assertEqual(
+            [d["id"] for d in self.store.list_for_patient("p1")],
+            [f"doc-{n}" for n in range(6)]
+        )
+        self.assertEqual(self.store.compact(), 0)
+
+    def test_iteration_survives_compaction_by_another_process(self):
+        self._fill()
+        reader = SegmentDocumentStore(self.tmp.name)
+
+        docs = reader.iter_all()
+        first = next(docs)
+        # segments the reader has not mapped yet disappear under it
+        SegmentDocumentStore(self.tmp.name).compact()
+        rest = list(docs)
+
+        self.assertEqual([d["id"] for _, d in [first] + rest],
+                         [f"doc-{n}" for n in range(6)])
+
+    def test_concurrent_readers_during_writes_and_compaction(self):
+        self._fill(count=2)
+        errors, seen = [], []
+        done = threading.Event()
+
+        def read():
+            reader = SegmentDocumentStore(self.tmp.name)
+            last = 0
+            try:
+                while not done.is_set():
+                    ids = [d["id"] for d in reader.list_for_patient("p1")]
+                    # documents only ever appear, in append order
+                    self.assertGreaterEqual(len(ids), last)
+                    self.assertEqual(ids, [f"doc-{n}" for n in range(len(ids))])
+                    last = len(ids)
+                seen.append(last)
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for t in readers:
+            t.start()
+        for n in range(2, 30):
+            self.store.add("p1", self._doc(n))
+            if n % 5 == 0:
+                self.store.compact()
+        done.set()
+        for t in readers:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(seen), 4)
+        self.assertEqual(len(self.store.list_for_patient("p1")), 30)
+
+
+class FHIRExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user("exporter", password="pw", is_staff=True)
+        hospital = Hospital.objects.create(name="H", location="L", email="h@example.com", phone="1")
+        cls.patients = [
+            Patient.objects.create(user=User.objects.create_user(f"patient{i}", password="pw"), hospital=hospital)
+            for i in range(5)
+        ]
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        overridden = override_settings(FHIR_EXPORT_DIR=tmp.name, FHIR_EXPORT_PART_SIZE=2)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+    def _job(self, **kwargs):
+        return ExportJob.objects.create(requested_by=self.staff, request_url="/fhir/$export",
+                                        resource_types="Patient", **kwargs)
+
+    def _run(self):
+        job = export.claim_next_job()
+        export.run_export_job(job)
+        return job
+
+    def test_export_round_trip(self):
+        self.client.login(username="exporter", password="pw")
+        response = self.client.get("/fhir/$export", {"_type": "Patient"})
+        self.assertEqual(response.status_code, 202)
+        status_url = urlparse(response["Content-Location"]).path
+
+        self.assertEqual(self.client.get(status_url).status_code, 202)
+        self._run()
+
+        manifest = self.client.get(status_url).json()
+        self.assertEqual([item["count"] for item in manifest["output"]], [2, 2, 1])
+
+        ids = []
+        for item in manifest["output"]:
+            response = self.client.get(urlparse(item["url"]).path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Content-Type"], "application/gzip")
+            self.assertFalse(response.has_header("Content-Encoding"))
+            lines = gzip.decompress(b"".join(response.streaming_content)).decode().splitlines()
+            self.assertEqual(len(lines), item["count"])
+            ids += [json.loads(line)["resourceType"] for line in lines]
+        self.assertEqual(ids, ["Patient"] * 5)
+
+    def test_download_only_own_part_files(self):
+        job = self._job()
+        self._run()
+        url = f"/fhir/$export-file/{job.id}/{export.part_file_name('Patient', 0)}"
+
+        User.objects.create_user("other", password="pw", is_staff=True)
+        self.client.login(username="other", password="pw")
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.client.login(username="exporter", password="pw")
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.get(f"/fhir/$export-file/{job.id}/MANIFEST").status_code, 404)
+
+    def test_claim_is_exclusive_and_reclaims_stale_jobs(self):
+        job = self._job()
+
+        self.assertEqual(export.claim_next_job(), job)
+        self.assertIsNone(export.claim_next_job())      # in progress, heartbeat fresh
+
+        stale = timezone.now() - datetime.timedelta(seconds=3600)
+        ExportJob.objects.filter(pk=job.pk).update(updated_at=stale)
+        self.assertEqual(export.claim_next_job(), job)
+
+    def test_resumed_job_keeps_finished_parts(self):
+        job = self._job()
+        write_part = export._write_part
+        written = []
+
+        def crash_on_second_part(path, resources):
+            if written:
+                raise OSError("disk full")
+            written.append(path)
+            return write_part(path, resources)
+
+        with mock.patch("fhir.export._write_part", side_effect=crash_on_second_part):
+            with self.assertRaises(OSError), self.assertLogs("fhir.export", "ERROR"):
+                self._run()
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.progress["Patient"]["parts"], [2])
+
+        # as if the worker had died mid-job
+        stale = timezone.now() - datetime.timedelta(seconds=3600)
+        ExportJob.objects.filter(pk=job.pk).update(status="in-progress", updated_at=stale)
+        with mock.patch("fhir.export._write_part", side_effect=write_part) as resumed:
+            job = self._run()
+
+        self.assertEqual(resumed.call_count, 2)         # parts 1 and 2 only
+        self.assertEqual(job.status, "completed")
+        self.assertEqual(job.progress["Patient"]["parts"], [2, 2, 1])
+
+
+class FHIRStreamingBodyTests(SimpleTestCase):
+    """Streamed request/response bodies parse to the same JSON as built ones."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def _file(self, data):
+        path = os.path.join(self.tmp.name, "scan.pdf")
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    # 3-byte chunks, so most sizes span several chunks and end mid-group
+    @mock.patch("fhir.utils.B64_CHUNK_SIZE", 3)
+    def test_document_reference_body_matches_plain_json(self):
+        for data in (b"", b"x", b"%PDF-1.7", os.urandom(100)):
+            path = self._file(data)
+            body = utils.document_reference_body("p1", path, "Blood panel")
+
+            streamed = b"".join(body)
+            self.assertEqual(len(body), len(streamed))
+            self.assertEqual(b"".join(body), streamed)     # re-iterable for retries
+
+            expected = {
+                "resourceType": "DocumentReference",
+                "status": "current",
+                "type": {"text": "Medical Report"},
+                "category": [{"text": "Lab"}],
+                "subject": {"reference": "Patient/p1"},
+                "description": "Blood panel",
+                "author": [{"display": "Blood panel"}],
+                "content": [{"attachment": {
+                    "contentType": "application/pdf",
+                    "title": "scan.pdf",
+                    "data": base64.b64encode(data).decode(),
+                }}],
+            }
+            self.assertEqual(json.loads(streamed), expected)
+
+    @mock.patch("fhir.bundle.WRITE_BUFFER_SIZE", 64)
+    def test_streamed_bundle_matches_plain_json(self):
+        resources = [{"resourceType": "Encounter", "id": str(i), "when": timezone.now()} for i in range(20)]
+        counted = Counter(resources)
+
+        chunks = list(iter_bundle(counted, header={"meta": {"tag": "x"}},
+                                  trailer=lambda: {"total": counted.count}))
+
+        self.assertGreater(len(chunks), 1)
+        expected = json.loads(json.dumps({
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "meta": {"tag": "x"},
+            "entry": [{"resource": r} for r in resources],
+            "total": 20,
+        }, cls=DjangoJSONEncoder))
+        self.assertEqual(json.loads("".join(chunks)), expected)
+        self.assertEqual(json.loads("".join(iter_bundle([])))["entry"], [])
+
+
+@mock.patch("fhir.utils.reads_from_local", return_value=False)
+class FHIRFanoutTests(SimpleTestCase):
+    """get_document_references_many: concurrent loads under a deadline."""
+
+    def setUp(self):
+        caches["fhir"].clear()
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def _bundle(self, pid):
+        return {"resourceType": "Bundle", "id": pid}
+
+    def test_results_follow_the_requested_ids(self, _):
+        delays = {"a": 0.2, "b": 0.0, "c": 0.1}
+
+        def load(pid):
+            time.sleep(delays[pid])
+            return self._bundle(pid)
+
+        with mock.patch("fhir.utils._load_document_references", side_effect=load) as loaded:
+            results = utils.get_document_references_many(["a", "b", None, "a", "c"], deadline=5)
+
+        self.assertEqual(list(results), ["a", "b", "c"])
+        self.assertEqual(results, {pid: self._bundle(pid) for pid in "abc"})
+        self.assertEqual(loaded.call_count, 3)
+
+    def test_slow_and_failing_calls_come_back_empty(self, _):
+        def load(pid):
+            if pid == "slow":
+                self.release.wait(5)
+            if pid == "broken":
+                raise RuntimeError("boom")
+            return self._bundle(pid)
+
+        started = time.monotonic()
+        with mock.patch("fhir.utils._load_document_references", side_effect=load):
+            results = utils.get_document_references_many(["fast", "slow", "broken"], deadline=0.3)
+
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(results, {"fast": self._bundle("fast"), "slow": None, "broken": None})
+
+    def test_cached_bundles_are_not_fetched(self, _):
+        utils.bundle_cache.set("cached", self._bundle("cached"))
+
+        with mock.patch("fhir.utils._load_document_references", side_effect=self._bundle) as loaded:
+            results = utils.get_document_references_many(["cached", "other"])
+
+        self.assertEqual(results["cached"], self._bundle("cached"))
+        loaded.assert_called_once_with("other")
+
+
+@mock.patch("fhir.utils.use_local_storage", return_value=True)
+class FHIRBundleCacheTests(SimpleTestCase):
+    """DocumentReference bundles are cached until a write for the patient."""
+
+    def setUp(self):
+        caches["fhir"].clear()
+        self.bundles = {"p1": {"entry": ["v1"]}, "p2": {"entry": ["other"]}}
+        patcher = mock.patch("fhir.utils._local_get_document_references",
+                             side_effect=lambda pid: self.bundles[pid])
+        self.loaded = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_are_cached(self, _):
+        self.assertEqual(utils.get_document_references("p1"), {"entry": ["v1"]})
+        self.bundles["p1"] = {"entry": ["v2"]}
+        self.assertEqual(utils.get_document_references("p1"), {"entry": ["v1"]})
+        self.assertEqual(self.loaded.call_count, 1)
+
+    def test_upload_invalidates_only_that_patient(self, _):
+        utils.get_document_references("p1")
+        utils.get_document_references("p2")
+        self.bundles["p1"] = {"entry": ["v1", "v2"]}
+
+        with mock.patch("fhir.utils._local_upload_document_reference", return_value=(201, "")):
+            utils.upload_document_reference("p1", "/tmp/report.pdf")
+
+        self.assertEqual(utils.get_document_references("p1"), {"entry": ["v1", "v2"]})
+        utils.get_document_references("p2")
+        self.assertEqual(self.loaded.call_count, 3)
+
+    def test_failed_upload_keeps_the_cache(self, _):
+        utils.get_document_references("p1")
+        with mock.patch("fhir.utils._local_upload_document_reference", return_value=(500, "disk full")):
+            utils.upload_document_reference("p1", "/tmp/report.pdf")
+
+        utils.get_document_references("p1")
+        self.assertEqual(self.loaded.call_count, 1)
+
+    def test_batched_writes_invalidate(self, _):
+        utils.get_document_references("p1")
+        self.bundles["p1"] = {"entry": ["v1", "v2"]}
+
+        with mock.patch("fhir.utils.get_store"), mock.patch("fhir.utils.index_documents"):
+            utils.add_document_references([("p1", {"resourceType": "DocumentReference"})])
+
+        self.assertEqual(utils.get_document_references("p1"), {"entry": ["v1", "v2"]})
+
+    def test_created_patient_starts_uncached(self, _):
+        utils.bundle_cache.set("p1", {"entry": ["stale"]})
+        with mock.patch("fhir.utils._local_create_fhir_patient", return_value="p1"):
+            utils.create_fhir_patient("Jane", "p1")
+
+        self.assertEqual(utils.get_document_references("p1"), {"entry": ["v1"]})
+
+
+class FHIRDocumentIndexTests(TestCase):
+    """Category and author are indexed once, when a document is stored."""
+
+    @classmethod
+    def setUpTestData(cls):
+        hospital = Hospital.objects.create(name="H", location="L", email="h@example.com", phone="1")
+        cls.doctor = Doctor.objects.create(
+            user=User.objects.create_user("bob", password="pw", first_name="Bob", last_name="Stone"),
+            hospital=hospital, specialization="x", contact_number="1", qualification="MBBS"
+        )
+
+    def _doc(self, doc_id, description, author, category=None):
+        doc = {"resourceType": "DocumentReference", "id": doc_id, "description": description, "author": [author]}
+        if category:
+            doc["category"] = [{"text": category}]
+        return doc
+
+    def test_classify_document(self):
+        self.assertEqual(classify_document("Blood panel"), "Lab")
+        self.assertEqual(classify_document("Knee MRI"), "Radiology")
+        self.assertEqual(classify_document("Discharge summary"), "Document")
+        self.assertEqual(classify_document(None), "Document")
+
+    def test_index_documents(self):
+        docs = [
+            ("p1", self._doc("d1", "Blood panel", {"reference": f"Practitioner/{self.doctor.id}"})),
+            ("p1", self._doc("d2", "Notes", {"display": "Report uploaded by Dr. Bob Stone"}, category="Radiology")),
+            ("p2", self._doc("d3", "Xray", {"reference": "Practitioner/999999", "display": "someone"})),
+            ("p2", {"resourceType": "DocumentReference", "description": "no id"}),
+        ]
+
+        self.assertEqual(index_documents(docs), 3)
+        self.assertEqual(index_documents(docs[:1]), 1)      # already indexed: left alone
+
+        rows = {row.doc_id: row for row in DocumentIndex.objects.all()}
+        self.assertEqual(set(rows), {"d1", "d2", "d3"})
+        self.assertEqual((rows["d1"].category, rows["d1"].author_practitioner_id), ("Lab", self.doctor.id))
+        self.assertEqual((rows["d2"].category, rows["d2"].author_key), ("Radiology", "bob stone"))
+        self.assertIsNone(rows["d3"].author_practitioner_id)   # unknown practitioner
+
+        self.assertEqual(documents_by_author(self.doctor, ["p1", "p2"]), {"p1": {"d1", "d2"}})
+
+
+class FHIRLocalStoreTests(SimpleTestCase):
+    """The json, sqlite and segment engines and the migrate_fhir_local command."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def _doc(self, n):
+        return {"resourceType": "DocumentReference", "id": f"doc-{n}", "status": "current"}
+
+    def _round_trip(self, store):
+        store.add("p1", self._doc(1))
+        store.add_many([("p1", self._doc(2)), ("p2", self._doc(3))])
+
+        self.assertEqual(store.list_for_patient("p1"), [self._doc(1), self._doc(2)])
+        self.assertEqual(store.list_for_patient("p2"), [self._doc(3)])
+        self.assertEqual(store.list_for_patient("nobody"), [])
+        self.assertEqual(sorted((pid, d["id"]) for pid, d in store.iter_all()),
+                         [("p1", "doc-1"), ("p1", "doc-2"), ("p2", "doc-3")])
+
+    def test_json_round_trip(self):
+        self._round_trip(JSONIndexStore(self.tmp.name))
+
+    def test_sqlite_round_trip(self):
+        self._round_trip(SQLiteDocumentStore(self.tmp.name))
+
+    def test_sqlite_add_rejects_duplicates_add_many_skips_them(self):
+        store = SQLiteDocumentStore(self.tmp.name)
+        store.add("p1", self._doc(1))
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            store.add("p1", self._doc(1))
+        store.add_many([("p1", self._doc(1)), ("p1", self._doc(2))])
+
+        self.assertEqual([d["id"] for d in store.list_for_patient("p1")], ["doc-1", "doc-2"])
+
+    def test_json_add_many_skips_duplicates(self):
+        store = JSONIndexStore(self.tmp.name)
+        store.add_many([("p1", self._doc(1))])
+        store.add_many([("p1", self._doc(1)), ("p1", self._doc(2))])
+
+        self.assertEqual([d["id"] for d in store.list_for_patient("p1")], ["doc-1", "doc-2"])
+
+    def _migrate(self, source, target):
+        call_command("migrate_fhir_local", "--source", source, "--target", target,
+                     "--base-dir", self.tmp.name, "--batch-size", "2", stdout=io.StringIO())
+
+    def test_migrate_json_to_sqlite_is_idempotent(self):
+        docs = [("p1", self._doc(n)) for n in range(3)] + [("p2", self._doc(3))]
+        JSONIndexStore(self.tmp.name).add_many(docs)
+
+        self._migrate("json", "sqlite")
+        self._migrate("json", "sqlite")     # re-run copies nothing twice
+
+        target = SQLiteDocumentStore(self.tmp.name)
+        self.assertEqual(target.list_for_patient("p1"), [self._doc(n) for n in range(3)])
+        self.assertEqual(list(target.iter_all()), docs)
+
+    def test_migrate_json_to_sqlite_to_segment(self):
+        docs = [("p1", self._doc(n)) for n in range(3)] + [("p2", self._doc(3))]
+        JSONIndexStore(self.tmp.name).add_many(docs)
+
+        for source, target in (("json", "sqlite"), ("sqlite", "segment")):
+            self._migrate(source, target)
+            self._migrate(source, target)
+
+        segments = SegmentDocumentStore(self.tmp.name)
+        self.assertEqual(segments.list_for_patient("p1"), [self._doc(n) for n in range(3)])
+        self.assertEqual(sorted(d["id"] for _, d in segments.iter_all()), [f"doc-{n}" for n in range(4)])
@@ -0,0 +1,531 @@
+import datetime
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from access_control.grants import has_active_grant
+from accounts.models import UserProfile
+from doctor_app.dashboard_cache import bump_doctors
+from doctor_app.models import Doctor
+from laboratory.models import Laboratory
+from patients.models import Patient
+from patients.search import index_patients
+from records.models import Encounter, Observation
+
+from .utils import add_document_references
+
+# ============================================================
+# FHIR batch / transaction Bundles (POST /fhir/)
+# Entries are validated up front, referenced rows are looked up
+# with one query per type, and each resource type is then written
+# with a single bulk_create, all inside one DB transaction.
+#   transaction: all or nothing - the first bad entry rolls back
+#   batch:       bad entries get an error response, the rest commit
+# Patient entries may carry request.ifNoneExist "identifier=[system|]value"
+# (conditional create): a matching patient is returned with 200 OK
+# instead of being created again.
+# Every existing patient an entry touches (directly, through an
+# Encounter, or via a urn:uuid / conditional-create match) is checked
+# against the caller: doctors need a live grant, laboratories the
+# patient's hospital, staff may write for anyone. Patients created by
+# the same Bundle are the caller's own. Others fail with 403.
+# ============================================================
+
+# Types are written in this order, so entries can reference
+# resources created earlier in the same Bundle (urn:uuid fullUrls).
+PROCESSING_ORDER = ("Patient", "Encounter", "Observation", "DocumentReference")
+
+BULK_BATCH_SIZE = 1000
+
+FHIR_GENDERS = {
+    "male": "M",
+    "female": "F",
+    "other": "O",
+}
+
+
+class InvalidBundle(ValueError):
+    """The request body is not a Bundle we can process."""
+
+
+class EntryError(Exception):
+    """One Bundle entry was rejected."""
+
+    def __init__(self, message, status="400 Bad Request", code="invalid"):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+    @property
+    def status_code(self):
+        return int(self.status.split()[0])
+
+    def outcome(self):
+        return {
+            "resourceType": "OperationOutcome",
+            "issue": [{"severity": "error", "code": self.code, "diagnostics": str(self)}]
+        }
+
+
+class TransactionFailed(Exception):
+    """A transaction Bundle entry failed; nothing was written."""
+
+    def __init__(self, index, error):
+        super().__init__(f"entry[{index}]: {error}")
+        self.error = error
+
+
+def _text(concept):
+    """CodeableConcept -> text, falling back to the first coding."""
+    if not isinstance(concept, dict):
+        return None
+    if concept.get("text"):
+        return concept["text"]
+    for coding in concept.get("coding") or []:
+        if coding.get("display") or coding.get("code"):
+            return coding.get("display") or coding.get("code")
+    return None
+
+
+def _first(value):
+    """First element of a FHIR list field ({} when missing)."""
+    if isinstance(value, list) and value and isinstance(value[0], dict):
+        return value[0]
+    return {}
+
+
+def _datetime(value, field):
+    if value is None:
+        return None
+    try:
+        # well-formed but impossible values ("2024-02-30") raise ValueError
+        parsed = parse_datetime(value) if isinstance(value, str) else None
+        if parsed is None and isinstance(value, str) and parse_date(value):
+            parsed = datetime.datetime.combine(parse_date(value), datetime.time())
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise EntryError(f"{field} is not a valid dateTime")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _limited(value, field, max_length, required=True):
+    if value in (None, ""):
+        if required:
+            raise EntryError(f"{field} is required")
+        return None
+    value = str(value)
+    if len(value) > max_length:
+        raise EntryError(f"{field} is longer than {max_length} characters")
+    return value
+
+
+def _observation_value(resource):
+    """(value, unit) from the value[x] choices we can store."""
+    if "valueQuantity" in resource:
+        quantity = resource["valueQuantity"] or {}
+        return quantity.get("value"), quantity.get("unit") or quantity.get("code")
+    if "valueCodeableConcept" in resource:
+        return _text(resource["valueCodeableConcept"]), None
+    for key in ("valueString", "valueInteger", "valueDecimal", "valueBoolean"):
+        if key in resource:
+            return resource[key], None
+    return None, None
+
+
+def _reference_id(reference, resource_type):
+    """'Patient/12' -> 12 (None when the reference is another kind)."""
+    prefix = f"{resource_type}/"
+    if isinstance(reference, str) and reference.startswith(prefix):
+        value = reference[len(prefix):]
+        if value.isdigit():
+            return int(value)
+    return None
+
+
+class BundleProcessor:
+    """
+    Apply one batch or transaction Bundle.
+    process() returns the batch-response / transaction-response Bundle,
+    or raises TransactionFailed (transaction Bundles only).
+    `user` is the caller whose patient access is checked; None skips
+    the checks (management commands, tests).
+    """
+
+    def __init__(self, bundle, user=None):
+        if not isinstance(bundle, dict) or bundle.get("resourceType") != "Bundle":
+            raise InvalidBundle("Request body must be a FHIR Bundle")
+
+        self.type = bundle.get("type")
+        if self.type not in ("batch", "transaction"):
+            raise InvalidBundle("Bundle.type must be 'batch' or 'transaction'")
+
+        self.entries = bundle.get("entry") or []
+        if not isinstance(self.entries, list):
+            raise InvalidBundle("Bundle.entry must be a list")
+
+        max_entries = settings.FHIR_BUNDLE_MAX_ENTRIES
+        if len(self.entries) > max_entries:
+            raise InvalidBundle(f"Bundle has more than {max_entries} entries")
+
+        # per entry: (status, location) or EntryError
+        self.results = [None] * len(self.entries)
+        self.full_urls = {}
+        self.if_none_exist = {}         # entry index -> identifier value
+        self.created = {}               # entry index -> pk
+        self.patient_fhir_ids = {}      # Patient pk -> fhir_patient_id
+        self.user = user
+        self.new_patients = set()       # Patient pks created by this Bundle
+        self.access = {}                # Patient pk -> caller may write
+
+    # ---------- entry bookkeeping ----------
+
+    def _fail(self, index, error):
+        if self.type == "transaction":
+            raise TransactionFailed(index, error)
+        self.results[index] = error
+
+    def _created(self, index, resource_type, pk):
+        self.created[index] = pk
+        self.results[index] = ("201 Created", f"{resource_type}/{pk}")
+
+    def _check_entry(self, entry):
+        if not isinstance(entry, dict) or not isinstance(entry.get("resource"), dict):
+            raise EntryError("Entry has no resource")
+
+        resource = entry["resource"]
+        resource_type = resource.get("resourceType")
+        if resource_type not in PROCESSING_ORDER:
+            raise EntryError(f"Unsupported resourceType: {resource_type}", code="not-supported")
+
+        request = entry.get("request") or {}
+        if request.get("method", "POST").upper() != "POST":
+            raise EntryError("Only POST (create) entries are supported", code="not-supported")
+        if request.get("url", resource_type).split("?")[0] != resource_type:
+            raise EntryError("request.url must match the resourceType")
+
+        condition = request.get("ifNoneExist")
+        if condition:
+            if resource_type != "Patient" or not condition.startswith("identifier="):
+                raise EntryError("ifNoneExist is supported as Patient identifier=[system|]value only",
+                                 code="not-supported")
+            condition = condition[len("identifier="):].split("|")[-1]
+
+        return resource, condition or None
+
+    def _resolve(self, reference, resource_type, existing):
+        """Reference -> pk, either a row in `existing` or an entry created earlier."""
+        if not isinstance(reference, str) or not reference:
+            raise EntryError(f"Missing {resource_type} reference")
+
+        if reference in self.full_urls:
+            index = self.full_urls[reference]
+            resource = self.entries[index]["resource"]
+            if resource.get("resourceType") != resource_type:
+                raise EntryError(f"{reference} is not a {resource_type}")
+            if index not in self.created:
+                raise EntryError(f"Referenced entry {reference} was not created")
+            return self.created[index]
+
+        pk = _reference_id(reference, resource_type)
+        if pk is None or pk not in existing:
+            raise EntryError(f"{reference} not found", code="not-found")
+        return pk
+
+    def _check_access(self, patient_id):
+        """Raise a 403 EntryError unless the caller may write for the patient."""
+        if not self.restricted or patient_id in self.new_patients:
+            return patient_id
+
+        if patient_id not in self.access:
+            if self.doctor_id is not None:
+                allowed = has_active_grant(self.doctor_id, patient_id)
+            else:
+                allowed = self.lab_hospital_id is not None \
+                    and self.patient_hospitals.get(patient_id) == self.lab_hospital_id
+            self.access[patient_id] = allowed
+
+        if not self.access[patient_id]:
+            raise EntryError(f"No access to Patient/{patient_id}", status="403 Forbidden", code="forbidden")
+        return patient_id
+
+    # ---------- processing ----------
+
+    def process(self):
+        by_type = {resource_type: [] for resource_type in PROCESSING_ORDER}
+
+        for index, entry in enumerate(self.entries):
+            try:
+                resource, condition = self._check_entry(entry)
+            except EntryError as e:
+                self._fail(index, e)
+                continue
+            by_type[resource["resourceType"]].append((index, resource))
+            if condition:
+                self.if_none_exist[index] = condition
+            if entry.get("fullUrl"):
+                self.full_urls[entry["fullUrl"]] = index
+
+        self._load_caller()
+        self._load_existing(by_type)
+
+        with transaction.atomic():
+            self._create_patients(by_type["Patient"])
+            self._create_encounters(by_type["Encounter"])
+            self._create_observations(by_type["Observation"])
+            self._create_document_references(by_type["DocumentReference"])
+
+        return self.response_bundle()
+
+    def _load_caller(self):
+        self.restricted = self.user is not None and not self.user.is_staff
+        self.doctor_id = self.lab_hospital_id = None
+        if self.restricted:
+            self.doctor_id = Doctor.objects.filter(user=self.user).values_list("id", flat=True).first()
+            if self.doctor_id is None:
+                self.lab_hospital_id = Laboratory.objects.filter(
+                    user=self.user
+                ).values_list("hospital_id", flat=True).first()
+
+    def _load_existing(self, by_type):
+        """One query per referenced type for rows outside the Bundle."""
+        patient_ids, encounter_ids, doctor_ids, identifiers = set(), set(), set(), set()
+
+        for index, resource in by_type["Patient"]:
+            identifiers.add(_first(resource.get("identifier")).get("value"))
+            identifiers.add(self.if_none_exist.get(index))
+        for _, resource in by_type["Encounter"]:
+            patient_ids.add(_reference_id((resource.get("subject") or {}).get("reference"), "Patient"))
+            doctor_ids.add(_reference_id(
+                (_first(resource.get("participant")).get("individual") or {}).get("reference"), "Practitioner"
+            ))
+        for _, resource in by_type["Observation"]:
+            encounter_ids.add(_reference_id((resource.get("encounter") or {}).get("reference"), "Encounter"))
+            doctor_ids.add(_reference_id(_first(resource.get("performer")).get("reference"), "Practitioner"))
+        for _, resource in by_type["DocumentReference"]:
+            patient_ids.add(_reference_id((resource.get("subject") or {}).get("reference"), "Patient"))
+
+        patient_ids.discard(None)
+        encounter_ids.discard(None)
+        doctor_ids.discard(None)
+        identifiers.discard(None)
+
+        self.existing_patients = set()
+        if patient_ids:
+            for pk, fhir_patient_id in Patient.objects.filter(id__in=patient_ids).values_list("id", "fhir_patient_id"):
+                self.existing_patients.add(pk)
+                self.patient_fhir_ids[pk] = fhir_patient_id
+
+        # Encounter pk -> Patient pk, for existing and (later) created encounters
+        self.encounter_patients = dict(
+            Encounter.objects.filter(id__in=encounter_ids).values_list("id", "patient_id")
+        ) if encounter_ids else {}
+        self.existing_encounters = set(self.encounter_patients)
+
+        self.existing_doctors = set(
+            Doctor.objects.filter(id__in=doctor_ids).values_list("id", flat=True)
+        ) if doctor_ids else set()
+
+        # identifier -> Patient pk (None until created, for this Bundle's own)
+        self.taken_identifiers = dict(
+            Patient.objects.filter(fhir_patient_id__in=identifiers).values_list("fhir_patient_id", "id")
+        ) if identifiers else {}
+
+        # laboratories are checked against the hospital of every patient touched
+        self.patient_hospitals = {}
+        if self.lab_hospital_id is not None:
+            touched = self.existing_patients | set(self.encounter_patients.values()) \
+                | {pk for pk in self.taken_identifiers.values() if pk is not None}
+            self.patient_hospitals = dict(
+                Patient.objects.filter(id__in=touched).values_list("id", "hospital_id")
+            ) if touched else {}
+
+    def _doctor(self, reference):
+        if not reference:
+            return None
+        return self._resolve(reference, "Practitioner", self.existing_doctors)
+
+    def _create_patients(self, items):
+        rows, matched = [], []
+        for index, resource in items:
+            condition = self.if_none_exist.get(index)
+            if condition is not None and condition in self.taken_identifiers:
+                matched.append((index, condition))
+                continue
+
+            try:
+                name = _first(resource.get("name"))
+                given = " ".join(name.get("given") or [])
+                identifier = _limited(_first(resource.get("identifier")).get("value"), "identifier", 200, required=False)
+                if identifier is not None and identifier in self.taken_identifiers:
+                    raise EntryError(f"Patient identifier {identifier} already exists", code="duplicate")
+
+                user = User(
+                    username=f"fhir-{uuid.uuid4().hex[:12]}",
+                    first_name=(given or name.get("text") or "")[:150],
+                    last_name=(name.get("family") or "")[:150],
+                )
+                user.set_unusable_password()
+                patient = Patient(
+                    gender=FHIR_GENDERS.get(resource.get("gender"), "O"),
+                    fhir_patient_id=identifier,
+                )
+            except EntryError as e:
+                self._fail(index, e)
+                continue
+
+            if identifier is not None:
+                self.taken_identifiers[identifier] = None
+            rows.append((index, user, patient))
+
+        if rows:
+            self._bulk_create_patients(rows)
+
+        for index, identifier in matched:
+            pk = self.taken_identifiers[identifier]
+            try:
+                self._check_access(pk)
+            except EntryError as e:
+                self._fail(index, e)
+                continue
+            self.created[index] = pk
+            self.patient_fhir_ids[pk] = identifier
+            self.results[index] = ("200 OK", f"Patient/{pk}")
+
+    def _bulk_create_patients(self, rows):
+        # bulk_create skips signals, so create the profile the
+        # accounts post_save handler would have added
+        User.objects.bulk_create([user for _, user, _ in rows], batch_size=BULK_BATCH_SIZE)
+        UserProfile.objects.bulk_create(
+            [UserProfile(user=user, role="patient") for _, user, _ in rows], batch_size=BULK_BATCH_SIZE
+        )
+        for _, user, patient in rows:
+            patient.user = user
+        Patient.objects.bulk_create([patient for _, _, patient in rows], batch_size=BULK_BATCH_SIZE)
+        index_patients(patient for _, _, patient in rows)
+
+        for index, _, patient in rows:
+            self.patient_fhir_ids[patient.pk] = patient.fhir_patient_id
+            self.new_patients.add(patient.pk)
+            if patient.fhir_patient_id is not None:
+                self.taken_identifiers[patient.fhir_patient_id] = patient.pk
+            self._created(index, "Patient", patient.pk)
+
+    def _create_encounters(self, items):
+        rows = []
+        for index, resource in items:
+            try:
+                period = resource.get("period") or {}
+                encounter = Encounter(
+                    patient_id=self._check_access(self._resolve(
+                        (resource.get("subject") or {}).get("reference"), "Patient", self.existing_patients
+                    )),
+                    doctor_id=self._doctor(
+                        (_first(resource.get("participant")).get("individual") or {}).get("reference")
+                    ),
+                    reason=_limited(_text(_first(resource.get("reasonCode"))), "reasonCode", 255),
+                    started_at=_datetime(period.get("start"), "period.start") or timezone.now(),
+                    ended_at=_datetime(period.get("end"), "period.end"),
+                )
+            except EntryError as e:
+                self._fail(index, e)
+                continue
+            rows.append((index, encounter))
+
+        Encounter.objects.bulk_create([encounter for _, encounter in rows], batch_size=BULK_BATCH_SIZE)
+        bump_doctors(encounter.doctor_id for _, encounter in rows)
+        for index, encounter in rows:
+            self.encounter_patients[encounter.pk] = encounter.patient_id
+            self._created(index, "Encounter", encounter.pk)
+
+    def _create_observations(self, items):
+        rows = []
+        for index, resource in items:
+            try:
+                value, unit = _observation_value(resource)
+                encounter_id = self._resolve(
+                    (resource.get("encounter") or {}).get("reference"), "Encounter", self.existing_encounters
+                )
+                self._check_access(self.encounter_patients[encounter_id])
+                observation = Observation(
+                    encounter_id=encounter_id,
+                    doctor_id=self._doctor(_first(resource.get("performer")).get("reference")),
+                    code=_limited(_text(resource.get("code")), "code", 100),
+                    value=_limited(value, "value[x]", 100),
+                    unit=_limited(unit, "valueQuantity.unit", 20, required=False),
+                )
+            except EntryError as e:
+                self._fail(index, e)
+                continue
+            rows.append((index, observation))
+
+        Observation.objects.bulk_create([observation for _, observation in rows], batch_size=BULK_BATCH_SIZE)
+        for index, observation in rows:
+            self._created(index, "Observation", observation.pk)
+
+    def _create_document_references(self, items):
+        rows = []
+        for index, resource in items:
+            try:
+                patient_id = self._check_access(self._resolve(
+                    (resource.get("subject") or {}).get("reference"), "Patient", self.existing_patients
+                ))
+                patient_fhir_id = self.patient_fhir_ids.get(patient_id)
+                if not patient_fhir_id:
+                    raise EntryError(f"Patient/{patient_id} has no FHIR record for documents")
+            except EntryError as e:
+                self._fail(index, e)
+                continue
+
+            document = dict(resource, subject={"reference": f"Patient/{patient_fhir_id}"})
+            document.pop("id", None)    # ids are assigned by the store
+            rows.append((index, patient_fhir_id, document))
+
+        if not rows:
+            return
+
+        # Runs last inside the DB transaction, once every entry has
+        # validated. The store keeps no transaction of ours, so for a
+        # transaction Bundle the write is all-or-nothing: if it fails,
+        # no document was stored and the rows created above roll back.
+        # A batch reports the failure on its DocumentReference entries.
+        try:
+            ids = add_document_references(
+                [(pid, document) for _, pid, document in rows], atomic=self.type == "transaction"
+            )
+        except Exception as e:
+            print(f"[FHIR] Bundle DocumentReference write failed: {e}")
+            ids = [None] * len(rows)
+            error = EntryError(f"Document store write failed: {e}", status="502 Bad Gateway", code="exception")
+        else:
+            error = EntryError("Rejected by the document store", status="502 Bad Gateway", code="exception")
+
+        for (index, _, _), doc_id in zip(rows, ids):
+            if not doc_id:
+                self._fail(index, error)
+                continue
+            self.created[index] = doc_id
+            self.results[index] = ("201 Created", f"DocumentReference/{doc_id}")
+
+    # ---------- response ----------
+
+    def response_bundle(self):
+        entries = []
+        for result in self.results:
+            if isinstance(result, EntryError):
+                entries.append({"response": {"status": result.status, "outcome": result.outcome()}})
+            else:
+                status, location = result
+                entries.append({"response": {"status": status, "location": location}})
+
+        return {
+            "resourceType": "Bundle",
+            "type": f"{self.type}-response",
+            "entry": entries
+        }
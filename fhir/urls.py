@@ -4,9 +4,17 @@ from . import views
 app_name = 'fhir'
 
 urlpatterns = [
+    path('', views.fhir_bundle, name='fhir_bundle'),
     path('Patient/<int:patient_id>/', views.fhir_patient, name='fhir_patient'),
+    path('Patient/<int:patient_id>/$everything', views.fhir_patient_everything, name='fhir_patient_everything'),
+    path('$export', views.fhir_export, name='fhir_export'),
+    path('$export-status/<uuid:job_id>', views.fhir_export_status, name='fhir_export_status'),
+    path('$export-file/<uuid:job_id>/<str:file_name>', views.fhir_export_file, name='fhir_export_file'),
+    path('$metrics', views.fhir_metrics, name='fhir_metrics'),
     path('Encounter/', views.fhir_encounter, name='fhir_encounter'),
     path('Observation/', views.fhir_observation, name='fhir_observation'),
+    path('DiagnosticReport/', views.fhir_diagnostic_report, name='fhir_diagnostic_report'),
+    path('Binary/<str:digest>/', views.fhir_binary, name='fhir_binary'),
     path('medical-history/<int:patient_id>/', views.fhir_medical_history, name='fhir_medical_history'),
     path('records/<int:patient_id>/', views.view_patient_fhir_records, name='view_patient_fhir_records'),
     path('my-records/<int:patient_id>/', views.patient_view_fhir_records, name='patient_view_fhir_records'),  # ✅ Patient ke liye
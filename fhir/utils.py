@@ -1,21 +1,40 @@
-import requests
 import base64
 import os
 import json
+import re
+import time
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 from django.conf import settings
+from django.urls import reverse
+
+# Local storage paths + document store engines live in fhir/store.py
+from .store import LOCAL_PATIENTS_DIR, LOCAL_DOCUMENTS_DIR, get_store
+from .attachments import get_attachment_cache
+from .blobs import get_blob_store
+from .backends import reads_from_local, record_fallback, use_local_storage
+from .client import get_fhir_client
+from .cache import bundle_cache
+from .documents import classify_document, index_documents
 
 # ============================================================
-# Toggle this to switch between HAPI FHIR and Local Storage
-# Set USE_LOCAL_STORAGE = True if HAPI server is not running
+# HAPI FHIR vs. Local Storage is chosen by settings.FHIR_BACKEND
+# ("local" / "hapi"), switchable at runtime - see fhir/backends.py.
+# While the HAPI circuit breaker is open, reads come from the
+# local store.
 # ============================================================
-USE_LOCAL_STORAGE = True
-FHIR_BASE_URL = "http://localhost:8080/fhir"
 
-# Local storage paths
-LOCAL_FHIR_DIR = os.path.join(settings.MEDIA_ROOT, "fhir_local")
-LOCAL_PATIENTS_DIR = os.path.join(LOCAL_FHIR_DIR, "patients")
-LOCAL_DOCUMENTS_DIR = os.path.join(LOCAL_FHIR_DIR, "documents")
-LOCAL_INDEX_FILE = os.path.join(LOCAL_FHIR_DIR, "index.json")
+CONTENT_TYPE_MAP = {
+    "pdf": "application/pdf",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "json": "application/json"
+}
+
+# 3 raw bytes -> 4 base64 chars, so chunks must be a multiple of 3
+B64_CHUNK_SIZE = 3 * 256 * 1024  # 768 KB raw -> 1 MB encoded
 
 
 def _ensure_dirs():
@@ -24,29 +43,26 @@ def _ensure_dirs():
     os.makedirs(LOCAL_DOCUMENTS_DIR, exist_ok=True)
 
 
-def _load_index():
-    """Load the local document index."""
-    if os.path.exists(LOCAL_INDEX_FILE):
-        with open(LOCAL_INDEX_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-
-def _save_index(index):
-    """Save the local document index."""
-    _ensure_dirs()
-    with open(LOCAL_INDEX_FILE, "w") as f:
-        json.dump(index, f, indent=2)
+def _guess_content_type(file_name):
+    ext = file_name.split(".")[-1].lower()
+    return CONTENT_TYPE_MAP.get(ext, "application/octet-stream")
 
 
 # ============================================================
 # CREATE FHIR PATIENT
 # ============================================================
 def create_fhir_patient(patient_name, patient_identifier):
-    if USE_LOCAL_STORAGE:
-        return _local_create_fhir_patient(patient_name, patient_identifier)
+    if use_local_storage():
+        fhir_id = _local_create_fhir_patient(patient_name, patient_identifier)
+    else:
+        fhir_id = _remote_create_fhir_patient(patient_name, patient_identifier)
+
+    if fhir_id:
+        bundle_cache.invalidate(fhir_id)
+    return fhir_id
+
 
-    url = f"{FHIR_BASE_URL}/Patient"
+def _remote_create_fhir_patient(patient_name, patient_identifier):
     payload = {
         "resourceType": "Patient",
         "identifier": [{"value": str(patient_identifier)}],
@@ -54,7 +70,9 @@ def create_fhir_patient(patient_name, patient_identifier):
     }
     headers = {"Content-Type": "application/fhir+json"}
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=5)
+        response = get_fhir_client().post(
+            "create_fhir_patient", "Patient", json=payload, headers=headers
+        )
         if response.status_code in [200, 201]:
             return response.json().get("id")
     except Exception as e:
@@ -82,16 +100,20 @@ def _local_create_fhir_patient(patient_name, patient_identifier):
 # CHECK PATIENT EXISTS
 # ============================================================
 def check_patient_exists(patient_fhir_id):
-    if USE_LOCAL_STORAGE:
+    if use_local_storage():
         return _local_check_patient_exists(patient_fhir_id)
 
-    url = f"{FHIR_BASE_URL}/Patient/{patient_fhir_id}"
     try:
-        response = requests.get(url, timeout=5)
-        return response.status_code == 200
+        response = get_fhir_client().get(
+            "check_patient_exists", f"Patient/{patient_fhir_id}"
+        )
+        if response.status_code < 500:
+            return response.status_code == 200
     except Exception as e:
         print(f"[FHIR] check_patient_exists failed: {e}")
-        return False
+
+    record_fallback("check_patient_exists")
+    return _local_check_patient_exists(patient_fhir_id)
 
 
 def _local_check_patient_exists(patient_fhir_id):
@@ -103,12 +125,36 @@ def _local_check_patient_exists(patient_fhir_id):
 # GET DOCUMENT REFERENCES
 # ============================================================
 def get_document_references(patient_fhir_id):
-    if USE_LOCAL_STORAGE:
-        return _local_get_document_references(patient_fhir_id)
-
-    url = f"{FHIR_BASE_URL}/DocumentReference?subject=Patient/{patient_fhir_id}"
+    bundle = bundle_cache.get(patient_fhir_id)
+    if bundle is not None:
+        return bundle
+    return _load_document_references(patient_fhir_id)
+
+
+def _load_document_references(patient_fhir_id):
+    """Read the bundle from the backend (bypassing the cache) and cache it."""
+    if use_local_storage():
+        bundle = _local_get_document_references(patient_fhir_id)
+    else:
+        bundle = _remote_get_document_references(patient_fhir_id)
+        if bundle is None:
+            # HAPI failed or the breaker is open: serve what the local
+            # store holds, but never cache it over the real bundle
+            record_fallback("get_document_references")
+            return _local_get_document_references(patient_fhir_id)
+
+    if bundle is not None:
+        bundle_cache.set(patient_fhir_id, bundle)
+    return bundle
+
+
+def _remote_get_document_references(patient_fhir_id):
     try:
-        response = requests.get(url, timeout=5)
+        response = get_fhir_client().get(
+            "get_document_references",
+            "DocumentReference",
+            params={"subject": f"Patient/{patient_fhir_id}"}
+        )
         if response.status_code == 200:
             return response.json()
     except Exception as e:
@@ -117,16 +163,10 @@ def get_document_references(patient_fhir_id):
 
 
 def _local_get_document_references(patient_fhir_id):
-    index = _load_index()
-    patient_docs = index.get(str(patient_fhir_id), [])
-
-    entries = []
-    for doc_id in patient_docs:
-        doc_file = os.path.join(LOCAL_DOCUMENTS_DIR, f"{doc_id}.json")
-        if os.path.exists(doc_file):
-            with open(doc_file, "r") as f:
-                doc_data = json.load(f)
-            entries.append({"resource": doc_data})
+    entries = [
+        {"resource": doc_data}
+        for doc_data in get_store().list_for_patient(patient_fhir_id)
+    ]
 
     return {
         "resourceType": "Bundle",
@@ -135,93 +175,233 @@ def _local_get_document_references(patient_fhir_id):
     }
 
 
+# ============================================================
+# GET DOCUMENT REFERENCES FOR MANY PATIENTS (dashboard fan-out)
+# ============================================================
+_fanout_pool = None
+_fanout_pool_lock = threading.Lock()
+
+
+def _get_fanout_pool():
+    global _fanout_pool
+    with _fanout_pool_lock:
+        if _fanout_pool is None:
+            _fanout_pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, "FHIR_FANOUT_WORKERS", 8),
+                thread_name_prefix="fhir-fanout"
+            )
+        return _fanout_pool
+
+
+def get_document_references_many(patient_fhir_ids, deadline=None):
+    """
+    Fetch DocumentReference bundles for many patients at once.
+    Returns {patient_fhir_id: bundle or None}. Remote calls run
+    concurrently on a bounded thread pool; anything that fails or is
+    still running when `deadline` seconds pass comes back as None, so
+    callers always get partial results in about one round-trip.
+    """
+    patient_fhir_ids = list(dict.fromkeys(pid for pid in patient_fhir_ids if pid))
+
+    results = {pid: None for pid in patient_fhir_ids}
+    results.update(bundle_cache.get_many(patient_fhir_ids))
+    missing = [pid for pid in patient_fhir_ids if results[pid] is None]
+
+    if reads_from_local():
+        for pid in missing:
+            results[pid] = _load_document_references(pid)
+        return results
+
+    if deadline is None:
+        deadline = getattr(settings, "FHIR_FANOUT_DEADLINE", 6)
+
+    pool = _get_fanout_pool()
+    futures = {pool.submit(_load_document_references, pid): pid for pid in missing}
+    done, not_done = wait(futures, timeout=deadline)
+
+    for future in done:
+        try:
+            results[futures[future]] = future.result()
+        except Exception as e:
+            print(f"[FHIR] get_document_references_many failed for {futures[future]}: {e}")
+
+    for future in not_done:
+        future.cancel()
+    if not_done:
+        print(f"[FHIR] get_document_references_many: {len(not_done)} call(s) missed the {deadline}s deadline")
+
+    return results
+
+
 # ============================================================
 # UPLOAD DOCUMENT REFERENCE
 # ============================================================
-def upload_document_reference(patient_fhir_id, file_path, description="Uploaded Report"):
-    if USE_LOCAL_STORAGE:
-        return _local_upload_document_reference(patient_fhir_id, file_path, description)
+def upload_document_reference(patient_fhir_id, file_path, description="Uploaded Report", author=None):
+    """`author`: the uploading doctor_app.Doctor, recorded as Practitioner/<id>."""
+    if use_local_storage():
+        status, text = _local_upload_document_reference(patient_fhir_id, file_path, description, author)
+    else:
+        status, text = _remote_upload_document_reference(patient_fhir_id, file_path, description, author)
 
-    url = f"{FHIR_BASE_URL}/DocumentReference"
-    file_name = os.path.basename(file_path)
-    ext = file_name.split(".")[-1].lower()
+    if status in [200, 201]:
+        bundle_cache.invalidate(patient_fhir_id)
+    return status, text
 
-    content_type_map = {
-        "pdf": "application/pdf",
-        "jpg": "image/jpeg",
-        "jpeg": "image/jpeg",
-        "png": "image/png",
-        "json": "application/json"
-    }
-    content_type = content_type_map.get(ext, "application/octet-stream")
 
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded_data = base64.b64encode(file_data).decode("utf-8")
+def _remote_upload_document_reference(patient_fhir_id, file_path, description, author=None):
+    headers = {"Content-Type": "application/fhir+json"}
+    try:
+        body = document_reference_body(patient_fhir_id, file_path, description, author)
+        response = get_fhir_client().post(
+            "upload_document_reference",
+            "DocumentReference",
+            data=body,
+            headers=headers,
+            timeout=10
+        )
+        if response.status_code in [200, 201]:
+            _index_remote_document(patient_fhir_id, response)
+        return response.status_code, response.text
+    except Exception as e:
+        print(f"[FHIR] upload_document_reference failed: {e}")
+        return 500, str(e)
 
-    payload = {
+
+def _index_remote_document(patient_fhir_id, response):
+    try:
+        index_documents([(patient_fhir_id, response.json())])
+    except Exception as e:
+        print(f"[FHIR] indexing uploaded DocumentReference failed: {e}")
+
+
+def hosted_document_reference(patient_fhir_id, file_url, description, author=None):
+    """DocumentReference dict for a file that is already hosted (attachment.url)."""
+    file_name = os.path.basename(file_url.split("?")[0])
+    return {
         "resourceType": "DocumentReference",
         "status": "current",
         "type": {"text": "Medical Report"},
+        "category": [{"text": classify_document(description)}],
         "subject": {"reference": f"Patient/{patient_fhir_id}"},
         "description": description,
-        "content": [
-            {
-                "attachment": {
-                    "contentType": content_type,
-                    "title": file_name,
-                    "data": encoded_data
-                }
+        "author": document_author(author, description),
+        "content": [{
+            "attachment": {
+                "contentType": _guess_content_type(file_name),
+                "title": file_name,
+                "url": file_url
             }
-        ]
+        }]
     }
 
-    headers = {"Content-Type": "application/fhir+json"}
-    try:
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
-        return response.status_code, response.text
-    except Exception as e:
-        print(f"[FHIR] upload_document_reference failed: {e}")
-        return 500, str(e)
 
+def document_author(author, description):
+    """DocumentReference.author for an upload by `author` (a Doctor) or anonymous."""
+    if author is None:
+        return [{"display": description}]
+    return [{
+        "reference": f"Practitioner/{author.id}",
+        "display": author.user.username,
+    }]
 
-def _local_upload_document_reference(patient_fhir_id, file_path, description):
-    _ensure_dirs()
 
+class StreamingBody:
+    """
+    Request body built from a chunk generator but with a known length,
+    so requests sends a Content-Length instead of chunked encoding.
+    `make_chunks` is called on every iteration, so the body can be
+    re-sent if the connection has to be retried.
+    """
+
+    def __init__(self, make_chunks, length):
+        self.make_chunks = make_chunks
+        self.length = length
+
+    def __iter__(self):
+        return iter(self.make_chunks())
+
+    def __len__(self):
+        return self.length
+
+
+def _iter_base64_file(file_path):
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(B64_CHUNK_SIZE), b""):
+            yield base64.b64encode(chunk)
+
+
+def document_reference_body(patient_fhir_id, file_path, description, author=None):
+    """
+    DocumentReference JSON for upload to HAPI.
+    Local files are base64-encoded chunk by chunk inside the JSON
+    envelope, so memory use stays flat whatever the file size.
+    Hosted files (http/https) are sent as attachment.url.
+    """
     file_name = os.path.basename(file_path)
-    ext = file_name.split(".")[-1].lower()
 
-    content_type_map = {
-        "pdf": "application/pdf",
-        "jpg": "image/jpeg",
-        "jpeg": "image/jpeg",
-        "png": "image/png",
-        "json": "application/json"
+    attachment = {
+        "contentType": _guess_content_type(file_name),
+        "title": file_name,
     }
-    content_type = content_type_map.get(ext, "application/octet-stream")
 
-    # ✅ Save actual file into media/fhir_downloads/
-    download_dir = os.path.join(settings.MEDIA_ROOT, "fhir_downloads")
-    os.makedirs(download_dir, exist_ok=True)
-    dest_path = os.path.join(download_dir, file_name)
-    with open(file_path, "rb") as src, open(dest_path, "wb") as dst:
-        dst.write(src.read())
+    payload = {
+        "resourceType": "DocumentReference",
+        "status": "current",
+        "type": {"text": "Medical Report"},
+        "category": [{"text": classify_document(description)}],
+        "subject": {"reference": f"Patient/{patient_fhir_id}"},
+        "description": description,
+        "author": document_author(author, description),
+        "content": [{"attachment": attachment}]
+    }
+
+    if file_path.startswith(("http://", "https://")):
+        attachment["url"] = file_path
+        return json.dumps(payload).encode("utf-8")
+
+    # Split the envelope around a placeholder for attachment.data
+    marker = f"__data_{uuid.uuid4().hex}__"
+    attachment["data"] = marker
+    head, tail = json.dumps(payload).encode("utf-8").split(marker.encode("utf-8"))
+
+    file_size = os.path.getsize(file_path)
+    encoded_size = 4 * ((file_size + 2) // 3)
 
-    # ✅ Build file URL so doctor can view/download it
-    file_url = settings.MEDIA_URL + "fhir_downloads/" + file_name
+    def chunks():
+        yield head
+        yield from _iter_base64_file(file_path)
+        yield tail
 
-    # ✅ Generate a doc ID
-    import time
-    doc_id = f"{patient_fhir_id}_{int(time.time())}"
+    return StreamingBody(chunks, len(head) + encoded_size + len(tail))
+
+
+def _local_upload_document_reference(patient_fhir_id, file_path, description, author=None):
+    _ensure_dirs()
+
+    file_name = os.path.basename(file_path)
+    content_type = _guess_content_type(file_name)
+
+    # ✅ Store file once per content hash (streamed, deduplicated)
+    # and point the attachment at /fhir/Binary/<sha256>/
+    if file_path.startswith(("http://", "https://")):
+        # Already hosted (e.g. Cloudinary) - just reference it
+        file_url = file_path
+    else:
+        digest = get_blob_store().put_file(file_path, content_type)
+        file_url = reverse("fhir:fhir_binary", args=[digest])
+
+    # ✅ Generate a doc ID (unique even for uploads in the same second)
+    doc_id = new_document_id(patient_fhir_id)
 
     doc_data = {
         "resourceType": "DocumentReference",
         "id": doc_id,
         "status": "current",
         "type": {"text": "Medical Report"},
+        "category": [{"text": classify_document(description)}],
         "subject": {"reference": f"Patient/{patient_fhir_id}"},
         "description": description,
-        "author": [{"display": description}],
+        "author": document_author(author, description),
         "content": [
             {
                 "attachment": {
@@ -233,52 +413,126 @@ def _local_upload_document_reference(patient_fhir_id, file_path, description):
         ]
     }
 
-    # Save document JSON
-    doc_file = os.path.join(LOCAL_DOCUMENTS_DIR, f"{doc_id}.json")
-    with open(doc_file, "w") as f:
-        json.dump(doc_data, f, indent=2)
-
-    # Update index
-    index = _load_index()
-    pid = str(patient_fhir_id)
-    if pid not in index:
-        index[pid] = []
-    index[pid].append(doc_id)
-    _save_index(index)
+    # Save document (single atomic append in the configured store)
+    get_store().add(patient_fhir_id, doc_data)
+    index_documents([(patient_fhir_id, doc_data)])
 
     return 201, "Stored locally"
 
 
+def new_document_id(patient_fhir_id):
+    return f"{patient_fhir_id}_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+
+
+# ============================================================
+# ADD MANY DOCUMENT REFERENCES (Bundle ingest)
+# ============================================================
+def add_document_references(items, atomic=False):
+    """
+    Store many DocumentReference resources in one write.
+    items: list of (patient_fhir_id, resource). Returns the stored
+    ids in the same order (None for an entry the remote server
+    rejected). Raises if the backend fails the write as a whole.
+    atomic=True stores all of them or none: the remote server gets a
+    transaction Bundle instead of a batch (the local store writes
+    add_many in one go).
+    """
+    if use_local_storage():
+        _ensure_dirs()
+        ids = []
+        for patient_fhir_id, resource in items:
+            # a preset id (outbox retries) makes the write idempotent
+            resource.setdefault("id", new_document_id(patient_fhir_id))
+            ids.append(resource["id"])
+        get_store().add_many(items)
+    else:
+        if atomic:
+            ids = _remote_add_document_references(items, bundle_type="transaction")
+        else:
+            ids = _remote_add_document_references(items)
+        for (_, resource), doc_id in zip(items, ids):
+            if doc_id:
+                resource["id"] = doc_id
+
+    index_documents(items)
+
+    for patient_fhir_id in {pid for pid, _ in items}:
+        bundle_cache.invalidate(patient_fhir_id)
+    return ids
+
+
+# "DocumentReference/123/_history/1", relative or absolute -> "123"
+_LOCATION_ID = re.compile(r"(?:^|/)DocumentReference/([^/?#]+)")
+
+
+def _remote_add_document_references(items, bundle_type="batch"):
+    entries = []
+    for _, resource in items:
+        request = {"method": "POST", "url": "DocumentReference"}
+        identifier = (resource.get("identifier") or [{}])[0]
+        if identifier.get("value"):
+            # conditional create: a resend finds the first copy
+            request["ifNoneExist"] = f"identifier={identifier.get('system', '')}|{identifier['value']}"
+        entries.append({
+            "resource": {k: v for k, v in resource.items() if k != "id"},
+            "request": request
+        })
+
+    bundle = {
+        "resourceType": "Bundle",
+        "type": bundle_type,
+        "entry": entries
+    }
+    response = get_fhir_client().post(
+        "add_document_references",
+        "",
+        json=bundle,
+        headers={"Content-Type": "application/fhir+json"},
+        timeout=30
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"FHIR server answered {response.status_code}: {response.text[:200]}")
+
+    entries = response.json().get("entry", [])
+    if len(entries) != len(items):
+        raise RuntimeError(f"FHIR server answered {len(entries)} entries for {len(items)}")
+
+    # None for an entry the server rejected
+    ids = []
+    for entry in entries:
+        location = _LOCATION_ID.search(entry.get("response", {}).get("location") or "")
+        ids.append(location.group(1) if location else None)
+    return ids
+
+
 # ============================================================
 # SAVE FHIR ATTACHMENT LOCALLY (helper)
 # ============================================================
 def save_fhir_attachment_locally(entry):
     """
-    Takes one DocumentReference entry, extracts base64 attachment,
-    saves it into media/fhir_downloads/ and returns the file URL.
+    Takes one DocumentReference entry and returns a URL for its
+    attachment. Inline base64 data is decoded once into the
+    attachment cache (media/fhir_downloads/, keyed by resource id and
+    meta.versionId); later calls for the same version only stat() the
+    cached file.
     """
     try:
-        attachment = entry["resource"]["content"][0]["attachment"]
-        title = attachment.get("title", "report_file")
+        resource = entry["resource"]
+        attachment = resource["content"][0]["attachment"]
 
         # If it already has a URL, return it directly
         if attachment.get("url"):
             return attachment["url"]
 
-        encoded_data = attachment.get("data")
-        if not encoded_data:
+        if not attachment.get("data"):
             return None
 
-        decoded_file = base64.b64decode(encoded_data)
-        folder_path = os.path.join(settings.MEDIA_ROOT, "fhir_downloads")
-        os.makedirs(folder_path, exist_ok=True)
-
-        file_path = os.path.join(folder_path, title)
-        with open(file_path, "wb") as f:
-            f.write(decoded_file)
-
-        return settings.MEDIA_URL + "fhir_downloads/" + title
+        version = None
+        version_id = resource.get("meta", {}).get("versionId")
+        if resource.get("id") and version_id:
+            version = f"DocumentReference/{resource['id']}/_history/{version_id}"
+        return get_attachment_cache().get_or_decode(attachment, version)
 
     except Exception as e:
         print(f"[FHIR] save_fhir_attachment_locally failed: {e}")
-        return None
\ No newline at end of file
+        return None
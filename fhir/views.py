@@ -1,33 +1,98 @@
+import itertools
+import json
+import os
+
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, render, redirect
 from django.contrib import messages
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.urls import reverse
+from django.views.decorators.http import require_POST
 from django.utils import timezone
 
+from access_control.grants import can_read_patient, grant_required, readable_patient_ids
+from accounts.models import UserProfile
 from patients.models import Patient
-from records.models import Encounter, Observation
+from records.models import Encounter, Observation, Report
+
+from .backends import backend_metrics
+from .bundle import Counter, StreamingBundleResponse
+from .cache import bundle_cache
+from .client import get_fhir_client
+from .conditional import (
+    collection_etag,
+    collection_state,
+    not_modified,
+    page_validators,
+    resource_etag,
+    set_validators,
+)
+from .documents import author_keys, document_category, index_rows_for
+from .everything import EverythingPage
+from .export import EXPORT_TYPES, delete_export_files, export_dir, export_manifest
+from .models import ExportJob
+from .paging import (
+    ChangeFeedPage,
+    InvalidSearchParameter,
+    KeysetPage,
+    filter_last_updated,
+    is_change_feed,
+    parse_since,
+)
+from .serializers import (
+    diagnostic_report_serializer,
+    encounter_serializer,
+    observation_serializer,
+    parse_summary,
+    patient_serializer,
+    subset_for,
+)
+from .transaction import BundleProcessor, InvalidBundle, TransactionFailed
+from .utils import get_document_references
+
+
+# ─────────────────────────────────────────
+# Helper: FHIR error response
+# ─────────────────────────────────────────
+
+def operation_outcome(message, status=400, code="invalid"):
+    return JsonResponse({
+        "resourceType": "OperationOutcome",
+        "issue": [{
+            "severity": "error",
+            "code": code,
+            "diagnostics": message
+        }]
+    }, status=status)
 
 
 # ─────────────────────────────────────────
-# Helper: Fetch DocumentReference from FHIR server
+# FHIR batch / transaction Bundle
 # ─────────────────────────────────────────
 
-def get_document_references(fhir_patient_id):
-    import requests
-    from django.conf import settings
+@login_required
+@require_POST
+def fhir_bundle(request):
+
+    if not _can_write_bundles(request.user):
+        return operation_outcome("Bundle ingest requires a staff, doctor or laboratory account.", status=403, code="forbidden")
 
     try:
-        url = f"{settings.FHIR_SERVER_URL}/DocumentReference?patient={fhir_patient_id}"
-        response = requests.get(url, timeout=10)
+        bundle = json.loads(request.body)
+        result = BundleProcessor(bundle, user=request.user).process()
+    except (ValueError, InvalidBundle) as e:
+        return operation_outcome(str(e))
+    except TransactionFailed as e:
+        return operation_outcome(str(e), status=e.error.status_code, code=e.error.code)
 
-        if response.status_code == 200:
-            return response.json()
+    return JsonResponse(result)
 
-        return {}
 
-    except Exception as e:
-        print(f"[FHIR ERROR] get_document_references: {e}")
-        return {}
+def _can_write_bundles(user):
+    if user.is_staff:
+        return True
+    return UserProfile.objects.filter(user=user, role__in=("doctor", "laboratory")).exists()
 
 
 # ─────────────────────────────────────────
@@ -36,20 +101,192 @@ def get_document_references(fhir_patient_id):
 
 def fhir_patient(request, patient_id):
 
-    patient = get_object_or_404(Patient, id=patient_id)
+    try:
+        if parse_summary(request) == "count":
+            raise InvalidSearchParameter("_summary=count applies to searches only")
+        serializer = subset_for(request, patient_serializer)
+    except InvalidSearchParameter as e:
+        return operation_outcome(str(e))
+
+    row = serializer.rows(Patient.objects.filter(id=patient_id)).first()
+
+    if row is None:
+        raise Http404("Patient not found")
+
+    # the representation depends on _elements/_summary, so they are in the ETag
+    etag = resource_etag(row["version_id"])
+    if serializer is not patient_serializer:
+        etag = collection_etag(request.get_full_path(), row["version_id"])
+    response = not_modified(request, etag, row["last_updated"])
+    if response is not None:
+        return response
+
+    return set_validators(
+        JsonResponse(serializer.to_resource(row)),
+        etag,
+        row["last_updated"]
+    )
+
+
+# ─────────────────────────────────────────
+# FHIR Patient $everything
+# ─────────────────────────────────────────
+
+@login_required
+def fhir_patient_everything(request, patient_id):
+
+    if not can_read_patient(request.user, patient_id):
+        return operation_outcome("No access to this patient's records.", status=403, code="forbidden")
+
+    row = patient_serializer.rows(Patient.objects.filter(id=patient_id)).first()
+
+    if row is None:
+        raise Http404("Patient not found")
+
+    try:
+        if parse_summary(request) == "count":
+            raise InvalidSearchParameter("_summary=count is not supported by $everything")
+        page = EverythingPage(request, row, patient_serializer)
+    except InvalidSearchParameter as e:
+        return operation_outcome(str(e))
+
+    return StreamingBundleResponse(
+        page,
+        trailer=lambda: {"link": page.links()}
+    )
+
+
+# ─────────────────────────────────────────
+# FHIR Binary (content-addressed attachments)
+# ─────────────────────────────────────────
+
+@login_required
+def fhir_binary(request, digest):
+
+    from .blobs import get_blob_store
+
+    blob_store = get_blob_store()
+    info = blob_store.info(digest)
+
+    if not info or not blob_store.exists(digest):
+        raise Http404("Binary not found")
+
+    response = FileResponse(
+        open(blob_store.path_for(digest), "rb"),
+        content_type=info["content_type"]
+    )
+    # Content never changes for a given hash
+    response["Cache-Control"] = "private, max-age=31536000, immutable"
+    response["ETag"] = f'"{digest}"'
+    return response
+
+
+# ─────────────────────────────────────────
+# FHIR Bulk Data $export
+# Kick-off only records the job; `manage.py run_fhir_exports`
+# writes the files. Clients poll the status URL for the manifest.
+# ─────────────────────────────────────────
+
+def _export_job_for(request, job_id):
+    job = ExportJob.objects.filter(id=job_id).first()
+    if job is None or not (request.user.is_superuser or job.requested_by_id == request.user.id):
+        raise Http404("Export job not found")
+    return job
+
+
+@login_required
+def fhir_export(request):
+
+    if not request.user.is_staff:
+        return operation_outcome("Bulk export requires a staff account.", status=403, code="forbidden")
+
+    requested = request.GET.get("_type")
+    resource_types = requested.split(",") if requested else list(EXPORT_TYPES)
+    unknown = [t for t in resource_types if t not in EXPORT_TYPES]
+    if unknown:
+        return operation_outcome(f"Unsupported _type: {', '.join(unknown)}")
+
+    try:
+        since = parse_since(request)
+    except InvalidSearchParameter as e:
+        return operation_outcome(str(e))
+
+    job = ExportJob.objects.create(
+        requested_by=request.user,
+        request_url=request.build_absolute_uri(),
+        resource_types=",".join(dict.fromkeys(resource_types)),
+        since=since
+    )
+
+    response = HttpResponse(status=202)
+    response["Content-Location"] = request.build_absolute_uri(
+        reverse("fhir:fhir_export_status", args=[job.id])
+    )
+    return response
+
+
+@login_required
+def fhir_export_status(request, job_id):
+
+    job = _export_job_for(request, job_id)
 
-    data = {
-        "resourceType": "Patient",
-        "id": str(patient.id),
-        "name": [{
-            "use": "official",
-            "text": str(patient),
-        }],
-        "gender": getattr(patient, "gender", "unknown"),
-        "birthDate": str(patient.date_of_birth) if getattr(patient, "date_of_birth", None) else None,
-    }
+    if request.method == "DELETE":
+        delete_export_files(job)
+        job.delete()
+        return HttpResponse(status=202)
 
-    return JsonResponse(data)
+    if job.status == "failed":
+        return operation_outcome(job.error or "Export failed", status=500, code="exception")
+
+    if job.status != "completed":
+        done = sum(1 for t in job.type_list() if job.progress.get(t, {}).get("done"))
+        response = HttpResponse(status=202)
+        response["X-Progress"] = f"{job.status}: {done}/{len(job.type_list())} resource types"
+        response["Retry-After"] = "10"
+        return response
+
+    return JsonResponse(export_manifest(
+        job,
+        lambda name: request.build_absolute_uri(
+            reverse("fhir:fhir_export_file", args=[job.id, name])
+        )
+    ))
+
+
+@login_required
+def fhir_export_file(request, job_id, file_name):
+
+    job = _export_job_for(request, job_id)
+
+    # only the part files this job wrote - never a caller-supplied path
+    if job.status != "completed" or os.path.basename(file_name) != file_name \
+            or not file_name.endswith(".ndjson.gz"):
+        raise Http404("Export file not found")
+
+    path = os.path.join(export_dir(job), file_name)
+    if not os.path.exists(path):
+        raise Http404("Export file not found")
+
+    # served as the gzip file it is: with Content-Encoding: gzip, clients
+    # would transparently inflate it and save NDJSON under a .gz name
+    return FileResponse(open(path, "rb"), content_type="application/gzip", filename=file_name)
+
+
+# ─────────────────────────────────────────
+# Backend health (breaker state, HTTP + cache counters)
+# ─────────────────────────────────────────
+
+@login_required
+def fhir_metrics(request):
+
+    if not request.user.is_staff:
+        return operation_outcome("Metrics require a staff account.", status=403, code="forbidden")
+
+    return JsonResponse(dict(
+        backend_metrics(),
+        http=get_fhir_client().metrics(),
+        bundle_cache=bundle_cache.stats(),
+    ))
 
 
 # ─────────────────────────────────────────
@@ -65,30 +302,7 @@ def fhir_encounter(request):
     else:
         encounters = Encounter.objects.all()
 
-    entries = []
-
-    for enc in encounters:
-        entries.append({
-            "resource": {
-                "resourceType": "Encounter",
-                "id": str(enc.id),
-                "status": "finished",
-                "subject": {"reference": f"Patient/{enc.patient_id}"},
-                "period": {
-                    "start": str(enc.started_at) if enc.started_at else None,
-                },
-                "reasonCode": [{
-                    "text": enc.reason
-                }]
-            }
-        })
-
-    return JsonResponse({
-        "resourceType": "Bundle",
-        "type": "searchset",
-        "total": len(entries),
-        "entry": entries
-    })
+    return _search(request, encounter_serializer, encounters)
 
 
 # ─────────────────────────────────────────
@@ -104,27 +318,78 @@ def fhir_observation(request):
     else:
         observations = Observation.objects.all()
 
-    entries = []
-
-    for obs in observations:
-        entries.append({
-            "resource": {
-                "resourceType": "Observation",
-                "id": str(obs.id),
-                "status": "final",
-                "subject": {"reference": f"Patient/{obs.encounter.patient_id}"},
-                "code": {"text": obs.code},
-                "valueString": str(obs.value),
-                "effectiveDateTime": str(obs.recorded_at)
-            }
-        })
+    return _search(request, observation_serializer, observations)
 
-    return JsonResponse({
-        "resourceType": "Bundle",
-        "type": "searchset",
-        "total": len(entries),
-        "entry": entries
-    })
+
+# ─────────────────────────────────────────
+# FHIR DiagnosticReport
+# ─────────────────────────────────────────
+
+@login_required
+def fhir_diagnostic_report(request):
+
+    patient_id = request.GET.get("patient")
+
+    if patient_id:
+        reports = Report.objects.filter(patient_id=patient_id)
+    else:
+        reports = Report.objects.all()
+
+    # only patients the caller may read (their own, or granted to them)
+    readable = readable_patient_ids(request.user)
+    if readable is not None:
+        reports = reports.filter(patient_id__in=readable)
+
+    return _search(request, diagnostic_report_serializer, reports)
+
+
+# ─────────────────────────────────────────
+# Search helpers (paging, _since / _lastUpdated, 304s)
+# ─────────────────────────────────────────
+
+def _search(request, serializer, queryset):
+
+    try:
+        summary = parse_summary(request)
+        serializer = subset_for(request, serializer)
+        queryset = filter_last_updated(request, serializer.filter_since(queryset, parse_since(request)))
+
+        if is_change_feed(request):
+            page = ChangeFeedPage(request, serializer.rows(queryset))
+        else:
+            page = KeysetPage(request, serializer.rows(queryset))
+    except InvalidSearchParameter as e:
+        return operation_outcome(str(e))
+
+    if summary == "count":
+        # the total is the whole response, so count every match
+        count, last_modified = collection_state(queryset)
+        etag = collection_etag(request.get_full_path(), count, last_modified)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+        return set_validators(
+            JsonResponse({"resourceType": "Bundle", "type": "searchset", "total": count}),
+            etag,
+            last_modified
+        )
+
+    # The page is at most FHIR_MAX_PAGE_SIZE rows: read it up front so
+    # its validators cost no query beyond the page itself.
+    rows = list(page)
+    etag, last_modified = page_validators(rows, request.get_full_path(), page.has_more)
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+
+    return set_validators(
+        StreamingBundleResponse(
+            (serializer.to_resource(row) for row in rows),
+            trailer=lambda: {"link": page.links()}
+        ),
+        etag,
+        last_modified
+    )
 
 
 # ─────────────────────────────────────────
@@ -133,57 +398,75 @@ def fhir_observation(request):
 
 def fhir_medical_history(request, patient_id):
 
-    patient = get_object_or_404(Patient, id=patient_id)
+    try:
+        summary = parse_summary(request)
+    except InvalidSearchParameter as e:
+        return operation_outcome(str(e))
+
+    # Validators for the whole compartment come back with the patient
+    # row (subqueries), so a 304 costs this single query.
+    encounter_state = Encounter.objects.filter(patient=OuterRef("pk")).values("patient")
+    observation_state = Observation.objects.filter(encounter__patient=OuterRef("pk")).values("encounter__patient")
+
+    patient = get_object_or_404(
+        Patient.objects.select_related("user").annotate(
+            encounter_count=Subquery(encounter_state.annotate(n=Count("id")).values("n")),
+            encounter_updated=Subquery(encounter_state.annotate(m=Max("last_updated")).values("m")),
+            observation_count=Subquery(observation_state.annotate(n=Count("id")).values("n")),
+            observation_updated=Subquery(observation_state.annotate(m=Max("last_updated")).values("m")),
+        ),
+        id=patient_id
+    )
+
+    last_modified = max(
+        t for t in (patient.last_updated, patient.encounter_updated, patient.observation_updated) if t
+    )
+    etag = collection_etag(
+        request.get_full_path(), patient.id, patient.version_id,
+        patient.encounter_count, patient.encounter_updated,
+        patient.observation_count, patient.observation_updated,
+    )
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+
+    if summary == "count":
+        total = (patient.encounter_count or 0) + (patient.observation_count or 0)
+        return set_validators(
+            JsonResponse({"resourceType": "Bundle", "type": "searchset", "total": total}),
+            etag,
+            last_modified
+        )
 
     encounters = Encounter.objects.filter(patient=patient)
     observations = Observation.objects.filter(encounter__patient=patient)
 
-    entries = []
-
-    for enc in encounters:
-        entries.append({
-            "resource": {
-                "resourceType": "Encounter",
-                "id": str(enc.id),
-                "status": "finished",
-                "subject": {"reference": f"Patient/{patient.id}"},
-                "period": {
-                    "start": str(enc.started_at) if enc.started_at else None,
-                },
-                "reasonCode": [{"text": enc.reason}]
-            }
-        })
-
-    for obs in observations:
-        entries.append({
-            "resource": {
-                "resourceType": "Observation",
-                "id": str(obs.id),
-                "status": "final",
-                "subject": {"reference": f"Patient/{patient.id}"},
-                "code": {"text": obs.code},
-                "valueString": str(obs.value),
-                "effectiveDateTime": str(obs.recorded_at)
-            }
-        })
-
-    return JsonResponse({
-        "resourceType": "Bundle",
-        "type": "searchset",
-        "patient": {
-            "reference": f"Patient/{patient.id}",
-            "display": str(patient)
-        },
-        "total": len(entries),
-        "entry": entries
-    })
+    entries = Counter(itertools.chain(
+        subset_for(request, encounter_serializer).iter_resources(encounters),
+        subset_for(request, observation_serializer).iter_resources(observations),
+    ))
+
+    return set_validators(
+        StreamingBundleResponse(
+            entries,
+            header={
+                "patient": {
+                    "reference": f"Patient/{patient.id}",
+                    "display": str(patient)
+                }
+            },
+            trailer=lambda: {"total": entries.count}
+        ),
+        etag,
+        last_modified
+    )
 
 
 # ─────────────────────────────────────────
 # Build Records From FHIR Data
 # ─────────────────────────────────────────
 
-def _build_records(fhir_data, username=None):
+def _build_records(fhir_data, doctor=None):
 
     all_records = []
     my_records = []
@@ -192,6 +475,12 @@ def _build_records(fhir_data, username=None):
     if not fhir_data or "entry" not in fhir_data:
         return all_records, my_records, other_records
 
+    # category / author worked out at upload time (one query)
+    indexed = index_rows_for(
+        entry["resource"]["id"] for entry in fhir_data["entry"] if entry.get("resource", {}).get("id")
+    )
+    doctor_keys = author_keys(doctor.user) if doctor else set()
+
     for entry in fhir_data["entry"]:
 
         resource = entry.get("resource", {})
@@ -210,15 +499,15 @@ def _build_records(fhir_data, username=None):
             file_url = attachment.get("url")
             content_type = attachment.get("contentType", "N/A")
 
-        category = "Document"
+        index_row = indexed.get(resource.get("id"))
 
-        if "lab" in description.lower() or "blood" in description.lower():
-            category = "Lab"
-
-        elif "mri" in description.lower() or "xray" in description.lower():
-            category = "Radiology"
-
-        is_mine = username and author_name == username
+        if index_row:
+            category, practitioner_id, author_key = index_row
+            is_mine = bool(doctor) and (practitioner_id == doctor.id or author_key in doctor_keys)
+        else:
+            # not indexed (e.g. written straight to the FHIR server)
+            category = document_category(resource)
+            is_mine = bool(doctor) and author_name == doctor.user.username
 
         record = {
             "description": description,
@@ -244,23 +533,10 @@ def _build_records(fhir_data, username=None):
 # ─────────────────────────────────────────
 
 @login_required
+@grant_required(message="OTP verification required before viewing FHIR records.")
 def view_patient_fhir_records(request, patient_id):
 
-    from doctor_app.models import Doctor
-    from access_control.models import PatientAccess
-
-    doctor = get_object_or_404(Doctor, user=request.user)
-
-    access = PatientAccess.objects.filter(
-        doctor=doctor,
-        patient_id=patient_id,
-        is_verified=True,
-        expires_at__gt=timezone.now()
-    ).first()
-
-    if not access:
-        messages.error(request, "OTP verification required before viewing FHIR records.")
-        return redirect("doctor_app:doctor_dashboard")
+    doctor = request.doctor
 
     patient = get_object_or_404(Patient, id=patient_id)
 
@@ -272,7 +548,7 @@ def view_patient_fhir_records(request, patient_id):
 
             all_records, my_records, other_records = _build_records(
                 fhir_data,
-                doctor.user.username
+                doctor
             )
 
         except Exception as e:
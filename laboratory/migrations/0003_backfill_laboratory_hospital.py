@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+def backfill_hospital(apps, schema_editor):
+    """
+    Link each laboratory without a hospital to the hospital of the
+    patients it has uploaded reports for, when that is a single one.
+    Labs left unlinked cannot search or upload until an administrator
+    sets their hospital.
+    """
+    Laboratory = apps.get_model("laboratory", "Laboratory")
+    Report = apps.get_model("records", "Report")
+
+    for lab in Laboratory.objects.filter(hospital__isnull=True):
+        hospital_ids = list(
+            Report.objects.filter(laboratory=lab, patient__hospital__isnull=False)
+            .values_list("patient__hospital_id", flat=True).distinct()[:2]
+        )
+        if len(hospital_ids) == 1:
+            lab.hospital_id = hospital_ids[0]
+            lab.save(update_fields=["hospital"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('laboratory', '0002_laboratory_user_hospital'),
+        ('records', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_hospital, migrations.RunPython.noop),
+    ]
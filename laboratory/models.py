@@ -2,6 +2,19 @@ from django.db import models
 from django.contrib.auth.models import User
 
 class Laboratory(models.Model):
+    # login account + owning hospital (scopes the patient search)
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True
+    )
+    hospital = models.ForeignKey(
+        "hospital_app.Hospital",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True
+    )
     name = models.CharField(max_length=100)
     phone = models.CharField(max_length=15, null=True, blank=True)
     address = models.TextField(null=True, blank=True)
@@ -1,3 +1,58 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase
 
-# Create your tests here.
+from hospital_app.models import Hospital
+from patients.models import Patient
+from records.models import Report
+
+from .models import Laboratory
+
+
+class LabUploadScopeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.hospital = Hospital.objects.create(name="H", location="L", email="h@example.com", phone="1")
+        other = Hospital.objects.create(name="O", location="L", email="o@example.com", phone="2")
+
+        def patient(username, hospital):
+            return Patient.objects.create(user=User.objects.create_user(username, password="pw"), hospital=hospital)
+
+        cls.own = patient("own", cls.hospital)
+        cls.foreign = patient("foreign", other)
+        cls.unassigned = patient("unassigned", None)
+
+        cls.lab = Laboratory.objects.create(name="Lab", user=User.objects.create_user("lab", password="pw"),
+                                            hospital=cls.hospital)
+
+    def setUp(self):
+        self.client.login(username="lab", password="pw")
+
+    def _upload(self, patient):
+        return self.client.post("/lab/dashboard/", {
+            "patient": patient.id,
+            "title": "CBC",
+            "file": SimpleUploadedFile("cbc.pdf", b"%PDF", content_type="application/pdf"),
+        })
+
+    def test_upload_for_own_hospital_patient(self):
+        storage = Report._meta.get_field("file").storage
+        with mock.patch.object(storage, "save", return_value="reports/cbc.pdf"):
+            self.assertEqual(self._upload(self.own).status_code, 302)
+        self.assertEqual(Report.objects.get().patient, self.own)
+
+    def test_upload_outside_own_hospital_is_refused(self):
+        for patient in (self.foreign, self.unassigned):
+            self.assertContains(self._upload(patient), "Invalid patient selected")
+        self.assertFalse(Report.objects.exists())
+
+    def test_lab_without_hospital_cannot_upload(self):
+        Laboratory.objects.filter(id=self.lab.id).update(hospital=None)
+
+        # without the check, hospital_id=None would match unassigned patients
+        response = self._upload(self.unassigned)
+        self.assertContains(response, "not linked to a hospital", status_code=403)
+        self.assertFalse(Report.objects.exists())
+        self.assertEqual(self.client.get("/patients/search/", {"q": "un"}).status_code, 403)
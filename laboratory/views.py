@@ -4,6 +4,11 @@ from .models import Laboratory
 from records.models import Report
 from patients.models import Patient
 
+NO_HOSPITAL_ERROR = (
+    "This laboratory is not linked to a hospital yet. "
+    "Ask an administrator to set it before uploading reports."
+)
+
 
 @login_required
 def lab_dashboard(request):
@@ -16,6 +21,14 @@ def lab_dashboard(request):
     # ✅ Reports uploaded by this lab
     reports = Report.objects.filter(laboratory=lab)
 
+    # ✅ Uploads are scoped to the lab's hospital; an unlinked lab has none
+    if lab.hospital_id is None:
+        return render(request, 'laboratory/dashboard.html', {
+            'lab': lab,
+            'reports': reports,
+            'error': NO_HOSPITAL_ERROR
+        }, status=403 if request.method == "POST" else 200)
+
     # ✅ Handle report upload
     if request.method == "POST":
         patient_id = request.POST.get("patient")
@@ -23,12 +36,12 @@ def lab_dashboard(request):
         file = request.FILES.get("file")
 
         if patient_id and title and file:
+            # patients are picked with the typeahead, scoped to the lab's hospital
             try:
-                patient = Patient.objects.get(id=patient_id)
-            except Patient.DoesNotExist:
+                patient = Patient.objects.get(id=patient_id, hospital_id=lab.hospital_id)
+            except (Patient.DoesNotExist, ValueError):
                 return render(request, 'laboratory/dashboard.html', {
                     'lab': lab,
-                    'patients': Patient.objects.all(),
                     'reports': reports,
                     'error': 'Invalid patient selected'
                 })
@@ -42,10 +55,7 @@ def lab_dashboard(request):
 
             return redirect('lab_dashboard')
 
-    patients = Patient.objects.all()
-
     return render(request, 'laboratory/dashboard.html', {
         'lab': lab,
-        'patients': patients,
         'reports': reports
     })
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 class PatientsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'patients'
+
+    def ready(self):
+        import patients.signals
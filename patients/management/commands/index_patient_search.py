@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from patients.models import Patient
+from patients.search import index_patients
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the patient typeahead index. Saves keep it current; run "
+        "this after writes that skip signals (queryset.update, raw SQL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        size = options["batch_size"]
+
+        indexed, last_id = 0, 0
+        while True:
+            batch = list(
+                Patient.objects.filter(id__gt=last_id).select_related("user").order_by("id")[:size]
+            )
+            if not batch:
+                break
+            index_patients(batch)
+            indexed += len(batch)
+            last_id = batch[-1].id
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {indexed} patient(s) in {time.monotonic() - started:.2f}s"
+        ))
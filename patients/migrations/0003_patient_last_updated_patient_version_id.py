@@ -0,0 +1,24 @@
+# Generated by Django 5.1.7 on 2026-10-17 20:47
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0002_patient_profile_picture'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='last_updated',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='version_id',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-17 20:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0003_patient_last_updated_patient_version_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['last_updated', 'id'], name='patients_patient_lu_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.1.7 on 2026-10-17 21:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from patients.search import patient_terms
+
+
+def backfill_search_terms(apps, schema_editor):
+    """Index the patients that exist before the typeahead does."""
+    Patient = apps.get_model("patients", "Patient")
+    PatientSearchTerm = apps.get_model("patients", "PatientSearchTerm")
+
+    rows = []
+    for p in Patient.objects.select_related("user").iterator(chunk_size=1000):
+        words, grams = patient_terms(p.user.username, p.user.first_name, p.user.last_name,
+                                     p.phone_number, p.fhir_patient_id)
+        rows += [PatientSearchTerm(patient_id=p.id, hospital_id=p.hospital_id, kind="w", term=t) for t in words]
+        rows += [PatientSearchTerm(patient_id=p.id, hospital_id=p.hospital_id, kind="t", term=t) for t in grams]
+        if len(rows) >= 5000:
+            PatientSearchTerm.objects.bulk_create(rows)
+            rows = []
+    PatientSearchTerm.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital_app', '0001_initial'),
+        ('patients', '0004_patient_patients_patient_lu_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('w', 'Word'), ('t', 'Trigram')], max_length=1)),
+                ('term', models.CharField(max_length=150)),
+                ('hospital', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='hospital_app.hospital')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='patients.patient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['hospital', 'kind', 'term'], name='patients_search_term')],
+            },
+        ),
+        migrations.RunPython(backfill_search_terms, migrations.RunPython.noop),
+    ]
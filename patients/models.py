@@ -2,7 +2,9 @@ from django.db import models
 from django.contrib.auth.models import User
 from cloudinary.models import CloudinaryField
 
-class Patient(models.Model):
+from fhir.models import VersionedResource
+
+class Patient(VersionedResource):
     GENDER_CHOICES = [
         ('M', 'Male'),
         ('F', 'Female'),
@@ -70,3 +72,39 @@ class Appointment(models.Model):
 
     def __str__(self):
         return f"{self.patient.user.username} → {self.doctor.user.username} ({self.date})"
+
+
+class PatientSearchTerm(models.Model):
+    """
+    Typeahead index (see patients/search.py): lowercased whole words
+    (username, names, phone, FHIR id) for prefix matches, plus their
+    trigrams for infix matches, stored per hospital.
+    """
+    WORD = "w"
+    TRIGRAM = "t"
+    KIND_CHOICES = (
+        (WORD, "Word"),
+        (TRIGRAM, "Trigram"),
+    )
+
+    patient = models.ForeignKey(
+        Patient,
+        on_delete=models.CASCADE,
+        related_name="search_terms"
+    )
+    hospital = models.ForeignKey(
+        "hospital_app.Hospital",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True
+    )
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    term = models.CharField(max_length=150)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["hospital", "kind", "term"], name="patients_search_term"),
+        ]
+
+    def __str__(self):
+        return f"{self.term} -> {self.patient_id}"
@@ -0,0 +1,121 @@
+from django.db.models import Count
+
+from .models import Patient, PatientSearchTerm
+
+# ============================================================
+# Patient typeahead search
+# Each patient's searchable values are written to
+# PatientSearchTerm when the patient (or its user) is saved:
+#   words     username, first/last/full name, phone, FHIR id
+#             -> prefix match as one (hospital, kind, term) range scan
+#   trigrams  3-letter slices of the name/phone words
+#             -> infix match ("ohn" finds "john")
+# Results are scoped to one hospital and capped at `limit`, so a
+# lookup costs the same however many patients exist.
+# ============================================================
+SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 25
+MIN_QUERY_LENGTH = 2
+MAX_TERM_LENGTH = 150
+
+
+def normalize(value):
+    return " ".join(str(value or "").lower().split())[:MAX_TERM_LENGTH]
+
+
+def trigrams(word):
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+def patient_terms(username, first_name, last_name, phone_number, fhir_patient_id):
+    """(words, trigrams) for one patient's searchable values."""
+    names = [normalize(username), normalize(first_name), normalize(last_name), normalize(phone_number)]
+    words = set(names)
+    words.add(normalize(f"{first_name} {last_name}"))
+    words.add(normalize(fhir_patient_id))
+    words.discard("")
+
+    grams = set()
+    for value in names:
+        for word in value.split():
+            grams |= trigrams(word)
+    return words, grams
+
+
+def _term_rows(patient_id, hospital_id, username, first_name, last_name, phone_number, fhir_patient_id):
+    words, grams = patient_terms(username, first_name, last_name, phone_number, fhir_patient_id)
+    return [
+        PatientSearchTerm(patient_id=patient_id, hospital_id=hospital_id, kind=kind, term=term)
+        for kind, terms in ((PatientSearchTerm.WORD, words), (PatientSearchTerm.TRIGRAM, grams))
+        for term in terms
+    ]
+
+
+def index_patients(patients):
+    """(Re)write the search terms of `patients` (with .user loaded)."""
+    patients = list(patients)
+    rows = []
+    for p in patients:
+        rows += _term_rows(p.id, p.hospital_id, p.user.username, p.user.first_name,
+                           p.user.last_name, p.phone_number, p.fhir_patient_id)
+
+    PatientSearchTerm.objects.filter(patient_id__in=[p.id for p in patients]).delete()
+    PatientSearchTerm.objects.bulk_create(rows, batch_size=1000)
+
+
+def _prefix_range(q):
+    """[q, next string after every q-prefixed one) - an index range scan."""
+    return {"term__gte": q, "term__lt": q[:-1] + chr(ord(q[-1]) + 1), "term__startswith": q}
+
+
+def search_patients(query, hospital, limit=SEARCH_LIMIT):
+    """Up to `limit` patients of `hospital` matching `query`; prefix matches first."""
+    q = normalize(query)
+    limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+    if len(q) < MIN_QUERY_LENGTH or hospital is None:
+        return []
+
+    terms = PatientSearchTerm.objects.filter(hospital=hospital)
+
+    ids = list(dict.fromkeys(
+        terms.filter(kind=PatientSearchTerm.WORD, **_prefix_range(q))
+        .order_by("term").values_list("patient_id", flat=True)[:limit * 4]
+    ))[:limit]
+
+    grams = set()
+    for word in q.split():
+        grams |= trigrams(word)
+
+    candidates = []
+    if grams and len(ids) < limit:
+        # every trigram of the query present; checked for adjacency below
+        candidates = list(
+            terms.filter(kind=PatientSearchTerm.TRIGRAM, term__in=grams)
+            .exclude(patient_id__in=ids)
+            .values("patient_id")
+            .annotate(hits=Count("term", distinct=True))
+            .filter(hits=len(grams))
+            .values_list("patient_id", flat=True)[:limit * 2]
+        )
+
+    patients = Patient.objects.filter(id__in=ids + candidates).select_related("user").in_bulk()
+
+    results = [patients[pid] for pid in ids if pid in patients]
+    for pid in candidates:
+        if len(results) == limit:
+            break
+        p = patients.get(pid)
+        haystack = (p.user.username, p.user.get_full_name(), p.phone_number) if p else ()
+        if any(q in normalize(value) for value in haystack):
+            results.append(p)
+    return results
+
+
+def patient_result(patient):
+    """JSON shape of one typeahead result."""
+    return {
+        "id": patient.id,
+        "username": patient.user.username,
+        "name": patient.user.get_full_name(),
+        "fhir_patient_id": patient.fhir_patient_id,
+    }
@@ -0,0 +1,31 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import Patient
+from .search import index_patients
+
+SEARCHABLE_PATIENT_FIELDS = {"user", "hospital", "phone_number", "fhir_patient_id"}
+SEARCHABLE_USER_FIELDS = {"username", "first_name", "last_name"}
+
+
+def _touches(update_fields, searchable):
+    return update_fields is None or bool(searchable & set(update_fields))
+
+
+# Keep the typeahead index in step with the searchable fields.
+# Patients written with bulk_create must be indexed explicitly.
+@receiver(post_save, sender=Patient)
+def index_patient_search_terms(sender, instance, update_fields=None, **kwargs):
+    if _touches(update_fields, SEARCHABLE_PATIENT_FIELDS):
+        index_patients([instance])
+
+
+@receiver(post_save, sender=User)
+def index_patient_user_search_terms(sender, instance, created, update_fields=None, **kwargs):
+    # a new user has no Patient yet; logins only touch last_login
+    if created or not _touches(update_fields, SEARCHABLE_USER_FIELDS):
+        return
+    patient = Patient.objects.filter(user=instance).select_related("user").first()
+    if patient is not None:
+        index_patients([patient])
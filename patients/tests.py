@@ -1,3 +1,59 @@
+from django.contrib.auth.models import User
 from django.test import TestCase
 
-# Create your tests here.
+from doctor_app.models import Doctor
+from hospital_app.models import Hospital
+
+from .models import Patient
+
+
+class PatientSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.hospital = Hospital.objects.create(name="H", location="L", email="h@example.com", phone="1")
+        other = Hospital.objects.create(name="O", location="L", email="o@example.com", phone="2")
+        Doctor.objects.create(user=User.objects.create_user("drbob", password="pw"), hospital=cls.hospital,
+                              specialization="x", contact_number="1", qualification="MBBS")
+
+        def patient(username, first, last, hospital, phone):
+            user = User.objects.create_user(username, password="pw", first_name=first, last_name=last)
+            return Patient.objects.create(user=user, hospital=hospital, phone_number=phone)
+
+        cls.john = patient("jsmith", "John", "Smith", cls.hospital, "5550101")
+        cls.johanna = patient("jo", "Johanna", "Berg", cls.hospital, "5550202")
+        patient("jsmith2", "John", "Smithson", other, "5550303")
+
+    def _search(self, q):
+        response = self.client.get("/patients/search/", {"q": q})
+        self.assertEqual(response.status_code, 200)
+        return [r["id"] for r in response.json()["results"]]
+
+    def test_prefix_and_infix_matches_in_own_hospital(self):
+        self.client.login(username="drbob", password="pw")
+
+        self.assertEqual(self._search("John Sm"), [self.john.id])
+        self.assertEqual(set(self._search("joh")), {self.john.id, self.johanna.id})
+        self.assertEqual(self._search("mith"), [self.john.id])     # trigram (infix)
+        self.assertEqual(self._search("0202"), [self.johanna.id])
+        self.assertEqual(self._search("j"), [])                    # too short
+
+    def test_results_do_not_expose_email(self):
+        self.john.user.email = "john@example.com"
+        self.john.user.save()
+        self.client.login(username="drbob", password="pw")
+
+        response = self.client.get("/patients/search/", {"q": "jsmith"})
+        self.assertNotIn("email", response.json()["results"][0])
+        self.assertNotContains(response, "john@example.com")
+
+    def test_renamed_user_is_reindexed(self):
+        self.client.login(username="drbob", password="pw")
+        self.john.user.last_name = "Doe"
+        self.john.user.save()
+
+        self.assertEqual(self._search("john doe"), [self.john.id])
+        self.assertEqual(self._search("john smith"), [])
+
+    def test_patients_cannot_search(self):
+        self.client.login(username="jsmith", password="pw")
+        self.assertEqual(self.client.get("/patients/search/", {"q": "jo"}).status_code, 403)
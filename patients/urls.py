@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import patient_dashboard, secure_patient_view, patient_settings
+from .views import patient_dashboard, secure_patient_view, patient_settings, patient_search
 
 app_name = "patients"
 
@@ -9,4 +9,7 @@ urlpatterns = [
 
     # NEW
     path('settings/', patient_settings, name='patient_settings'),
+
+    # staff typeahead (doctor / laboratory dashboards)
+    path('search/', patient_search, name='patient_search'),
 ]
\ No newline at end of file
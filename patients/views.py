@@ -1,10 +1,13 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
-from django.utils import timezone
+from django.http import JsonResponse
 
 from .models import Patient, Appointment
+from .search import SEARCH_LIMIT, patient_result, search_patients
 from records.models import Report, Prescription
-from access_control.models import PatientAccess
+from access_control.grants import active_grants
+from doctor_app.models import Doctor
+from laboratory.models import Laboratory
 from django.contrib import messages
 
 @login_required
@@ -49,13 +52,7 @@ def secure_patient_view(request, access_id):
     except Patient.DoesNotExist:
         return render(request, 'errors/not_a_patient.html')
 
-    access = get_object_or_404(
-        PatientAccess,
-        id=access_id,
-        patient=patient,
-        is_verified=True,
-        expires_at__gt=timezone.now()
-    )
+    access = get_object_or_404(active_grants(), id=access_id, patient=patient)
 
     return render(request, 'patients/secure_patient_page.html', {
         'patient': patient,
@@ -79,4 +76,33 @@ def patient_settings(request):
 
     return render(request, "patients/settings.html", {
         "patient": patient
-    })  
\ No newline at end of file
+    })  
+
+
+def search_hospital_id(user):
+    """Hospital whose patients `user` may look up (doctor or laboratory), else None."""
+    for model in (Doctor, Laboratory):
+        hospital_id = model.objects.filter(user=user).values_list("hospital_id", flat=True).first()
+        if hospital_id is not None:
+            return hospital_id
+    return None
+
+
+@login_required
+def patient_search(request):
+    """
+    Patient typeahead for staff dashboards
+    URL: /patients/search/?q=<text>&limit=<n>
+    Results are limited to the caller's hospital.
+    """
+    hospital_id = search_hospital_id(request.user)
+    if hospital_id is None:
+        return JsonResponse({"error": "Patient search is for hospital staff."}, status=403)
+
+    try:
+        limit = int(request.GET.get("limit", SEARCH_LIMIT))
+    except ValueError:
+        limit = SEARCH_LIMIT
+
+    patients = search_patients(request.GET.get("q", ""), hospital_id, limit)
+    return JsonResponse({"results": [patient_result(p) for p in patients]})
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.7 on 2026-10-17 20:47
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('records', '0003_auditlog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encounter',
+            name='last_updated',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='encounter',
+            name='version_id',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='observation',
+            name='last_updated',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='observation',
+            name='version_id',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
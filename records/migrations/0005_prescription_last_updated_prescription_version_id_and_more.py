@@ -0,0 +1,66 @@
+# Generated by Django 5.1.7 on 2026-10-17 20:48
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def backfill_last_updated(apps, schema_editor):
+    """Existing rows: use their own timestamp rather than the migration time."""
+    for model_name, source in (
+        ("Encounter", "started_at"),
+        ("Observation", "recorded_at"),
+        ("Report", "uploaded_at"),
+        ("Prescription", "created_at"),
+    ):
+        apps.get_model("records", model_name).objects.update(last_updated=models.F(source))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctor_app', '0001_initial'),
+        ('hospital_app', '0001_initial'),
+        ('laboratory', '0001_initial'),
+        ('patients', '0004_patient_patients_patient_lu_idx'),
+        ('records', '0004_encounter_last_updated_encounter_version_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prescription',
+            name='last_updated',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='prescription',
+            name='version_id',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='last_updated',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='report',
+            name='version_id',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='encounter',
+            index=models.Index(fields=['last_updated', 'id'], name='records_encounter_lu_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='observation',
+            index=models.Index(fields=['last_updated', 'id'], name='records_observation_lu_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prescription',
+            index=models.Index(fields=['last_updated', 'id'], name='records_prescription_lu_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='report',
+            index=models.Index(fields=['last_updated', 'id'], name='records_report_lu_idx'),
+        ),
+        migrations.RunPython(backfill_last_updated, migrations.RunPython.noop),
+    ]
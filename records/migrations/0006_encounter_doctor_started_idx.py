@@ -0,0 +1,20 @@
+# Generated by Django 5.1.7 on 2026-10-17 21:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctor_app', '0001_initial'),
+        ('hospital_app', '0001_initial'),
+        ('patients', '0004_patient_patients_patient_lu_idx'),
+        ('records', '0005_prescription_last_updated_prescription_version_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='encounter',
+            index=models.Index(fields=['doctor', '-started_at', '-id'], name='records_enc_doctor_started'),
+        ),
+    ]
@@ -7,11 +7,13 @@ from laboratory.models import Laboratory
 from hospital_app.models import Hospital
 from cloudinary_storage.storage import RawMediaCloudinaryStorage
 
+from fhir.models import VersionedResource
+
 
 # =========================
 # Encounter
 # =========================
-class Encounter(models.Model):
+class Encounter(VersionedResource):
     patient = models.ForeignKey(
         Patient,
         on_delete=models.CASCADE,
@@ -38,6 +40,12 @@ class Encounter(models.Model):
     started_at = models.DateTimeField(default=timezone.now)
     ended_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta(VersionedResource.Meta):
+        indexes = VersionedResource.Meta.indexes + [
+            # doctor dashboard: a doctor's encounters, newest first (keyset paged)
+            models.Index(fields=["doctor", "-started_at", "-id"], name="records_enc_doctor_started"),
+        ]
+
     def __str__(self):
         return f"Encounter #{self.id} - {self.patient}"
 
@@ -45,7 +53,7 @@ class Encounter(models.Model):
 # =========================
 # Observation
 # =========================
-class Observation(models.Model):
+class Observation(VersionedResource):
     encounter = models.ForeignKey(
         Encounter,
         on_delete=models.CASCADE,
@@ -73,7 +81,7 @@ class Observation(models.Model):
 # =========================
 # Diagnostic Report
 # =========================
-class Report(models.Model):
+class Report(VersionedResource):
     STATUS_CHOICES = (
         ("pending", "Pending"),
         ("explained", "Explained"),
@@ -135,7 +143,7 @@ class Report(models.Model):
 # =========================
 # Prescription
 # =========================
-class Prescription(models.Model):
+class Prescription(VersionedResource):
     encounter = models.ForeignKey(
         Encounter,
         on_delete=models.CASCADE,